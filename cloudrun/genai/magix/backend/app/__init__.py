@@ -17,12 +17,29 @@ from flask_cors import CORS
 
 
 def create_app():
+    from app.main.util.codec import CodecJSONProvider
+    from app.main.util.recorder import init_recorder
+    from app.main.util.tracing import init_tracing
+    from db.config import LAST_WRITE_HEADER, init_read_your_writes
+
     app = Flask(__name__)
-    CORS(app)
+    app.json = CodecJSONProvider(app)
+    # the frontend is served from another origin, and sends the last write
+    # cookie and reads the last write header of the responses
+    CORS(app, expose_headers=[LAST_WRITE_HEADER], supports_credentials=True)
+    init_tracing(app)
+    init_recorder(app)
+    init_read_your_writes(app)
 
     # Register blueprints
     from app.main import bp as main_bp
 
     app.register_blueprint(main_bp)
 
+    from app.main.service.llm_service import start_llm_catalog
+    from app.main.service.purge_service import start_purger
+
+    start_llm_catalog()
+    start_purger()
+
     return app
@@ -16,4 +16,12 @@ from flask import Blueprint
 
 bp = Blueprint("main", __name__)
 
-from app.main.controller import conversation_controller, llm_controller, user_controller
+from app.main.controller import (
+    batch_controller,
+    conversation_controller,
+    llm_controller,
+    metrics_controller,
+    profile_controller,
+    search_controller,
+    user_controller,
+)
@@ -0,0 +1,86 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from flask import request
+from http import HTTPStatus
+from app.main import bp
+from app.main.model.apiresponse import ApiResponse
+from app.main.service.batch_service import (
+    create_batch_job,
+    get_batch_job_status,
+    parse_prompts,
+    resume_batch_job,
+)
+
+
+@bp.route("/batches", methods=["POST"])
+def create_batch_route():
+    """Batch job controller
+    Form data:
+        file - NDJSON prompts file, one {"prompt": ..., "id": optional} per line
+        llm_name - Name of the LLM used for every prompt
+        userEmail - User email
+    Returns:
+        Status of the created batch job.
+    """
+    prompts_file = request.files.get("file")
+    llm_name = request.form.get("llm_name")
+    user_email = request.form.get("userEmail")
+    if not prompts_file or not llm_name or not user_email:
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="Missing argument")
+        return response.to_response()
+
+    try:
+        prompts = parse_prompts(prompts_file.read())
+    except ValueError as e:
+        response = ApiResponse(
+            HTTPStatus.BAD_REQUEST, message=f"Invalid prompts file - {e}"
+        )
+        return response.to_response()
+    if not prompts:
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="No prompts in file")
+        return response.to_response()
+
+    return create_batch_job(user_email, llm_name, prompts)
+
+
+@bp.route("/batches/<string:job_id>", methods=["GET"])
+def batch_status_route(job_id):
+    """Batch job status controller
+    Args:
+        job_id - Batch job ID
+    Returns:
+        Progress, throughput and ETA of the batch job.
+    """
+    user_email = request.args.get("userEmail")
+    if not user_email:
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="User email is required")
+        return response.to_response()
+    return get_batch_job_status(user_email, job_id)
+
+
+@bp.route("/batches/<string:job_id>/resume", methods=["POST"])
+def resume_batch_route(job_id):
+    """Resumes a batch job from its last checkpoint
+    Args:
+        job_id - Batch job ID
+    Returns:
+        Status of the resumed batch job.
+    """
+    data = request.get_json(silent=True) or {}
+    user_email = data.get("userEmail")
+    if not user_email:
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="User email is required")
+        return response.to_response()
+    return resume_batch_job(user_email, job_id)
@@ -15,22 +15,51 @@
 from flask import request, jsonify, Response
 from http import HTTPStatus
 from flask_cors import cross_origin
+import uuid
 import logging
+import threading
 from app.main import bp
 from app.main.service.conversation_service import (
+    CONVERSATIONS_PAGE_SIZE,
+    MAX_BATCH_CONVERSATIONS,
+    MAX_CONVERSATIONS_PAGE_SIZE,
     get_user_conversations,
+    get_user_conversations_page,
     create_conversation_id,
     get_conversation_settings,
     post_conversation_settings,
     update_conversation_settings,
     get_conversation,
+    get_conversations_batch,
+    delete_conversations,
+    is_conversation_deleted,
 )
 from app.main.service.message_service import (
+    FANOUT_MAX_LLMS,
     get_messages_for_conversation,
-    post_message,
+    generate_messages,
+)
+from app.main.service.generation_service import (
+    GenerationExpired,
+    get_generation,
+    start_generation,
 )
 from app.main.util.utils import get_file_from_gcs
+from app.main.util.profiler import PROFILE_CAPTURE_HEADER, request_capture
+from app.main.util.streaming import (
+    SSE_MIMETYPE,
+    NDJSON_MIMETYPE,
+    coalesce_events,
+    format_ndjson_line,
+    format_sse_event,
+    ndjson_stream,
+)
 from app.main.model.apiresponse import ApiResponse
+from db.config import (
+    LAST_WRITE_HEADER,
+    READ_YOUR_WRITES_STREAM_SECONDS,
+    record_caller_write,
+)
 
 
 @bp.route("/conversations", methods=["POST", "GET"])
@@ -47,13 +76,28 @@ def get_user_conversations_route():
             )
             return response.to_response()
         conversation_id = request.args.get("id")
+        if not conversation_id and "cursor" in request.args:
+            limit = request.args.get("limit", default=CONVERSATIONS_PAGE_SIZE, type=int)
+            if limit < 1:
+                response = ApiResponse(
+                    HTTPStatus.BAD_REQUEST, message="limit must be positive"
+                )
+                return response.to_response()
+            return get_user_conversations_page(
+                user_email,
+                min(limit, MAX_CONVERSATIONS_PAGE_SIZE),
+                request.args["cursor"],
+            )
         if not conversation_id:
             offset = request.args.get("offset", default=0, type=int)
             limit = request.args.get("limit", type=int)
-            print(f"Received offset: {offset}, limit: {limit}")
+            logging.debug(f"Received offset: {offset}, limit: {limit}")
             user_conversations = get_user_conversations(user_email, offset, limit)
         else:
             user_conversations = get_conversation(conversation_id)
+            if not isinstance(user_conversations, dict):
+                # error response, e.g. of a deleted conversation
+                return user_conversations
         return jsonify(user_conversations)
     else:
         #AVTODO it seems useless
@@ -61,6 +105,116 @@ def get_user_conversations_route():
         return id
 
 
+def _valid_conversation_ids(conversation_ids):
+    """Returns the ids that are UUIDs, the others name no conversation."""
+    valid = []
+    for conversation_id in conversation_ids:
+        try:
+            uuid.UUID(conversation_id)
+        except ValueError:
+            continue
+        valid.append(conversation_id)
+    return valid
+
+
+def _with_invalid_ids_missing(result, conversation_ids, valid_ids):
+    """Adds the ids that are not UUIDs to the missing ids of a result."""
+    if not isinstance(result, dict):
+        return result
+    missing = set(result["missing"]) | (set(conversation_ids) - set(valid_ids))
+    result["missing"] = [
+        conversation_id
+        for conversation_id in dict.fromkeys(conversation_ids)
+        if conversation_id in missing
+    ]
+    return result
+
+
+@bp.route("/conversations/batch", methods=["POST"])
+def get_conversations_batch_route():
+    """Batch conversation controller
+    Body:
+        userEmail - User email
+        ids - Conversation ids
+        preview - Whether to add the last message of each conversation, optional
+    Returns:
+        The conversations with their settings, and the ids not found.
+    """
+    data = request.get_json(silent=True) or {}
+    user_email = data.get("userEmail")
+    conversation_ids = data.get("ids")
+    if (
+        not user_email
+        or not isinstance(conversation_ids, list)
+        or not all(isinstance(conversation_id, str) for conversation_id in conversation_ids)
+    ):
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="Missing argument")
+        return response.to_response()
+    if len(conversation_ids) > MAX_BATCH_CONVERSATIONS:
+        response = ApiResponse(
+            HTTPStatus.BAD_REQUEST,
+            message=f"At most {MAX_BATCH_CONVERSATIONS} ids per batch",
+        )
+        return response.to_response()
+    valid_ids = _valid_conversation_ids(conversation_ids)
+    result = get_conversations_batch(valid_ids, user_email, bool(data.get("preview")))
+    return _with_invalid_ids_missing(result, conversation_ids, valid_ids)
+
+
+@bp.route("/conversations", methods=["DELETE"])
+def delete_conversations_route():
+    """Bulk conversation delete controller
+    Body:
+        userEmail - User email
+        ids - Conversation ids
+    Returns:
+        The ids of the deleted conversations, and of those not found.
+    """
+    data = request.get_json(silent=True) or {}
+    user_email = data.get("userEmail")
+    conversation_ids = data.get("ids")
+    if (
+        not user_email
+        or not isinstance(conversation_ids, list)
+        or not all(isinstance(conversation_id, str) for conversation_id in conversation_ids)
+    ):
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="Missing argument")
+        return response.to_response()
+    if len(conversation_ids) > MAX_BATCH_CONVERSATIONS:
+        response = ApiResponse(
+            HTTPStatus.BAD_REQUEST,
+            message=f"At most {MAX_BATCH_CONVERSATIONS} ids per batch",
+        )
+        return response.to_response()
+    valid_ids = _valid_conversation_ids(conversation_ids)
+    result = delete_conversations(user_email, valid_ids)
+    return _with_invalid_ids_missing(result, conversation_ids, valid_ids)
+
+
+@bp.route("/conversations/<string:conversation_id>", methods=["DELETE"])
+def delete_conversation_route(conversation_id):
+    """Conversation delete controller
+    Args:
+        conversation_id - Conversation ID
+    Returns:
+        Empty response, 404 if the user has no such conversation.
+    """
+    user_email = request.args.get("userEmail")
+    if not user_email:
+        response = ApiResponse(HTTPStatus.BAD_REQUEST, message="User email is required")
+        return response.to_response()
+    if not _valid_conversation_ids([conversation_id]):
+        response = ApiResponse(HTTPStatus.NOT_FOUND, message="Conversation not found")
+        return response.to_response()
+    result = delete_conversations(user_email, [conversation_id])
+    if not isinstance(result, dict):
+        return result
+    if not result["deleted"]:
+        response = ApiResponse(HTTPStatus.NOT_FOUND, message="Conversation not found")
+        return response.to_response()
+    return "", HTTPStatus.NO_CONTENT
+
+
 @bp.route(
     "/conversations/<string:conversation_id>/settings", methods=["POST", "GET", "PATCH"]
 )
@@ -90,15 +244,58 @@ def conversation_settings(conversation_id):
             llm_params = data["llm_params"]
             user_email = data["userEmail"]
             return post_conversation_settings(
-                conversation_id, user_email, llm_name, llm_params
+                conversation_id, user_email, llm_name=llm_name, llm_params=llm_params
             )
         else:
             response = ApiResponse(HTTPStatus.BAD_REQUEST, message="Missing argument")
             return response.to_response()
 
 
+def stream_generation(generation, offset=0):
+    """Streams a generation from an offset in the negotiated format.
+    Args:
+        generation: Generation object
+        offset: Sequence number of the first chunk to send
+    Returns:
+        Streaming response, SSE or newline delimited JSON.
+    """
+    try:
+        reader = generation.reader(offset)
+    except GenerationExpired as e:
+        response = ApiResponse(HTTPStatus.GONE, message=str(e))
+        return response.to_response()
+
+    headers = {"X-Generation-Id": generation.id}
+    output_format = request.accept_mimetypes.best_match(
+        [NDJSON_MIMETYPE, SSE_MIMETYPE], default=NDJSON_MIMETYPE
+    )
+    if output_format == SSE_MIMETYPE:
+        headers.update({"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        frames = coalesce_events(reader.get)
+    else:
+        frames = ndjson_stream(reader.get)
+
+    def guarded_frames():
+        try:
+            yield from frames
+        except GenerationExpired as e:
+            # the client fell further behind than the generation buffer
+            if output_format == SSE_MIMETYPE:
+                yield format_sse_event({"message": str(e)}, event="error")
+            else:
+                yield format_ndjson_line({"role": "error", "message": str(e)})
+
+    response = Response(guarded_frames(), mimetype=output_format, headers=headers)
+    # runs when the server closes the response, including on client disconnect
+    # before the first frame, so an abandoned generation can be cancelled
+    response.call_on_close(reader.close)
+    return response
+
+
 @bp.route("/conversations/<string:conversation_id>/messages", methods=["POST", "GET"])
-@cross_origin()
+@cross_origin(
+    expose_headers=["X-Generation-Id", LAST_WRITE_HEADER], supports_credentials=True
+)
 def get_conversation_messages_route(conversation_id):
     """Conversation message controller
     Args:
@@ -112,10 +309,68 @@ def get_conversation_messages_route(conversation_id):
     elif request.method == "POST":
         data = request.get_json()
         if data is not None and "role" in data and "message" in data:
-            logging.debug("CONVERSATION ID: ", conversation_id)
-            return Response(
-                post_message(conversation_id, data), mimetype="application/json"
-            )
+            llm_names = data.get("llm_names")
+            if llm_names is not None and (
+                not isinstance(llm_names, list)
+                or not all(isinstance(name, str) for name in llm_names)
+                or not 0 < len(llm_names) <= FANOUT_MAX_LLMS
+            ):
+                response = ApiResponse(
+                    HTTPStatus.BAD_REQUEST,
+                    message=f"llm_names must list 1 to {FANOUT_MAX_LLMS} LLM names",
+                )
+                return response.to_response()
+            logging.debug(f"CONVERSATION ID: {conversation_id}")
+            # a deleted conversation waits to be purged, its files must not be
+            # written again
+            if _valid_conversation_ids([conversation_id]) and is_conversation_deleted(
+                conversation_id
+            ):
+                response = ApiResponse(HTTPStatus.NOT_FOUND, message="Conversation not found")
+                return response.to_response()
+            cancel_event = threading.Event()
+            # admins profile one request by sending an armed capture id
+            with request_capture(request.headers.get(PROFILE_CAPTURE_HEADER)) as capture:
+                generation = start_generation(
+                    conversation_id,
+                    generate_messages(conversation_id, data, cancel_event=cancel_event),
+                    cancel_event,
+                )
+            # the messages are persisted at the end of the stream
+            record_caller_write(READ_YOUR_WRITES_STREAM_SECONDS)
+            response = stream_generation(generation)
+            if capture is not None:
+                response.call_on_close(capture.stop_event.set)
+            return response
         else:
             response = ApiResponse(HTTPStatus.BAD_REQUEST, message="Missing argument")
             return response.to_response()
+
+
+@bp.route(
+    "/conversations/<string:conversation_id>/generations/<string:generation_id>",
+    methods=["GET"],
+)
+@cross_origin(
+    expose_headers=["X-Generation-Id", LAST_WRITE_HEADER], supports_credentials=True
+)
+def resume_generation_route(conversation_id, generation_id):
+    """Resumes a dropped message stream
+    Args:
+        conversation_id - Conversation ID
+        generation_id - Generation ID returned in the X-Generation-Id header
+    Returns:
+        Remaining response from LLM, starting after the Last-Event-ID header
+        or at the offset query parameter.
+    """
+    generation = get_generation(conversation_id, generation_id)
+    if not generation:
+        response = ApiResponse(HTTPStatus.NOT_FOUND, message="Generation not found")
+        return response.to_response()
+
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    if last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+    else:
+        offset = request.args.get("offset", default=0, type=int)
+    return stream_generation(generation, offset)
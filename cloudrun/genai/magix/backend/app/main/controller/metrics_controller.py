@@ -0,0 +1,26 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from flask import Response
+from app.main import bp
+from app.main.util.metrics import render_prometheus
+
+
+@bp.route("/metrics", methods=["GET"])
+def metrics_route():
+    """Prometheus metrics controller
+    Returns:
+        LLM and chat latency and throughput metrics in the Prometheus text format.
+    """
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
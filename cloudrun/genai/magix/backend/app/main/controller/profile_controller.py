@@ -0,0 +1,100 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from http import HTTPStatus
+from flask import Response, g, jsonify, request
+from app.main import bp
+from app.main.model.apiresponse import ApiResponse
+from app.main.util.auth import admin_required
+from app.main.util.profiler import (
+    PROFILE_CAPTURE_HEADER,
+    PROFILE_INTERVAL_SECONDS,
+    PROFILE_TOP_ALLOCATIONS,
+    ProfilerBusy,
+    arm_request_capture,
+    get_capture,
+    profile_process,
+)
+
+
+def profile_response(result):
+    """Returns a profile as JSON, or as a collapsed stack file with
+    ?format=collapsed."""
+    if request.args.get("format") == "collapsed":
+        return Response(result["collapsed"], mimetype="text/plain")
+    return jsonify(result)
+
+
+def profile_options():
+    interval_ms = request.args.get("interval_ms", type=float)
+    return {
+        "interval": interval_ms / 1000 if interval_ms else PROFILE_INTERVAL_SECONDS,
+        "top_n": request.args.get("top", default=PROFILE_TOP_ALLOCATIONS, type=int),
+    }
+
+
+@bp.route("/admin/profile", methods=["POST"])
+@admin_required
+def profile_process_route():
+    """Process profile controller
+    Returns:
+        Sampled stacks of every thread and the allocation top-N, after
+        sampling for ?seconds (default 10).
+    """
+    seconds = request.args.get("seconds", default=10, type=float)
+    logging.info(f"Profiling process for {seconds}s, requested by {g.user['email']}")
+    try:
+        return profile_response(profile_process(seconds, **profile_options()))
+    except ProfilerBusy as e:
+        response = ApiResponse(HTTPStatus.CONFLICT, message=str(e))
+        return response.to_response()
+
+
+@bp.route("/admin/profile/captures", methods=["POST"])
+@admin_required
+def arm_capture_route():
+    """Request capture controller
+    Returns:
+        Id of a capture profiling the next request to
+        /conversations/<id>/messages sent with it in the X-Profile-Capture header.
+    """
+    try:
+        profile = arm_request_capture(**profile_options())
+    except ProfilerBusy as e:
+        response = ApiResponse(HTTPStatus.CONFLICT, message=str(e))
+        return response.to_response()
+    logging.info(f"Profile capture {profile.id} armed by {g.user['email']}")
+    return jsonify({"id": profile.id, "header": PROFILE_CAPTURE_HEADER}), HTTPStatus.CREATED
+
+
+@bp.route("/admin/profile/captures/<string:capture_id>", methods=["GET"])
+@admin_required
+def get_capture_route(capture_id):
+    """Request capture result controller
+    Args:
+        capture_id - Capture id
+    Returns:
+        The profile once the captured request finished, its status until then.
+    """
+    profile = get_capture(capture_id)
+    if profile is None:
+        response = ApiResponse(HTTPStatus.NOT_FOUND, message="Capture not found")
+        return response.to_response()
+    if profile.status == "failed":
+        response = ApiResponse(HTTPStatus.INTERNAL_SERVER_ERROR, message="Capture failed")
+        return response.to_response()
+    if profile.result is None:
+        return jsonify(profile.to_dict()), HTTPStatus.ACCEPTED
+    return profile_response(profile.result)
@@ -0,0 +1,53 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from flask import request
+from http import HTTPStatus
+from app.main import bp
+from app.main.model.apiresponse import ApiResponse
+from app.main.service.search_service import (
+    MAX_SEARCH_PAGE_SIZE,
+    SEARCH_PAGE_SIZE,
+    search_conversations,
+)
+
+
+@bp.route("/search", methods=["GET"])
+def search_route():
+    """Search controller
+    Query parameters:
+        userEmail - User email
+        q - Search terms
+        limit - Maximum number of hits, optional
+        offset - next_offset of the previous page, optional
+    Returns:
+        Ranked hits of the user's conversation titles and messages.
+    """
+    user_email = request.args.get("userEmail")
+    query = request.args.get("q", "").strip()
+    if not user_email or not query:
+        response = ApiResponse(
+            HTTPStatus.BAD_REQUEST, message="userEmail and q are required"
+        )
+        return response.to_response()
+    limit = request.args.get("limit", default=SEARCH_PAGE_SIZE, type=int)
+    offset = request.args.get("offset", default=0, type=int)
+    if limit < 1 or offset < 0:
+        response = ApiResponse(
+            HTTPStatus.BAD_REQUEST, message="limit must be positive and offset not negative"
+        )
+        return response.to_response()
+    return search_conversations(
+        user_email, query, min(limit, MAX_SEARCH_PAGE_SIZE), offset
+    )
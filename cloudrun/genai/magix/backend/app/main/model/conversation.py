@@ -12,8 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from sqlalchemy import Column, String, JSON, UUID, DateTime, func
+from sqlalchemy import Column, String, JSON, UUID, DateTime, Index, Integer, func
 from sqlalchemy.orm import declarative_base
+from app.main.model.search import search_document
 
 Base = declarative_base()
 
@@ -25,12 +26,50 @@ class ConversationSQL(Base):
     """
 
     __tablename__ = "conversation"
-    id = Column(UUID, unique=True, primary_key=True)
+    id = Column(UUID(as_uuid=False), unique=True, primary_key=True)
     user_email = Column(String)
     title = Column(String)
     llm_name = Column(String)
     llm_params = Column(JSON, nullable=True)
     created_at = Column(DateTime, default=func.now())
+    # summary of the messages, updated whenever a turn is persisted;
+    # last_message_at is the creation time while there is no message
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    last_message_at = Column(DateTime, default=func.now())
+    last_message_preview = Column(String, nullable=True)
+    # set when the conversation is deleted, until it is purged
+    deleted_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # keyset pagination of a user's conversations, most recently active first
+        Index(
+            "ix_conversation_user_email_last_message_at_id",
+            user_email,
+            last_message_at.desc(),
+            id,
+        ),
+        # keyset pagination of every user's conversations, by activity
+        Index(
+            "ix_conversation_last_message_at_id",
+            last_message_at,
+            id,
+            postgresql_where=deleted_at.is_(None),
+            sqlite_where=deleted_at.is_(None),
+        ),
+        # conversations waiting to be purged
+        Index(
+            "ix_conversation_deleted_at",
+            deleted_at,
+            postgresql_where=deleted_at.isnot(None),
+            sqlite_where=deleted_at.isnot(None),
+        ),
+        Index(
+            "ix_conversation_title_document",
+            search_document(title),
+            postgresql_using="gin",
+            info={"dialects": ("postgresql",)},
+        ).ddl_if(dialect="postgresql"),
+    )
 
     def __init__(self, id, user_email, title, llm_name, llm_params):
         self.id = id
@@ -52,4 +91,7 @@ class ConversationSQL(Base):
             "title": self.title,
             "llm_name": self.llm_name,
             "llm_params": self.llm_params,
+            "message_count": self.message_count,
+            "last_message_at": self.last_message_at,
+            "last_message_preview": self.last_message_preview,
         }
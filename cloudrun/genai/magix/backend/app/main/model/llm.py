@@ -12,22 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Provider SDKs are imported by the methods using them, so that starting the
+# app, or serving requests not calling an LLM, does not pay for their imports.
 import os
-import json
 import time
 import logging
-import google.generativeai as genai
-import openai
-import vertexai
-from vertexai.preview.generative_models import GenerativeModel, Content, Part, GenerationConfig
-import httpx
-import google.auth
-from google.auth.transport.requests import Request
-import os
-from mistralai import Mistral, UserMessage
 from sqlalchemy import create_engine, Column, String, Boolean, JSON
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.ext.declarative import declarative_base
+from app.main.util import codec
+from app.main.util.metrics import increment_counter, instrumented_generation
+from app.main.util.tracing import traced
 
 Base = declarative_base()
 
@@ -87,9 +82,11 @@ class OpenAILLM:
     def __init__(self, model_name="gpt-3.5-turbo", api_key=None):
         self.model_name = model_name
         self.api_key = api_key
-        openai.api_key = api_key
 
     def generate_response(self, prompt):
+        import openai
+
+        openai.api_key = self.api_key
         response = openai.ChatCompletion.create(
             model=self.model_name, messages=[{"role": "user", "content": prompt}]
         )
@@ -105,13 +102,20 @@ class OpenAILLM:
 
 
 class GeminiLLM:
+    llm_name = "Gemini"
+
     def __init__(self, model_name="gemini-1.5-pro", api_key=None):
         self.model_name = model_name
         self.api_key = os.environ.get("GEMINI_API_KEY")
         self.project_id = os.environ.get("GOOGLE_PROJECT_ID")
         self.region = os.environ.get("GOOGLE_REGION")
 
-    def generate_response(self, context, prompt, params, stream=True):
+    @traced("llm.gemini.generate_response")
+    @instrumented_generation
+    def generate_response(self, context, prompt, params, stream=True, cancel_event=None):
+        import vertexai
+        from vertexai.preview.generative_models import GenerativeModel, GenerationConfig
+
         # genai.configure(api_key=self.api_key)
         vertexai.init(project=self.project_id, location=self.region)
         model = GenerativeModel(self.model_name)
@@ -122,11 +126,18 @@ class GeminiLLM:
         )
         if stream:
             genai_response = chat.send_message(prompt, stream=True, generation_config=config)
-            for chunk in genai_response:
-                yield {
-                    "result": "success",
-                    "data": [{"role": "system", "message": chunk.text}],
-                }
+            try:
+                for chunk in genai_response:
+                    if cancel_event is not None and cancel_event.is_set():
+                        logging.info("Gemini generation cancelled")
+                        break
+                    yield {
+                        "result": "success",
+                        "data": [{"role": "system", "message": chunk.text}],
+                    }
+            finally:
+                # closing the Vertex iterator cancels the underlying stream
+                genai_response.close()
         else:
             non_streaming_genai_response = chat.send_message(prompt, generation_config=config)
             non_streaming_response = {
@@ -141,6 +152,8 @@ class GeminiLLM:
         return self.model_name
 
     def transform_context_structure(self, context):
+        from vertexai.preview.generative_models import Content, Part
+
         tranformed_context = []
         for con in context:
             if con["role"] == "user":
@@ -160,12 +173,17 @@ class GeminiLLM:
 
 
 class CodestralLLM:
+    llm_name = "Codestral"
+
     def __init__(self, model_name="codestral-latest", api_key=None, stream=False):
         self.model_name = model_name
         self.api_key = api_key
         self.stream = stream
 
     def get_credentials(self):
+        import google.auth
+        from google.auth.transport.requests import Request
+
         credentials, project_id = google.auth.default(
             scopes=["https://www.googleapis.com/auth/cloud-platform"]
         )
@@ -189,43 +207,28 @@ class CodestralLLM:
         return url
 
     def extract_streamed_content(self, chunk):
-        if chunk.strip() == "data: [DONE]":
-            return
         try:
-            # Parse the JSON chunk
-            data = json.loads(chunk[5:])  # Remove the "data: " prefix
-            # Extract the 'content' value
-            content = data["choices"][0]["delta"]["content"]
-            if content != None:
-                return content
-
-        except json.JSONDecodeError:
-            print(f"Error: Invalid JSON format in chunk: {chunk}")
-            return None  # Or handle the error as needed
+            # Content of the "data: {...}" line, None for [DONE] and role-only chunks
+            return codec.decode_codestral_chunk(chunk)
 
-        except KeyError:
-            print(f"Error: 'content' key not found in chunk: {chunk}")
+        except codec.DecodeError:
+            logging.error(f"Error: Invalid JSON format in chunk: {chunk}")
             return None  # Or handle the error as needed
 
     def extract_non_streamed_content(self, chunk):
         try:
-            # Parse the JSON chunk
-            data = json.loads(chunk)  # Remove the "data: " prefix
-            # Extract the 'content' value
-            content = data["choices"][0]["message"]["content"]
-            if content != None:
-                return content
-
-        except json.JSONDecodeError:
-            print(f"Error: Invalid JSON format in chunk: {chunk}")
-            return None  # Or handle the error as needed
+            return codec.decode_codestral_message(chunk)
 
-        except KeyError:
-            print(f"Error: 'content' key not found in chunk: {chunk}")
+        except codec.DecodeError:
+            logging.error(f"Error: Invalid JSON format in chunk: {chunk}")
             return None  # Or handle the error as needed
 
-    def generate_response(self, context, prompt, params, stream=True):
+    @traced("llm.codestral.generate_response")
+    @instrumented_generation
+    def generate_response(self, context, prompt, params, stream=True, cancel_event=None):
         try:
+            import httpx
+
             project_id = os.environ.get("GOOGLE_PROJECT_ID")
             region = os.environ.get("GOOGLE_REGION")
 
@@ -260,12 +263,16 @@ class CodestralLLM:
                 "temperature": params.get("temp", 0.1),
                 "max_tokens": params.get("max_tokens", 1000)
                 }
-            # Make the call with streaming
+            # Make the call with streaming, leaving the with blocks closes the
+            # httpx stream and stops the upstream generation
             with httpx.Client() as client:
                 with client.stream(
                     "POST", url, json=data, headers=headers, timeout=None
                 ) as resp:
                     for chunk in resp.iter_lines():
+                        if cancel_event is not None and cancel_event.is_set():
+                            logging.info("Codestral generation cancelled")
+                            break
                         if chunk and stream == True:
                             # print(chunk, end='\n', flush=True)
                             content = self.extract_streamed_content(chunk=chunk)
@@ -295,6 +302,7 @@ class CodestralLLM:
                                 yield non_streaming_response
         except Exception as e:
             logging.error(f"error in generate response - {e}")
+            increment_counter("llm_errors_total", llm_name=self.llm_name)
 
     def transform_context_structure(self, context, prompt):
         tranformed_context = []
@@ -0,0 +1,80 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Index,
+    Integer,
+    String,
+    Text,
+    UUID,
+    func,
+    literal_column,
+)
+from sqlalchemy.orm import declarative_base
+
+Base = declarative_base()
+
+# Text search configuration of the message and title indexes.
+SEARCH_CONFIG = "english"
+
+
+def search_document(column):
+    """Returns the tsvector expression the full-text indexes are built on,
+    queries must use the same expression to use them."""
+    # literals, not parameters, so that the SQL is the indexed expression
+    return func.to_tsvector(
+        literal_column(f"'{SEARCH_CONFIG}'"), func.coalesce(column, literal_column("''"))
+    )
+
+
+class MessageSearchSQL(Base):
+    """
+    Message of a conversation, indexed for full-text search
+
+    """
+
+    __tablename__ = "message_search"
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True)
+    conversation_id = Column(UUID(as_uuid=False), nullable=False)
+    user_email = Column(String, nullable=False)
+    role = Column(String)
+    message = Column(Text)
+    created_at = Column(DateTime, default=func.now())
+
+    __table_args__ = (
+        Index(
+            "ix_message_search_user_email_conversation_id",
+            user_email,
+            conversation_id,
+        ),
+        Index(
+            "ix_message_search_document",
+            search_document(message),
+            postgresql_using="gin",
+            info={"dialects": ("postgresql",)},
+        ).ddl_if(dialect="postgresql"),
+    )
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "conversation_id": self.conversation_id,
+            "role": self.role,
+            "message": self.message,
+            "created_at": self.created_at,
+        }
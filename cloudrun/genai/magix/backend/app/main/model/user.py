@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from sqlalchemy import Column, String, Boolean, UUID, DateTime, func
+from sqlalchemy import Column, String, Boolean, UUID, DateTime, Index, func
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -28,9 +28,11 @@ class UserSQL(Base):
     email = Column(String)
     username = Column(String, unique=True, primary_key=True)
     is_admin = Column(Boolean, default=False)
-    tenant_id = Column(UUID)
+    tenant_id = Column(UUID(as_uuid=False))
     created_at = Column(DateTime, default=func.now())
 
+    __table_args__ = (Index("uq_user_email", email, unique=True),)
+
     def __init__(self, email, username, tenant_id):
         self.email = email
         self.username = username
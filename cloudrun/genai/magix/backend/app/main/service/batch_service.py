@@ -0,0 +1,359 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import uuid
+import logging
+import threading
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+from app.main.model.apiresponse import ApiResponse
+from app.main.service.llm_service import get_llm
+from app.main.service.message_service import get_llm_model
+from app.main.util import codec
+from app.main.util.tracing import run_in_current_context
+from app.main.util.utils import get_blob_from_gcs, write_blob_to_gcs
+
+# Prompts generated concurrently across all batch jobs of this instance.
+BATCH_MAX_WORKERS = int(os.environ.get("BATCH_MAX_WORKERS", 4))
+# Results written to storage per checkpoint.
+BATCH_CHECKPOINT_EVERY = int(os.environ.get("BATCH_CHECKPOINT_EVERY", 25))
+# Requests per second per provider, e.g. "google=5,mistralai=2".
+BATCH_RATE_LIMITS = dict(
+    (provider.strip(), float(rate))
+    for provider, rate in (
+        item.split("=")
+        for item in os.environ.get("BATCH_RATE_LIMITS", "").split(",")
+        if item
+    )
+)
+BATCH_DEFAULT_RATE_LIMIT = float(os.environ.get("BATCH_DEFAULT_RATE_LIMIT", 2))
+
+_executor = ThreadPoolExecutor(
+    max_workers=BATCH_MAX_WORKERS, thread_name_prefix="batch"
+)
+_jobs = {}
+_jobs_lock = threading.Lock()
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Spaces out calls to a provider to a fixed rate
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+def get_rate_limiter(provider):
+    with _rate_limiters_lock:
+        if provider not in _rate_limiters:
+            rate = BATCH_RATE_LIMITS.get(provider, BATCH_DEFAULT_RATE_LIMIT)
+            _rate_limiters[provider] = RateLimiter(rate)
+        return _rate_limiters[provider]
+
+
+class BatchJob:
+    """
+    Batch of prompts generated with one LLM
+    """
+
+    def __init__(self, job_id, user_email, llm, llm_params, prompts):
+        self.id = job_id
+        self.user_email = user_email
+        self.llm = llm
+        self.llm_params = llm_params
+        self.prompts = prompts
+        # prompts with a result, and those whose result is durably stored
+        self.succeeded = set()
+        self.completed = set()
+        self.failed = set()
+        self.parts = 0
+        self.pending_results = []
+        self.status = "running"
+        self.started_at = time.time()
+        self.completed_at_start = 0
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+
+    def blob_name(self, name):
+        return f"{self.user_email}/batches/{self.id}/{name}"
+
+    def remaining(self):
+        return [
+            index for index in range(len(self.prompts)) if index not in self.completed
+        ]
+
+    def to_checkpoint(self):
+        return {
+            "id": self.id,
+            "user_email": self.user_email,
+            "llm": self.llm,
+            "llm_params": self.llm_params,
+            "total": len(self.prompts),
+            "completed": sorted(self.completed),
+            "failed": sorted(self.failed),
+            "parts": self.parts,
+            "status": self.status,
+        }
+
+    def to_dict(self):
+        with self.lock:
+            total = len(self.prompts)
+            completed = len(self.succeeded)
+            failed = len(self.failed - self.succeeded)
+            elapsed = time.time() - self.started_at
+            # throughput of this run, resumed jobs start from their checkpoint
+            throughput = (completed - self.completed_at_start) / elapsed if elapsed else 0
+            remaining = total - completed
+            return {
+                "id": self.id,
+                "llm_name": self.llm["name"],
+                "status": self.status,
+                "total": total,
+                "completed": completed,
+                "failed": failed,
+                "elapsed_seconds": round(elapsed, 3),
+                "throughput_per_second": round(throughput, 3),
+                "eta_seconds": round(remaining / throughput, 1)
+                if throughput and self.status == "running"
+                else None,
+                "result_parts": [
+                    self.blob_name(f"results-{part:05d}.ndjson")
+                    for part in range(1, self.parts + 1)
+                ],
+            }
+
+    def checkpoint(self, final=False):
+        """Writes pending results as a new NDJSON part, then the checkpoint.
+
+        Results are written before the checkpoint that marks them completed,
+        so a crash can only cause prompts to be generated again, not lost.
+        Results that could not be written are kept pending for the next
+        checkpoint, and a final checkpoint then fails the job, to be resumed.
+        Returns:
+            True if the checkpoint was written.
+        """
+        with self.checkpoint_lock:
+            with self.lock:
+                results = self.pending_results
+                self.pending_results = []
+                if final:
+                    self.status = "failed" if self.failed - self.succeeded else "done"
+            if results:
+                part = self.parts + 1
+                payload = b"".join(codec.dumps(result) + b"\n" for result in results)
+                written = write_blob_to_gcs(
+                    self.blob_name(f"results-{part:05d}.ndjson"),
+                    payload,
+                    content_type="application/x-ndjson",
+                )
+                with self.lock:
+                    if not written:
+                        self.pending_results = results + self.pending_results
+                        if not final:
+                            return False
+                        self.status = "failed"
+                    else:
+                        self.parts = part
+                        self.completed.update(
+                            result["index"] for result in results if "error" not in result
+                        )
+            with self.lock:
+                checkpoint = self.to_checkpoint()
+            return write_blob_to_gcs(
+                self.blob_name("checkpoint.json"), codec.dumps(checkpoint)
+            )
+
+    def record(self, result):
+        with self.lock:
+            self.pending_results.append(result)
+            if "error" in result:
+                self.failed.add(result["index"])
+            else:
+                self.succeeded.add(result["index"])
+            flush = len(self.pending_results) >= BATCH_CHECKPOINT_EVERY
+        if flush:
+            self.checkpoint()
+
+
+def _generate(job, index):
+    prompt = job.prompts[index]
+    started = time.monotonic()
+    result = {"index": index, "id": prompt.get("id"), "llm_name": job.llm["name"]}
+    try:
+        get_rate_limiter(job.llm["provider"]).acquire()
+        llm_model = get_llm_model(job.llm["name"])
+        response = "".join(
+            chunk["data"][0]["message"]
+            for chunk in llm_model.generate_response(
+                [], prompt["prompt"], job.llm_params, False
+            )
+        )
+        result["response"] = response
+    except Exception as e:
+        logging.error(f"Error in batch {job.id} prompt {index} - {e}")
+        result["error"] = {"type": type(e).__name__, "message": str(e)}
+    result["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+    job.record(result)
+
+
+def _run(job):
+    generate = run_in_current_context(_generate)
+    futures = [_executor.submit(generate, job, index) for index in job.remaining()]
+    for future in futures:
+        future.result()
+    job.checkpoint(final=True)
+    logging.info(f"Batch {job.id} finished with status {job.status}")
+
+
+def _start(job):
+    with _jobs_lock:
+        _jobs[job.id] = job
+    threading.Thread(
+        target=run_in_current_context(_run), args=(job,), daemon=True
+    ).start()
+    return job.to_dict()
+
+
+def parse_prompts(payload):
+    """Parses a prompts file.
+    Args:
+        payload: NDJSON bytes, one {"prompt": ..., "id": optional} object per line.
+    Returns:
+        List of prompt dictionaries.
+    Raises:
+        ValueError when a line is not a prompt object.
+    """
+    prompts = []
+    for number, line in enumerate(payload.splitlines(), start=1):
+        if not line.strip():
+            continue
+        prompt = codec.loads(line)
+        if not isinstance(prompt, dict) or not isinstance(prompt.get("prompt"), str):
+            raise ValueError(f"Line {number} is not a prompt object")
+        prompts.append(prompt)
+    return prompts
+
+
+def create_batch_job(user_email, llm_name, prompts, llm_params=None):
+    """Creates and starts a batch job.
+    Args:
+        user_email: User email
+        llm_name: Name of the llm row used for every prompt
+        prompts: List of prompt dictionaries, see parse_prompts
+        llm_params: LLM parameters, defaults to the params of the llm row
+    Returns:
+        Status of the job.
+    """
+    llm = get_llm(llm_name)
+    if not llm or not llm["is_active"]:
+        response = ApiResponse(
+            HTTPStatus.BAD_REQUEST, message=f"LLM {llm_name} is not available"
+        )
+        return response.to_response()
+
+    job = BatchJob(
+        str(uuid.uuid4()), user_email, llm, llm_params or llm["params"] or {}, prompts
+    )
+    # a job is only started once it can be resumed
+    stored = (
+        write_blob_to_gcs(job.blob_name("prompts.json"), codec.dumps(prompts))
+        and job.checkpoint()
+    )
+    if not stored:
+        response = ApiResponse(
+            HTTPStatus.SERVICE_UNAVAILABLE, message="Batch job could not be stored"
+        )
+        return response.to_response()
+    return _start(job)
+
+
+def resume_batch_job(user_email, job_id):
+    """Resumes an interrupted batch job from its last checkpoint.
+    Args:
+        user_email: User email
+        job_id: Batch job id
+    Returns:
+        Status of the job.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job and job.user_email == user_email and job.status == "running":
+        return job.to_dict()
+
+    checkpoint = get_blob_from_gcs(f"{user_email}/batches/{job_id}/checkpoint.json")
+    prompts = get_blob_from_gcs(f"{user_email}/batches/{job_id}/prompts.json")
+    if checkpoint is None or prompts is None:
+        response = ApiResponse(HTTPStatus.NOT_FOUND, message="Batch job not found")
+        return response.to_response()
+
+    checkpoint = codec.loads(checkpoint)
+    job = BatchJob(
+        job_id,
+        user_email,
+        checkpoint["llm"],
+        checkpoint["llm_params"],
+        codec.loads(prompts),
+    )
+    job.completed = set(checkpoint["completed"])
+    job.succeeded = set(job.completed)
+    job.completed_at_start = len(job.completed)
+    job.parts = checkpoint["parts"]
+    return _start(job)
+
+
+def get_batch_job_status(user_email, job_id):
+    """Returns progress, throughput and ETA of a batch job.
+    Args:
+        user_email: User email
+        job_id: Batch job id
+    Returns:
+        Status of the job.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+    if job and job.user_email == user_email:
+        return job.to_dict()
+
+    # the job runs, or ran, on another instance
+    checkpoint = get_blob_from_gcs(f"{user_email}/batches/{job_id}/checkpoint.json")
+    if checkpoint is None:
+        response = ApiResponse(HTTPStatus.NOT_FOUND, message="Batch job not found")
+        return response.to_response()
+    checkpoint = codec.loads(checkpoint)
+    return {
+        "id": checkpoint["id"],
+        "llm_name": checkpoint["llm"]["name"],
+        "status": checkpoint["status"],
+        "total": checkpoint["total"],
+        "completed": len(checkpoint["completed"]),
+        "failed": len(set(checkpoint["failed"]) - set(checkpoint["completed"])),
+        "result_parts": [
+            f"{user_email}/batches/{job_id}/results-{part:05d}.ndjson"
+            for part in range(1, checkpoint["parts"] + 1)
+        ],
+    }
@@ -12,21 +12,57 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import time
 import uuid
-import copy
 import logging
+import threading
 import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy.orm import Session
 from http import HTTPStatus
 from app.main.model.conversation import ConversationSQL
 from app.main.util.utils import get_file_from_gcs, write_file_to_gcs
-from db.config import connect_with_connector
+from db.config import get_engine, get_read_engine, record_write
 from app.main.model.apiresponse import ApiResponse
+from app.main.service.purge_service import wake_purger
+from app.main.util.cache import TTLCache
+from app.main.util.pagination import decode_cursor, encode_cursor
+from app.main.util.tracing import run_in_current_context, traced
 
-from sqlalchemy import desc
+from sqlalchemy import and_, desc, or_
+
+# Settings of a conversation kept in memory. Changes made on another instance
+# are seen after at most the TTL.
+SETTINGS_CACHE_SIZE = int(os.environ.get("SETTINGS_CACHE_SIZE", 10000))
+SETTINGS_CACHE_TTL_SECONDS = float(os.environ.get("SETTINGS_CACHE_TTL_SECONDS", 30))
+SETTINGS_FIELDS = ("title", "llm_name", "llm_params")
+# Attempts to write llm-settings.json before giving up.
+SETTINGS_RECONCILE_ATTEMPTS = 5
+# Settings read of a deleted conversation, until it is purged.
+DELETED = object()
+
+_settings_cache = TTLCache(SETTINGS_CACHE_SIZE, SETTINGS_CACHE_TTL_SECONDS)
+_pending_settings = {}
+_reconciling = set()
+_reconcile_condition = threading.Condition()
+_reconciler = None
+
+# Conversations per page of GET /conversations?cursor=, by default and at most.
+CONVERSATIONS_PAGE_SIZE = 20
+MAX_CONVERSATIONS_PAGE_SIZE = 100
+# Conversations of one POST /conversations/batch at most.
+MAX_BATCH_CONVERSATIONS = int(os.environ.get("MAX_BATCH_CONVERSATIONS", 100))
+# Concurrent storage reads of batch fetches, across all requests.
+STORAGE_READ_WORKERS = int(os.environ.get("STORAGE_READ_WORKERS", 8))
+# Characters of the last message returned as preview.
+PREVIEW_LENGTH = 200
+
+_storage_executor = ThreadPoolExecutor(
+    max_workers=STORAGE_READ_WORKERS, thread_name_prefix="storage-read"
+)
 
 # cursor = connect_to_db()
-engine = connect_with_connector()
 
 
 def create_conversation_id():
@@ -40,6 +76,7 @@ def create_conversation_id():
     return new_id
 
 
+@traced("sql.create_conversation")
 def create_conversation(conversation_id, user_email, title, llm_name, llm_params):
     """Creates a new conversation object.
     Args:
@@ -59,10 +96,11 @@ def create_conversation(conversation_id, user_email, title, llm_name, llm_params
             llm_name=llm_name,
             llm_params=llm_params,
         )
-        session = Session(engine, expire_on_commit=False)
+        session = Session(get_engine(), expire_on_commit=False)
         session.add(conversation)
         session.commit()
         session.close()
+        record_write(user_email, conversation_id)
         logging.info(f"Conversation created: {conversation}")
 
         return conversation.to_dict()
@@ -76,6 +114,7 @@ def create_conversation(conversation_id, user_email, title, llm_name, llm_params
         )
         return response.to_response()
     
+@traced("sql.update_conversation_title")
 def update_conversation_title(conversation_id, title):
     """Creates a new conversation object.
     Args:
@@ -85,12 +124,13 @@ def update_conversation_title(conversation_id, title):
         Updated conversation object.
     """
     try:
-        session = Session(engine, expire_on_commit=False)
+        session = Session(get_engine(), expire_on_commit=False)
         conversation = session.query(ConversationSQL).filter_by(id=conversation_id).first()
 
         if conversation:
             conversation.title = title 
             session.commit()
+            record_write(conversation_id, conversation.user_email)
             logging.info("Title updated successfully!")
         else:
             logging.info("Conversation not found.")
@@ -109,6 +149,7 @@ def update_conversation_title(conversation_id, title):
         return response.to_response()
 
 
+@traced("sql.get_conversation")
 def get_conversation(conversation_id):
     """Returns a conversation.
     Args:
@@ -117,12 +158,18 @@ def get_conversation(conversation_id):
         A conversation object.
     """
     try:
-        with Session(engine, expire_on_commit=False) as session:
+        with Session(get_read_engine(conversation_id), expire_on_commit=False) as session:
             conversation = (
                 session.query(ConversationSQL)
-                .filter(ConversationSQL.id == conversation_id)
+                .filter(
+                    ConversationSQL.id == conversation_id,
+                    ConversationSQL.deleted_at.is_(None),
+                )
                 .first()
             )
+        if conversation is None:
+            response = ApiResponse(HTTPStatus.NOT_FOUND, message="Conversation not found")
+            return response.to_response()
         return conversation.to_dict()
 
     except sqlalchemy.exc.OperationalError as e:
@@ -135,19 +182,61 @@ def get_conversation(conversation_id):
         return response.to_response()
 
 
+def _settings_of(conversation):
+    return conversation.to_dict()
+
+
+@traced("sql.get_conversation_settings")
+def _read_conversation_settings(conversation_id):
+    with Session(get_read_engine(conversation_id), expire_on_commit=False) as session:
+        conversation = (
+            session.query(ConversationSQL)
+            .filter(ConversationSQL.id == conversation_id)
+            .first()
+        )
+    if conversation is None:
+        return None
+    # not None, so that the llm-settings.json waiting to be purged is not read
+    return DELETED if conversation.deleted_at else _settings_of(conversation)
+
+
+@traced("sql.is_conversation_deleted")
+def is_conversation_deleted(conversation_id):
+    """Returns whether a conversation was deleted, and waits to be purged."""
+    table = ConversationSQL.__table__
+    with get_read_engine(conversation_id).connect() as connection:
+        deleted_at = connection.execute(
+            sqlalchemy.select(table.c.deleted_at).where(table.c.id == conversation_id)
+        ).scalar()
+    return deleted_at is not None
+
+
 # TODO: How to get user_email for this method? Fixing for now
 def get_conversation_settings(conversation_id):
     """Returns LLM settings for a conversation id.
+
+    Settings are read from the conversation row through a cache, and from
+    llm-settings.json for conversations without a row.
     Args:
         id: Conversation Id
     Returns:
-        Returns a dictionary containing llm settings.
+        Returns a dictionary containing llm settings, not to be modified.
     """
+    settings = _settings_cache.get(conversation_id)
+    if settings is not None:
+        return settings
     try:
-        llm_settings = get_file_from_gcs(
-            conversation_id=conversation_id, file_name="llm-settings"
-        )
-        return llm_settings
+        settings = _read_conversation_settings(conversation_id)
+        if settings is DELETED:
+            response = ApiResponse(HTTPStatus.NOT_FOUND, message="Conversation not found")
+            return response.to_response()
+        if settings is None:
+            logging.info(f"No conversation row, reading GCS settings - {conversation_id}")
+            return get_file_from_gcs(
+                conversation_id=conversation_id, file_name="llm-settings"
+            )
+        _settings_cache.set(conversation_id, settings)
+        return settings
     except Exception as e:
         response = ApiResponse(
             data={"error": {"type": type(e).__name__, "message": str(e)}},
@@ -157,18 +246,48 @@ def get_conversation_settings(conversation_id):
         return response.to_response()
 
 
+@traced("sql.update_conversation_settings")
 def update_conversation_settings(conversation_id, data):
+    """Updates LLM settings of a conversation.
+
+    The conversation row is updated and cached, llm-settings.json is written
+    in the background. Conversations without a row are created.
+    Args:
+        conversation_id: Conversation Id
+        data: Settings to change, among title, llm_name and llm_params.
+    Returns:
+        Returns a dictionary containing the updated llm settings.
+    """
     try:
-        llm_settings = get_file_from_gcs(
-            conversation_id=conversation_id, file_name="llm-settings"
-        )
-        if llm_settings == {}:
-            return post_conversation_settings(
-                conversation_id,
-                llm_name=data.get("llm_name"),
-                llm_params=data.get("llm_params"),
+        with Session(get_engine(), expire_on_commit=False) as session:
+            conversation = (
+                session.query(ConversationSQL)
+                .filter(ConversationSQL.id == conversation_id)
+                .first()
             )
-        return update_conversation_settings_gcs(llm_settings, data)
+            if conversation is None:
+                return post_conversation_settings(
+                    conversation_id,
+                    llm_name=data.get("llm_name"),
+                    llm_params=data.get("llm_params"),
+                )
+            if conversation.deleted_at is not None:
+                response = ApiResponse(
+                    HTTPStatus.NOT_FOUND, message="Conversation not found"
+                )
+                return response.to_response()
+            for key, value in data.items():
+                if key in SETTINGS_FIELDS:
+                    setattr(conversation, key, value)
+                else:
+                    logging.warning(f"Ignoring unknown setting {key} - {conversation_id}")
+            session.commit()
+        record_write(conversation_id, conversation.user_email)
+        settings = _settings_of(conversation)
+        logging.info(f"Updated settings - {settings}")
+        _settings_cache.set(conversation_id, settings)
+        reconcile_settings(conversation_id, settings)
+        return settings
     except Exception as e:
         logging.error(f"Error while updating llm settings - {e}")
         response = ApiResponse(
@@ -178,26 +297,6 @@ def update_conversation_settings(conversation_id, data):
         return response.to_response()
 
 
-def update_conversation_settings_gcs(current_settings, updated_settings):
-    """Updates LLM settings for a conversation in GCS bucket
-    Args:
-        current_settings: Current llm settings retrived from GCS bucket.
-        updated_settings: Updated llm settings based on PATCH request.
-    Returns:
-        Returns a dictionary containing llm settings.
-    """
-    new_settings = copy.deepcopy(current_settings)
-    for key, value in updated_settings.items():
-        new_settings[key] = value
-    logging.info("Updated settings - ", new_settings)
-    response = write_file_to_gcs(
-        conversation_id=current_settings["id"],
-        data=new_settings,
-        file_name="llm-settings",
-    )
-    return response
-
-
 def post_conversation_settings(
     conversation_id,
     user_email="user@example.com",
@@ -216,21 +315,74 @@ def post_conversation_settings(
         llm_name: LLM name
         llm_params: LLM parameters
     Returns:
-        Response of llm-settings file creation in GCS.
+        The llm settings of the conversation, llm-settings.json is written in
+        the background.
     """
     try:
         conversation = create_conversation(
             conversation_id, user_email, title, llm_name, llm_params
         )
-        response = write_file_to_gcs(
-            conversation_id=conversation_id, data=conversation, file_name="llm-settings"
-        )
-        return response
+        if not isinstance(conversation, dict):
+            return conversation
+        _settings_cache.set(conversation_id, conversation)
+        reconcile_settings(conversation_id, conversation)
+        return conversation
     except Exception as e:
         logging.error(f"An error occurred while posting the conversation settings: {e}")
         return {"error": "Error in post conversation settings"}, 400
 
 
+def reconcile_settings(conversation_id, settings):
+    """Queues the write of llm-settings.json, kept for compatibility. Writes
+    queued for the same conversation are coalesced to the latest settings."""
+    global _reconciler
+    with _reconcile_condition:
+        _pending_settings[conversation_id] = (settings, 0)
+        if _reconciler is None:
+            _reconciler = threading.Thread(
+                target=_reconcile_loop, name="settings-reconciler", daemon=True
+            )
+            _reconciler.start()
+        _reconcile_condition.notify_all()
+
+
+def _reconcile_loop():
+    while True:
+        with _reconcile_condition:
+            while not _pending_settings:
+                _reconcile_condition.notify_all()
+                _reconcile_condition.wait()
+            conversation_id = next(iter(_pending_settings))
+            settings, attempts = _pending_settings.pop(conversation_id)
+            _reconciling.add(conversation_id)
+        try:
+            _, status = write_file_to_gcs(
+                conversation_id=conversation_id, data=settings, file_name="llm-settings"
+            )
+        except Exception as e:
+            logging.error(f"Error writing GCS settings - {conversation_id} - {e}")
+            status = None
+        with _reconcile_condition:
+            _reconciling.discard(conversation_id)
+            if status != 200 and attempts + 1 < SETTINGS_RECONCILE_ATTEMPTS:
+                # newer settings queued meanwhile win over the failed ones
+                _pending_settings.setdefault(conversation_id, (settings, attempts + 1))
+        if status != 200:
+            time.sleep(min(2**attempts, 30))
+
+
+def flush_settings_reconciler(timeout=None):
+    """Waits until the queued llm-settings.json writes are done.
+    Returns:
+        True if they are, False on timeout.
+    """
+    with _reconcile_condition:
+        return _reconcile_condition.wait_for(
+            lambda: not _pending_settings and not _reconciling, timeout
+        )
+
+
+@traced("sql.get_user_conversations")
 def get_user_conversations(user_email, offset, limit):
     """Returns all conversations for a specific user email.
     Args:
@@ -239,11 +391,14 @@ def get_user_conversations(user_email, offset, limit):
         A list of conversations for the given user.
     """
     try:
-        with Session(engine, expire_on_commit=False) as session:
+        with Session(get_read_engine(user_email), expire_on_commit=False) as session:
             conversations = (
                 session.query(ConversationSQL)
-                .filter(ConversationSQL.user_email == user_email)
-                .order_by(desc(ConversationSQL.created_at))
+                .filter(
+                    ConversationSQL.user_email == user_email,
+                    ConversationSQL.deleted_at.is_(None),
+                )
+                .order_by(desc(ConversationSQL.last_message_at), ConversationSQL.id)
                 .offset(offset)
                 .limit(limit)
                 .all()
@@ -259,3 +414,269 @@ def get_user_conversations(user_email, offset, limit):
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
         return response.to_response()
+
+
+@traced("sql.get_user_conversations_page")
+def get_user_conversations_page(user_email, limit, cursor=None):
+    """Returns a page of the conversations of a user, most recently active first.
+
+    Pages are read by keyset on (last_message_at, id), so reading a page costs
+    the same at any depth and conversations created meanwhile do not shift
+    pages; a conversation active meanwhile moves to the first page.
+    Args:
+        user_email: User email
+        limit: Maximum number of conversations of the page
+        cursor: next_cursor of the previous page, None for the first page
+    Returns:
+        Dictionary of the conversations and the next_cursor, None on the last page.
+    """
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        response = ApiResponse(
+            data={"error": {"type": type(e).__name__, "message": str(e)}},
+            message="Invalid cursor",
+            status_code=HTTPStatus.BAD_REQUEST,
+        )
+        return response.to_response()
+
+    try:
+        with Session(get_read_engine(user_email), expire_on_commit=False) as session:
+            query = session.query(ConversationSQL).filter(
+                ConversationSQL.user_email == user_email,
+                ConversationSQL.deleted_at.is_(None),
+            )
+            if after:
+                last_message_at, conversation_id = after
+                query = query.filter(
+                    ConversationSQL.last_message_at <= last_message_at,
+                    or_(
+                        ConversationSQL.last_message_at < last_message_at,
+                        and_(
+                            ConversationSQL.last_message_at == last_message_at,
+                            ConversationSQL.id > conversation_id,
+                        ),
+                    ),
+                )
+            # one more row tells whether there is a next page
+            rows = (
+                query.order_by(desc(ConversationSQL.last_message_at), ConversationSQL.id)
+                .limit(limit + 1)
+                .all()
+            )
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1].last_message_at, rows[-1].id)
+        return {
+            "conversations": [row.to_dict() for row in rows],
+            "next_cursor": next_cursor,
+        }
+
+    except sqlalchemy.exc.OperationalError as e:
+        logging.error(f"Error getting user conversations: {e}")
+        response = ApiResponse(
+            data={"error": {"type": type(e).__name__, "message": str(e)}},
+            message="Database error occurred",
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+        return response.to_response()
+
+
+@traced("sql.update_conversation_summary")
+def update_conversation_summary(conversation_id, messages):
+    """Updates the message summary of a conversation row after a turn was
+    persisted, with one statement. Failures are logged, the summary catches
+    up at the next turn.
+    Args:
+        conversation_id: Conversation Id
+        messages: All messages of the conversation, as persisted.
+    """
+    if not messages:
+        return
+    table = ConversationSQL.__table__
+    summary = {
+        # the whole conversation is persisted, so the count corrects itself,
+        # e.g. for conversations older than the summary
+        "message_count": len(messages),
+        "last_message_preview": (messages[-1].get("message") or "")[:PREVIEW_LENGTH],
+    }
+    try:
+        with get_engine().begin() as connection:
+            row = connection.execute(
+                table.update()
+                .where(table.c.id == conversation_id, table.c.deleted_at.is_(None))
+                .values(last_message_at=sqlalchemy.func.now(), **summary)
+                .returning(table.c.user_email, table.c.last_message_at)
+            ).first()
+        if row is None:
+            return
+        record_write(conversation_id, row.user_email)
+        settings = _settings_cache.get(conversation_id)
+        if settings is not None:
+            _settings_cache.set(
+                conversation_id,
+                dict(settings, last_message_at=row.last_message_at, **summary),
+            )
+    except Exception as e:
+        logging.error(f"Error updating summary of {conversation_id} - {e}")
+
+
+def _message_preview(conversation_id):
+    messages = get_file_from_gcs(conversation_id=conversation_id, file_name="message")
+    if not isinstance(messages, list) or not messages:
+        return None
+    last_message = messages[-1]
+    return {
+        "role": last_message.get("role"),
+        "message": (last_message.get("message") or "")[:PREVIEW_LENGTH],
+    }
+
+
+def _row_preview(conversation):
+    if not conversation.get("message_count"):
+        return None
+    # turns are persisted once answered, so the last message is an answer
+    return {"role": "system", "message": conversation.get("last_message_preview") or ""}
+
+
+@traced("sql.get_conversations_batch")
+def _read_conversations(conversation_ids, user_email):
+    with Session(
+        get_read_engine(user_email, *conversation_ids), expire_on_commit=False
+    ) as session:
+        rows = (
+            session.query(ConversationSQL)
+            .filter(
+                ConversationSQL.id.in_(conversation_ids),
+                ConversationSQL.user_email == user_email,
+            )
+            .all()
+        )
+    # deleted conversations are missing, without reading their storage settings
+    return {row.id: None if row.deleted_at else row.to_dict() for row in rows}
+
+
+def get_conversations_batch(conversation_ids, user_email, include_preview=False):
+    """Returns several conversations of a user at once.
+
+    Rows are read with one query, and carry the preview of the last message.
+    Settings and previews of conversations without a row are read from storage
+    concurrently, on a pool of STORAGE_READ_WORKERS threads shared by all
+    requests.
+    Args:
+        conversation_ids: Conversation ids, at most MAX_BATCH_CONVERSATIONS
+        user_email: User email, conversations of other users are not returned
+        include_preview: Whether to add the last message of each conversation
+    Returns:
+        Dictionary of the conversations, in the order of conversation_ids and
+        with their settings, and the ids of the missing ones.
+    """
+    conversation_ids = list(dict.fromkeys(conversation_ids))
+    try:
+        conversations = _read_conversations(conversation_ids, user_email)
+    except sqlalchemy.exc.OperationalError as e:
+        logging.error(f"Error getting conversations: {e}")
+        response = ApiResponse(
+            data={"error": {"type": type(e).__name__, "message": str(e)}},
+            message="Database error occurred",
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+        return response.to_response()
+    rows = set(conversations)
+    for conversation_id, conversation in conversations.items():
+        if conversation is not None:
+            _settings_cache.set(conversation_id, conversation)
+
+    read_settings = run_in_current_context(
+        lambda conversation_id: get_file_from_gcs(
+            conversation_id=conversation_id, file_name="llm-settings"
+        )
+    )
+    settings_reads = {
+        conversation_id: _storage_executor.submit(read_settings, conversation_id)
+        for conversation_id in conversation_ids
+        if conversation_id not in conversations
+    }
+    for conversation_id, settings_read in settings_reads.items():
+        settings = settings_read.result()
+        # conversations without a row are only known to llm-settings.json
+        if isinstance(settings, dict) and settings.get("user_email") == user_email:
+            conversations[conversation_id] = settings
+
+    preview_reads = {}
+    if include_preview:
+        # only conversations of the user without a row, None when not found
+        read_preview = run_in_current_context(_message_preview)
+        preview_reads = {
+            conversation_id: _storage_executor.submit(read_preview, conversation_id)
+            for conversation_id, conversation in conversations.items()
+            if conversation is not None and conversation_id not in rows
+        }
+    results = []
+    missing = []
+    for conversation_id in conversation_ids:
+        conversation = conversations.get(conversation_id)
+        if conversation is None:
+            missing.append(conversation_id)
+            continue
+        if include_preview:
+            preview_read = preview_reads.get(conversation_id)
+            conversation = dict(
+                conversation,
+                preview=(
+                    preview_read.result() if preview_read else _row_preview(conversation)
+                ),
+            )
+        results.append(conversation)
+    return {"conversations": results, "missing": missing}
+
+
+@traced("sql.delete_conversations")
+def delete_conversations(user_email, conversation_ids):
+    """Deletes conversations of a user.
+
+    The conversations are marked deleted with one statement and disappear
+    from the conversation list at once; the purger removes their files and
+    rows in the background.
+    Args:
+        user_email: User email, conversations of other users are not deleted
+        conversation_ids: Conversation ids
+    Returns:
+        Dictionary of the ids of the deleted conversations, and of the missing
+        or already deleted ones.
+    """
+    conversation_ids = list(dict.fromkeys(conversation_ids))
+    table = ConversationSQL.__table__
+    try:
+        with get_engine().begin() as connection:
+            deleted = set(
+                connection.execute(
+                    table.update()
+                    .where(
+                        table.c.user_email == user_email,
+                        table.c.id.in_(conversation_ids),
+                        table.c.deleted_at.is_(None),
+                    )
+                    .values(deleted_at=sqlalchemy.func.now())
+                    .returning(table.c.id)
+                ).scalars()
+            )
+    except sqlalchemy.exc.OperationalError as e:
+        logging.error(f"Error deleting conversations: {e}")
+        response = ApiResponse(
+            data={"error": {"type": type(e).__name__, "message": str(e)}},
+            message="Database error occurred",
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+        return response.to_response()
+    for conversation_id in deleted:
+        _settings_cache.pop(conversation_id)
+    record_write(user_email, *deleted)
+    if deleted:
+        logging.info(f"Deleted {len(deleted)} conversations of {user_email}")
+        wake_purger()
+    return {
+        "deleted": [id for id in conversation_ids if id in deleted],
+        "missing": [id for id in conversation_ids if id not in deleted],
+    }
@@ -0,0 +1,319 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import uuid
+import queue
+import logging
+import threading
+from collections import deque
+from app.main.util.streaming import END_OF_STREAM
+from app.main.util.tracing import run_in_current_context
+from app.main.util.utils import (
+    GCS_BATCH_SIZE,
+    delete_blobs_in_gcs,
+    get_file_from_gcs,
+    write_file_to_gcs,
+)
+from app.main.service.purge_service import CONVERSATION_PREFIX
+
+# Number of chunks kept in memory for every generation.
+GENERATION_BUFFER_SIZE = int(os.environ.get("GENERATION_BUFFER_SIZE", 512))
+# How long a finished generation can still be replayed.
+GENERATION_RETENTION_SECONDS = float(
+    os.environ.get("GENERATION_RETENTION_SECONDS", 300)
+)
+# Spill chunks evicted from the ring buffer to GCS so old offsets stay readable.
+GENERATION_SPILL_TO_GCS = os.environ.get("GENERATION_SPILL_TO_GCS", "") != ""
+# How long a generation without connected clients waits for a reconnect
+# before the upstream LLM call is cancelled.
+GENERATION_RESUME_GRACE_SECONDS = float(
+    os.environ.get("GENERATION_RESUME_GRACE_SECONDS", 10)
+)
+
+_generations = {}
+_generations_lock = threading.Lock()
+
+
+class GenerationExpired(Exception):
+    """Raised when a requested offset is no longer buffered."""
+
+
+class Generation:
+    """
+    Chunks of one LLM response, buffered so that clients can reconnect
+    """
+
+    def __init__(self, conversation_id, buffer_size=GENERATION_BUFFER_SIZE,
+                 spill=GENERATION_SPILL_TO_GCS, cancel_event=None):
+        self.id = str(uuid.uuid4())
+        self.conversation_id = conversation_id
+        self.cancel_event = cancel_event or threading.Event()
+        self.readers = 0
+        self.buffer_size = buffer_size
+        self.spill = spill
+        self.events = deque(maxlen=buffer_size)
+        self.next_sequence = 0
+        self.evicted = 0
+        # Evicted chunks that are not yet written to GCS, by block index.
+        self.spill_blocks = {}
+        # Indexes of the blocks written to GCS, deleted with the generation.
+        self.spilled = []
+        self.finished_at = None
+        self.condition = threading.Condition()
+
+    @property
+    def done(self):
+        return self.finished_at is not None
+
+    def append(self, message):
+        """Buffers a chunk and wakes up readers.
+        Args:
+            message: Message dictionary streamed to the client.
+        """
+        block_to_flush = None
+        with self.condition:
+            if len(self.events) == self.buffer_size and self.spill:
+                block_index = self.evicted // self.buffer_size
+                self.spill_blocks.setdefault(block_index, []).append(self.events[0])
+                self.evicted += 1
+                if self.evicted % self.buffer_size == 0:
+                    block_to_flush = block_index
+            self.events.append((self.next_sequence, message))
+            self.next_sequence += 1
+            self.condition.notify_all()
+
+        if block_to_flush is not None:
+            self._flush_block(block_to_flush)
+
+    def finish(self):
+        with self.condition:
+            self.finished_at = time.monotonic()
+            self.condition.notify_all()
+
+    def _block_file_name(self, block_index):
+        return f"generation-{self.id}-{block_index}"
+
+    def _flush_block(self, block_index):
+        with self.condition:
+            block = self.spill_blocks[block_index]
+        _, status_code = write_file_to_gcs(
+            conversation_id=self.conversation_id,
+            data=[message for _, message in block],
+            file_name=self._block_file_name(block_index),
+        )
+        if status_code != 200:
+            # the block stays readable from memory
+            logging.warning(f"Block {block_index} of generation {self.id} kept in memory")
+            return
+        with self.condition:
+            del self.spill_blocks[block_index]
+            self.spilled.append(block_index)
+
+    def spilled_blob_names(self):
+        """Returns the names of the blocks written to GCS."""
+        prefix = CONVERSATION_PREFIX.format(conversation_id=self.conversation_id)
+        with self.condition:
+            return [
+                f"{prefix}{self._block_file_name(block_index)}.json"
+                for block_index in self.spilled
+            ]
+
+    def first_available(self):
+        """Returns the lowest sequence number that can still be replayed."""
+        with self.condition:
+            if self.spill:
+                return 0
+            return self.events[0][0] if self.events else self.next_sequence
+
+    def read(self, sequence, timeout=None):
+        """Returns the chunk at a sequence number, waiting for it if needed.
+        Args:
+            sequence: Sequence number of the chunk.
+            timeout: Seconds to wait for the chunk. None waits until it arrives.
+        Returns:
+            A (sequence, message) tuple or END_OF_STREAM.
+        Raises:
+            queue.Empty when the chunk did not arrive within the timeout.
+            GenerationExpired when the chunk is no longer buffered.
+        """
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: sequence < self.next_sequence or self.done, timeout
+            ):
+                raise queue.Empty
+            if sequence >= self.next_sequence:
+                return END_OF_STREAM
+
+            oldest = self.events[0][0]
+            if sequence >= oldest:
+                return self.events[sequence - oldest]
+            if not self.spill:
+                raise GenerationExpired(
+                    f"Chunk {sequence} of generation {self.id} is no longer buffered"
+                )
+            block_index = sequence // self.buffer_size
+            if block_index in self.spill_blocks:
+                return self.spill_blocks[block_index][sequence % self.buffer_size]
+
+        block = get_file_from_gcs(
+            conversation_id=self.conversation_id,
+            file_name=self._block_file_name(block_index),
+        )
+        if not isinstance(block, list):
+            raise GenerationExpired(
+                f"Chunk {sequence} of generation {self.id} could not be loaded"
+            )
+        return sequence, block[sequence % self.buffer_size]
+
+    def reader(self, offset=0):
+        """Returns a reader replaying the generation from an offset.
+        Args:
+            offset: Sequence number of the first chunk to return.
+        Returns:
+            GenerationReader object.
+        Raises:
+            GenerationExpired when the offset is no longer buffered.
+        """
+        if offset < self.first_available():
+            raise GenerationExpired(
+                f"Offset {offset} of generation {self.id} is no longer buffered"
+            )
+        with self.condition:
+            self.readers += 1
+        return GenerationReader(self, offset)
+
+    def release(self):
+        """Detaches a reader, cancelling the generation if no client
+        reconnects within GENERATION_RESUME_GRACE_SECONDS."""
+        with self.condition:
+            self.readers -= 1
+            abandoned = self.readers == 0 and not self.done
+        if abandoned:
+            timer = threading.Timer(
+                GENERATION_RESUME_GRACE_SECONDS, self._cancel_if_abandoned
+            )
+            timer.daemon = True
+            timer.start()
+
+    def _cancel_if_abandoned(self):
+        with self.condition:
+            if self.readers or self.done or self.cancel_event.is_set():
+                return
+            self.cancel_event.set()
+        logging.info(f"Generation {self.id} cancelled, client disconnected")
+
+
+class GenerationReader:
+    """
+    Cursor over a generation, polled by the streaming helpers
+    """
+
+    def __init__(self, generation, offset):
+        self.generation = generation
+        self.offset = offset
+        self.closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.generation.release()
+
+    def get(self, timeout=None):
+        item = self.generation.read(self.offset, timeout)
+        if item is not END_OF_STREAM:
+            self.offset += 1
+        return item
+
+    def __iter__(self):
+        while True:
+            item = self.get()
+            if item is END_OF_STREAM:
+                return
+            yield item
+
+
+def _produce(generation, messages):
+    try:
+        for message in messages:
+            generation.append(message)
+    except Exception as e:
+        logging.error(f"Error in generation {generation.id} - {e}")
+    finally:
+        generation.finish()
+
+
+def _delete_blobs(blob_names):
+    for start in range(0, len(blob_names), GCS_BATCH_SIZE):
+        failed = delete_blobs_in_gcs(blob_names[start:start + GCS_BATCH_SIZE])
+        if failed:
+            logging.error(f"Spilled generation blocks not deleted: {failed}")
+
+
+def _remove_expired_generations():
+    now = time.monotonic()
+    blob_names = []
+    with _generations_lock:
+        for generation_id, generation in list(_generations.items()):
+            if (
+                generation.done
+                and now - generation.finished_at > GENERATION_RETENTION_SECONDS
+            ):
+                del _generations[generation_id]
+                blob_names.extend(generation.spilled_blob_names())
+    if blob_names:
+        # off the request starting a generation
+        threading.Thread(target=_delete_blobs, args=(blob_names,), daemon=True).start()
+
+
+def start_generation(conversation_id, messages, cancel_event=None):
+    """Starts consuming an LLM response in the background.
+
+    The response is produced, and persisted, exactly once no matter how many
+    clients read or reconnect to the generation.
+
+    Args:
+        conversation_id: Conversation Id
+        messages: Generator of message dictionaries, see generate_messages.
+        cancel_event: Event observed by messages, set once every client is gone.
+    Returns:
+        Generation object.
+    """
+    _remove_expired_generations()
+    generation = Generation(conversation_id, cancel_event=cancel_event)
+    with _generations_lock:
+        _generations[generation.id] = generation
+    # spans of the generation belong to the trace of the request starting it
+    threading.Thread(
+        target=run_in_current_context(_produce),
+        args=(generation, messages),
+        daemon=True,
+    ).start()
+    return generation
+
+
+def get_generation(conversation_id, generation_id):
+    """Returns a running or recently finished generation.
+    Args:
+        conversation_id: Conversation Id
+        generation_id: Generation Id
+    Returns:
+        Generation object or None if it is unknown to this instance.
+    """
+    with _generations_lock:
+        generation = _generations.get(generation_id)
+    if generation and generation.conversation_id == conversation_id:
+        return generation
+    return None
@@ -13,16 +13,152 @@
 # limitations under the License.
 
 from http import HTTPStatus
+import os
 import json
+import time
 import logging
+import threading
 import sqlalchemy
 from sqlalchemy.orm import Session
 from app.main.model.llm import LLMTableSQL
-from db.config import connect_with_connector
+from db.config import (
+    database_configured,
+    get_engine,
+    get_read_engine,
+    record_write,
+)
 from app.main.model.apiresponse import ApiResponse
+from app.main.util.tracing import traced
 
+# The llm table is served from memory and reloaded at least this often, in case
+# a change notification from another instance was missed.
+LLM_CATALOG_TTL_SECONDS = float(os.environ.get("LLM_CATALOG_TTL_SECONDS", 300))
+# Postgres channel notified when the llm table changes, set to false to disable.
+LLM_CATALOG_LISTEN = os.environ.get("LLM_CATALOG_LISTEN", "true").lower() == "true"
+LLM_CATALOG_CHANNEL = "llm_catalog"
+# Seconds between two checks of the listening connection for notifications.
+LLM_CATALOG_POLL_SECONDS = float(os.environ.get("LLM_CATALOG_POLL_SECONDS", 1))
 
-engine = connect_with_connector()
+_catalog = None
+_catalog_loaded_at = 0
+_catalog_lock = threading.Lock()
+_listener = None
+
+
+@traced("sql.load_llm_catalog")
+def load_llm_catalog():
+    """Reads the llm table.
+    Returns:
+        Dictionary of LLM name to LLM dictionary.
+    """
+    session = Session(get_read_engine(LLM_CATALOG_CHANNEL))
+    try:
+        return {llm.name: llm.to_dict() for llm in session.query(LLMTableSQL).all()}
+    finally:
+        session.close()
+
+
+def get_llm_catalog():
+    """Returns the in-memory LLM catalog, loading it when it was invalidated or
+    is older than LLM_CATALOG_TTL_SECONDS.
+    Returns:
+        Dictionary of LLM name to LLM dictionary, not to be modified.
+    """
+    global _catalog, _catalog_loaded_at
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - _catalog_loaded_at < LLM_CATALOG_TTL_SECONDS:
+        return catalog
+    with _catalog_lock:
+        # another thread may have loaded it while this one waited
+        if _catalog is None or time.monotonic() - _catalog_loaded_at >= LLM_CATALOG_TTL_SECONDS:
+            _catalog = load_llm_catalog()
+            _catalog_loaded_at = time.monotonic()
+            logging.info(f"LLM catalog loaded: {len(_catalog)} LLMs")
+        return _catalog
+
+
+def invalidate_llm_catalog():
+    """Drops the in-memory LLM catalog, the next read loads it again, from
+    the primary or a replica that caught up with the change."""
+    global _catalog
+    record_write(LLM_CATALOG_CHANNEL)
+    # taking the lock orders this after a load that started before the change
+    with _catalog_lock:
+        _catalog = None
+
+
+def notify_llm_catalog_changed(session):
+    """Notifies the instances listening on Postgres, once session commits."""
+    if session.get_bind().dialect.name == "postgresql":
+        session.execute(sqlalchemy.text(f"NOTIFY {LLM_CATALOG_CHANNEL}"))
+
+
+def _wait_for_notification(driver_connection, cursor):
+    """Returns True when the connection received a notification. Notifications
+    are read by pg8000 and psycopg2 only while the connection is in use."""
+    cursor.execute("SELECT 1")
+    cursor.fetchall()
+    if hasattr(driver_connection, "poll"):
+        driver_connection.poll()
+    notifications = getattr(driver_connection, "notifications", None)
+    if notifications is None:
+        notifications = getattr(driver_connection, "notifies", [])
+    if notifications:
+        notifications.clear()
+        return True
+    return False
+
+
+def listen_for_llm_catalog_changes(stop_event):
+    """Invalidates the catalog when an instance changes the llm table, until
+    stop_event is set. Keeps one connection of the pool.
+    Args:
+        stop_event: threading.Event ending the listener.
+    """
+    backoff = 1
+    while not stop_event.is_set():
+        try:
+            connection = get_engine().raw_connection()
+            try:
+                driver_connection = connection.driver_connection
+                driver_connection.autocommit = True
+                cursor = driver_connection.cursor()
+                cursor.execute(f"LISTEN {LLM_CATALOG_CHANNEL}")
+                # changes made while not listening were missed
+                invalidate_llm_catalog()
+                backoff = 1
+                while not stop_event.wait(LLM_CATALOG_POLL_SECONDS):
+                    if _wait_for_notification(driver_connection, cursor):
+                        logging.info("LLM catalog changed on another instance")
+                        invalidate_llm_catalog()
+            finally:
+                # the connection listens and autocommits, it is not reused
+                connection.invalidate()
+                connection.close()
+        except Exception as e:
+            logging.error(f"Error listening for LLM catalog changes: {e}")
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+def start_llm_catalog():
+    """Loads the LLM catalog, and listens for changes on Postgres, on a
+    background thread. Does nothing when no database is configured."""
+    global _listener
+    if _listener is not None or not database_configured():
+        return
+
+    def run():
+        try:
+            get_llm_catalog()
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.error(f"Error loading LLM catalog: {e}")
+        if LLM_CATALOG_LISTEN and get_engine().dialect.name == "postgresql":
+            listen_for_llm_catalog_changes(_listener.stop_event)
+
+    _listener = threading.Thread(target=run, name="llm-catalog", daemon=True)
+    _listener.stop_event = threading.Event()
+    _listener.start()
 
 
 def get_llms():
@@ -31,11 +167,7 @@ def get_llms():
       A list of LLM objects.
     """
     try:
-        session = Session(engine)
-        llms = session.query(LLMTableSQL).all()
-        llms_list = [llm.to_dict() for llm in llms]
-        session.close()
-        return llms_list
+        return [dict(llm) for llm in get_llm_catalog().values()]
 
     except sqlalchemy.exc.OperationalError as e:
         logging.error(f"Error getting llms: {e}")
@@ -66,10 +198,12 @@ def create_llm(
         llm = LLMTableSQL(
             name, display_name, provider, model_name, version, params, is_active
         )
-        session = Session(engine, expire_on_commit=False)
+        session = Session(get_engine(), expire_on_commit=False)
         session.add(llm)
+        notify_llm_catalog_changed(session)
         session.commit()
         session.close()
+        invalidate_llm_catalog()
 
         logging.info(f"LLM added: {name}")
         return llm.to_dict()
@@ -98,7 +232,7 @@ def update_llm(name, is_active):
         Response object.
     """
     try:
-        session = Session(engine, expire_on_commit=False)
+        session = Session(get_engine(), expire_on_commit=False)
         llm = session.query(LLMTableSQL).filter_by(name=name).first()
 
         if not llm:
@@ -116,9 +250,11 @@ def update_llm(name, is_active):
             return response.to_response()
 
         llm.is_active = is_active
+        notify_llm_catalog_changed(session)
 
         session.commit()
         session.close()
+        invalidate_llm_catalog()
 
         logging.info(f"LLM updated successfully: {name}")
         response = ApiResponse(
@@ -144,7 +280,7 @@ def delete_llm(name):
         Response object.
     """
     try:
-        session = Session(engine, expire_on_commit=False)
+        session = Session(get_engine(), expire_on_commit=False)
         llm = session.query(LLMTableSQL).filter_by(name=name).first()
         if not llm:
             logging.warning(f"No LLM record found with name: {name}.")
@@ -161,8 +297,10 @@ def delete_llm(name):
             return response.to_response()
 
         session.delete(llm)
+        notify_llm_catalog_changed(session)
         session.commit()
         session.close()
+        invalidate_llm_catalog()
         logging.info(f"LLM deleted: {name}")
         response = ApiResponse(
             message="LLM deleted successfully", status_code=HTTPStatus.OK
@@ -187,11 +325,9 @@ def is_llm_active(name):
         boolean, if the llm is active or not
     """
     try:
-        session = Session(engine)
-        llm = session.query(LLMTableSQL).filter_by(name=name).first()
-        session.close()
+        llm = get_llm_catalog().get(name)
         if llm:
-            return llm.to_dict().get("is_active")
+            return llm.get("is_active")
         return {"error": "LLM Not Found."}
 
     except sqlalchemy.exc.OperationalError as e:
@@ -202,3 +338,14 @@ def is_llm_active(name):
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
         return response.to_response()
+
+
+def get_llm(name):
+    """Get details of one LLM
+    Args:
+        name: LLM name
+    Returns:
+        LLM dictionary, or None if no LLM has this name
+    """
+    llm = get_llm_catalog().get(name)
+    return dict(llm) if llm else None
@@ -13,14 +13,18 @@
 # limitations under the License.
 
 from http import HTTPStatus
-import json
+import os
+import time
+import datetime
+import queue
 import logging
+import threading
 from app.main.model.message import Message
 from app.main.service.conversation_service import (
     post_conversation_settings,
     get_conversation_settings,
-    update_conversation_title,
     update_conversation_settings,
+    update_conversation_summary,
     get_conversation
 )
 from app.main.util.utils import (
@@ -31,6 +35,14 @@ from app.main.util.utils import (
 from app.main.model.llm import LLMBase, LLMFactory, GeminiLLM, CodestralLLM
 from app.main.model.apiresponse import ApiResponse
 from app.main.service.llm_service import is_llm_active
+from app.main.service.search_service import index_messages
+from app.main.util.metrics import increment_counter, instrument_stream
+from app.main.util.streaming import END_OF_STREAM, format_ndjson_line
+from app.main.util.tracing import run_in_current_context, traced
+
+# Maximum number of LLMs a prompt can be fanned out to.
+FANOUT_MAX_LLMS = int(os.environ.get("FANOUT_MAX_LLMS", 4))
+DISABLED_LLM_MESSAGE = "This LLM has been disabled, please switch to some other LLM."
 
 
 def create_message(role: str, message: str):
@@ -88,6 +100,7 @@ def get_context_from_bucket(conversation_id):
     return context
 
 
+@traced("chat.generate_title")
 def generate_title(user_propmt):
     # By default, gemini will be used to generate the prompt
     llm_model = GeminiLLM()
@@ -106,7 +119,7 @@ def generate_title(user_propmt):
     for response in non_streaming_response:
         if response["result"] == "success":
             raw_title = response["data"][0]["message"]
-            logging.info("-------------RAW TITLE: ", raw_title)
+            logging.info(f"-------------RAW TITLE: {raw_title}")
             formatted_title = (
                 raw_title.split(": ")[1]
                 .replace("\n", "")
@@ -115,31 +128,188 @@ def generate_title(user_propmt):
                 .strip()
             )
             logging.info(
-                "SUCCESS - Title generation.\nConversation Title: ", formatted_title
+                f"SUCCESS - Title generation.\nConversation Title: {formatted_title}"
             )
             return formatted_title
         else:
             logging.error("FAILED - Title generation.")
             return "Untitled Chat"
     
+@traced("chat.update_title")
 def update_title(conversation_id, conversation_title):
-    update_conversation = update_conversation_title(conversation_id, conversation_title)
-    logging.info("Updated conversation title in DB - ", update_conversation)
+    # the conversation row is updated, llm-settings.json follows in the background
     updated_title = {
         "title": conversation_title 
     }
-    _ = update_conversation_settings(conversation_id, updated_title)
-    logging.info("Updated conversation title in GCS - ", conversation_id)
+    update_conversation = update_conversation_settings(conversation_id, updated_title)
+    logging.info(f"Updated conversation title - {update_conversation}")
 
 
-def post_message(conversation_id: str, message_request_body: dict, stream=True):
-    """Send prompt to LLM and store response.
+def turn_metadata(llm_name, llm_params, started, first_chunk_at=None):
+    """Returns the metadata stored with an answer, read by the analytics export.
     Args:
-        id: Conversation Id
+        llm_name: LLM that answered
+        llm_params: LLM parameters of the answer
+        started: time.monotonic() of the request
+        first_chunk_at: time.monotonic() of the first chunk of the answer
+    Returns:
+        Dictionary of the LLM, its parameters, the time the answer was stored
+        and the time to its first chunk and to its end in milliseconds.
+    """
+    finished = time.monotonic()
+    return {
+        "llm_name": llm_name,
+        "llm_params": llm_params,
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "ttft_ms": round((first_chunk_at - started) * 1000) if first_chunk_at else None,
+        "duration_ms": round((finished - started) * 1000),
+    }
+
+
+def get_llm_model(llm_name):
+    """Returns the LLM client for a conversation's llm_name.
+    Args:
+        llm_name: Name of the llm row selected for the conversation.
+    Returns:
+        LLM client object.
+    """
+    if llm_name == "Gemini":
+        return GeminiLLM()
+    elif llm_name == "Codestral":
+        return CodestralLLM()
+    # setting default as Gemini
+    return GeminiLLM()
+
+
+def context_for_llm(context, llm_name):
+    """Keeps one answer per turn of a conversation with fanned-out prompts.
+    Args:
+        context: Messages of the conversation
+        llm_name: LLM the context is sent to
+    Returns:
+        Messages with the answer of llm_name, or the first answer, for every
+        fanned-out prompt.
+    """
+    filtered_context = []
+    answers = []
+    for message in context + [None]:
+        if message is not None and "llm_name" in message:
+            answers.append(message)
+            continue
+        if answers:
+            own_answers = [a for a in answers if a["llm_name"] == llm_name]
+            filtered_context.append((own_answers or answers)[0])
+            answers = []
+        if message is not None:
+            filtered_context.append(message)
+    return filtered_context
+
+
+def generate_fanout_messages(
+    conversation_id, context, message_request_body, llm_names, llm_params,
+    cancel_event=None, started=None,
+):
+    """Sends one prompt to several LLMs concurrently.
+    Args:
+        conversation_id: Conversation Id
+        context: Messages of the conversation
         message_request_body: Dictionary containing role -> user and message -> prompt
+        llm_names: Names of the LLMs answering the prompt
+        llm_params: LLM parameters
+        cancel_event: Optional threading.Event, set when the client went away.
+        started: time.monotonic() of the request, for the chat latency metrics.
     Returns:
-        Dict response received from LLM containing role -> system and message -> response text.
+        Generator of response chunks of all LLMs, tagged with llm_name, in
+        arrival order, and of an error chunk for each LLM that failed. All
+        answers are stored with a single write, without those of failed LLMs.
     """
+    prompt = message_request_body["message"]
+    llm_names = list(dict.fromkeys(llm_names))
+    source = queue.Queue()
+    started = started if started is not None else time.monotonic()
+    first_chunk_at = {}
+
+    def generate(llm_name):
+        try:
+            if not is_llm_active(llm_name):
+                source.put((llm_name, {"role": "system", "message": DISABLED_LLM_MESSAGE}))
+                return
+            llm_model = get_llm_model(llm_name)
+            responses = llm_model.generate_response(
+                context_for_llm(context, llm_name), prompt, llm_params, True,
+                cancel_event=cancel_event,
+            )
+            for response_data in instrument_stream(
+                (response["data"][0] for response in responses),
+                "chat", started, llm_name=llm_name,
+            ):
+                first_chunk_at.setdefault(llm_name, time.monotonic())
+                source.put((llm_name, response_data))
+        except Exception as e:
+            logging.error(f"Error in fan-out to {llm_name} - {e}")
+            source.put((llm_name, {"role": "error", "message": str(e)}))
+        finally:
+            source.put((llm_name, END_OF_STREAM))
+
+    for llm_name in llm_names:
+        threading.Thread(
+            target=run_in_current_context(generate), args=(llm_name,), daemon=True
+        ).start()
+
+    answers = {llm_name: "" for llm_name in llm_names}
+    failed = set()
+    running = len(llm_names)
+    while running:
+        llm_name, response_data = source.get()
+        if response_data is END_OF_STREAM:
+            running -= 1
+            continue
+        if response_data["role"] == "error":
+            failed.add(llm_name)
+        else:
+            answers[llm_name] += response_data["message"]
+        yield dict(response_data, llm_name=llm_name)
+
+    context.append(
+        {"role": message_request_body["role"], "message": message_request_body["message"]}
+    )
+    # failed answers are not stored, rather than stored as empty or partial answers
+    answered = [llm_name for llm_name in llm_names if llm_name not in failed]
+    for llm_name in answered:
+        response_message = {
+            "role": "system",
+            "message": answers[llm_name],
+            "llm_name": llm_name,
+            "metadata": turn_metadata(
+                llm_name, llm_params, started, first_chunk_at.get(llm_name)
+            ),
+        }
+        if cancel_event is not None and cancel_event.is_set():
+            response_message["truncated"] = True
+            increment_counter("llm_generations_cancelled_total", llm_name=llm_name)
+        context.append(response_message)
+    write_file_to_gcs(conversation_id=conversation_id, data=context, file_name="message")
+    index_messages(conversation_id, context[-len(answered) - 1:])
+    update_conversation_summary(conversation_id, context)
+
+
+@traced("chat.generate_messages")
+def generate_messages(
+    conversation_id: str, message_request_body: dict, stream=True, cancel_event=None
+):
+    """Send prompt to LLM, store response and yield the response chunks.
+    Args:
+        conversation_id: Conversation Id
+        message_request_body: Dictionary containing role -> user and message -> prompt
+        stream: Whether the LLM response is streamed
+        cancel_event: Optional threading.Event, set when the client went away.
+            The partial response is stored marked as truncated.
+    Returns:
+        Generator of dicts containing role -> system and message -> response text.
+        When message_request_body has llm_names, the prompt is fanned out to
+        those LLMs instead of the conversation's LLM, see generate_fanout_messages.
+    """
+    started = time.monotonic()
     conversations = list_folders_in_gcs()
     current_conversation = None
     # Check if the conversation id already exists
@@ -165,53 +335,78 @@ def post_message(conversation_id: str, message_request_body: dict, stream=True):
         llm_name = llm_settings["llm_name"]
         llm_params = llm_settings["llm_params"]
 
+        llm_names = message_request_body.get("llm_names")
+        if llm_names:
+            yield from generate_fanout_messages(
+                conversation_id, context, message_request_body, llm_names,
+                llm_params, cancel_event, started,
+            )
+
         # Check if the particular llm is active
-        if not is_llm_active(llm_name):
-            response_data = {
-                "role": "system",
-                "message": "This LLM has been disabled, please switch to some other LLM.",
-            }
-            yield (json.dumps(response_data) + "\n").encode("utf-8")
+        elif not is_llm_active(llm_name):
+            yield {"role": "system", "message": DISABLED_LLM_MESSAGE}
 
         else:
-            if llm_name == "Gemini":
-                llm_model = GeminiLLM()
-            elif llm_name == "Codestral":
-                llm_model = CodestralLLM()
-            else:
-                # setting default as Gemini
-                llm_model = GeminiLLM()
+            llm_model = get_llm_model(llm_name)
 
             if stream:
                 streaming_response_generator = llm_model.generate_response(
-                    context, prompt, llm_params, True
+                    context_for_llm(context, llm_name), prompt, llm_params, True,
+                    cancel_event=cancel_event,
                 )
                 complete_response = ""
-                for streaming_response in streaming_response_generator:
-                    streaming_response_data = streaming_response["data"][0]
+                first_chunk_at = None
+                for streaming_response_data in instrument_stream(
+                    (response["data"][0] for response in streaming_response_generator),
+                    "chat", started, llm_name=llm_name,
+                ):
+                    first_chunk_at = first_chunk_at or time.monotonic()
                     complete_response += streaming_response_data["message"]
-                    yield (json.dumps(streaming_response_data) + "\n").encode("utf-8")
+                    yield streaming_response_data
 
+                response_message = {
+                    "role": "system",
+                    "message": complete_response,
+                    "metadata": turn_metadata(
+                        llm_name, llm_params, started, first_chunk_at
+                    ),
+                }
+                if cancel_event is not None and cancel_event.is_set():
+                    response_message["truncated"] = True
+                    increment_counter(
+                        "llm_generations_cancelled_total", llm_name=llm_name
+                    )
                 context.append(message_request_body)
-                context.append({"role": "system", "message": complete_response})
+                context.append(response_message)
                 write_file_to_gcs(
                     conversation_id=conversation_id, data=context, file_name="message"
                 )
+                index_messages(conversation_id, [message_request_body, response_message])
+                update_conversation_summary(conversation_id, context)
 
             else:
                 non_streaming_response = llm_model.generate_response(
-                    context, prompt, llm_params, False
+                    context_for_llm(context, llm_name), prompt, llm_params, False
                 )
                 for resp in non_streaming_response:
                     response_data = resp["data"][0]
                     context.append(message_request_body)
-                    context.append(response_data)
+                    context.append(
+                        dict(
+                            response_data,
+                            metadata=turn_metadata(
+                                llm_name, llm_params, started, time.monotonic()
+                            ),
+                        )
+                    )
                     write_file_to_gcs(
                         conversation_id=conversation_id,
                         data=context,
                         file_name="message",
                     )
-                    yield (json.dumps(response_data) + "\n").encode("utf-8")
+                    index_messages(conversation_id, context[-2:])
+                    update_conversation_summary(conversation_id, context)
+                    yield response_data
 
     except Exception as e:
         logging.error(f"Error in post message - {e}")
@@ -221,3 +416,18 @@ def post_message(conversation_id: str, message_request_body: dict, stream=True):
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
         return response.to_response()
+
+
+def post_message(conversation_id: str, message_request_body: dict, stream=True):
+    """Send prompt to LLM and store response.
+    Args:
+        id: Conversation Id
+        message_request_body: Dictionary containing role -> user and message -> prompt
+    Returns:
+        Newline delimited JSON chunks received from LLM containing role -> system
+        and message -> response text.
+    """
+    for response_data in generate_messages(
+        conversation_id, message_request_body, stream
+    ):
+        yield format_ndjson_line(response_data)
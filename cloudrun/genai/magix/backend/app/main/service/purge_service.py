@@ -0,0 +1,164 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background purge of deleted conversations.
+
+Deleting a conversation only sets its deleted_at. The purger then deletes
+its storage objects, with batch requests on a bounded pool of threads, and
+finally its search index rows and its row. Purging is idempotent, instances
+purging the same conversations concurrently do no harm.
+"""
+
+import os
+import logging
+import datetime
+import threading
+import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
+from app.main.model.conversation import ConversationSQL
+from app.main.model.search import MessageSearchSQL
+from app.main.util.tracing import run_in_current_context, traced
+from app.main.util.utils import GCS_BATCH_SIZE, delete_blobs_in_gcs, list_blobs_in_gcs
+from db.config import database_configured, get_engine
+
+# Seconds between purges when no conversation is deleted meanwhile.
+PURGE_INTERVAL_SECONDS = float(os.environ.get("PURGE_INTERVAL_SECONDS", 60))
+# Seconds a deleted conversation waits before its purge, so that the files of
+# generations still running when it was deleted are written before the purge
+# lists them.
+PURGE_DELAY_SECONDS = float(os.environ.get("PURGE_DELAY_SECONDS", 300))
+# Conversations purged together.
+PURGE_BATCH_SIZE = int(os.environ.get("PURGE_BATCH_SIZE", 100))
+# Concurrent storage requests of the purger.
+PURGE_WORKERS = int(os.environ.get("PURGE_WORKERS", 4))
+# Conversation files are stored under the fixed user of app/main/util/utils.py.
+CONVERSATION_PREFIX = "user@example.com/{conversation_id}/"
+
+_executor = ThreadPoolExecutor(max_workers=PURGE_WORKERS, thread_name_prefix="purge")
+_wake_event = threading.Event()
+_purger = None
+
+
+def pending_purges(limit=PURGE_BATCH_SIZE):
+    """Returns the ids of the conversations deleted more than
+    PURGE_DELAY_SECONDS ago, oldest deletions first."""
+    table = ConversationSQL.__table__
+    # deleted_at is a naive UTC time
+    deleted_before = datetime.datetime.now(datetime.timezone.utc).replace(
+        tzinfo=None
+    ) - datetime.timedelta(seconds=PURGE_DELAY_SECONDS)
+    with get_engine().connect() as connection:
+        return connection.execute(
+            sqlalchemy.select(table.c.id)
+            .where(table.c.deleted_at < deleted_before)
+            .order_by(table.c.deleted_at)
+            .limit(limit)
+        ).scalars().all()
+
+
+@traced("purge.conversations")
+def purge_conversations(conversation_ids):
+    """Deletes the storage objects, search rows and rows of deleted conversations.
+    Args:
+        conversation_ids: Ids of deleted conversations.
+    Returns:
+        The ids of the purged conversations. Conversations whose objects
+        could not all be listed or deleted are kept for the next purge.
+    """
+    list_blobs = run_in_current_context(list_blobs_in_gcs)
+    listings = {
+        conversation_id: _executor.submit(
+            list_blobs, CONVERSATION_PREFIX.format(conversation_id=conversation_id)
+        )
+        for conversation_id in conversation_ids
+    }
+    blobs_of = {}
+    for conversation_id, listing in listings.items():
+        try:
+            blobs_of[conversation_id] = listing.result()
+        except Exception as e:
+            logging.error(f"Error listing files of {conversation_id} - {e}")
+
+    # the objects of all conversations are deleted together, 100 per request
+    blob_names = [name for names in blobs_of.values() for name in names]
+    delete_blobs = run_in_current_context(delete_blobs_in_gcs)
+    deletions = [
+        _executor.submit(delete_blobs, blob_names[start:start + GCS_BATCH_SIZE])
+        for start in range(0, len(blob_names), GCS_BATCH_SIZE)
+    ]
+    failed = set()
+    for deletion in deletions:
+        failed.update(deletion.result())
+
+    purged = [
+        conversation_id
+        for conversation_id, names in blobs_of.items()
+        if failed.isdisjoint(names)
+    ]
+    if purged:
+        conversations, messages = ConversationSQL.__table__, MessageSearchSQL.__table__
+        with get_engine().begin() as connection:
+            connection.execute(
+                messages.delete().where(messages.c.conversation_id.in_(purged))
+            )
+            connection.execute(
+                conversations.delete().where(
+                    conversations.c.id.in_(purged), conversations.c.deleted_at.isnot(None)
+                )
+            )
+    logging.info(
+        f"Purged {len(purged)} conversations and {len(blob_names) - len(failed)} files, "
+        f"{len(conversation_ids) - len(purged)} left for the next purge"
+    )
+    return purged
+
+
+def purge_once():
+    """Purges deleted conversations until none is left or a purge fails partly.
+    Returns:
+        The number of purged conversations.
+    """
+    total = 0
+    while True:
+        conversation_ids = pending_purges()
+        if not conversation_ids:
+            return total
+        purged = purge_conversations(conversation_ids)
+        total += len(purged)
+        if len(purged) < len(conversation_ids):
+            return total
+
+
+def _purge_loop():
+    while True:
+        _wake_event.wait(PURGE_INTERVAL_SECONDS)
+        _wake_event.clear()
+        try:
+            purge_once()
+        except Exception as e:
+            logging.error(f"Error purging deleted conversations: {e}")
+
+
+def wake_purger():
+    """Starts a purge now rather than after PURGE_INTERVAL_SECONDS."""
+    _wake_event.set()
+
+
+def start_purger():
+    """Starts the purger thread. Does nothing when no database is configured."""
+    global _purger
+    if _purger is not None or not database_configured():
+        return
+    _purger = threading.Thread(target=_purge_loop, name="purger", daemon=True)
+    _purger.start()
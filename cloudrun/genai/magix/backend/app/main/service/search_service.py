@@ -0,0 +1,205 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import logging
+import sqlalchemy
+from http import HTTPStatus
+from sqlalchemy import and_, desc, func, literal, literal_column, null, select, union_all
+from sqlalchemy.orm import Session
+from app.main.model.apiresponse import ApiResponse
+from app.main.model.conversation import ConversationSQL
+from app.main.model.search import SEARCH_CONFIG, MessageSearchSQL, search_document
+from app.main.service.conversation_service import get_conversation_settings
+from app.main.util.tracing import traced
+from db.config import get_engine, get_read_engine, record_write
+
+# Hits per page of GET /search, by default and at most.
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 50
+# Characters of a hit's text returned as snippet when the database has no
+# ts_headline.
+SNIPPET_LENGTH = 160
+SNIPPET_OPTIONS = os.environ.get(
+    "SEARCH_SNIPPET_OPTIONS", "MaxWords=30, MinWords=10, MaxFragments=2"
+)
+
+
+@traced("sql.index_messages")
+def index_messages(conversation_id, messages):
+    """Adds persisted messages of a conversation to the search index.
+
+    Failures are logged, searching lags behind rather than failing the chat.
+    Args:
+        conversation_id: Conversation Id
+        messages: Messages appended to the conversation, dictionaries
+            containing role and message.
+    """
+    messages = [message for message in messages if message.get("message")]
+    if not messages:
+        return
+    try:
+        settings = get_conversation_settings(conversation_id)
+        user_email = settings.get("user_email") if isinstance(settings, dict) else None
+        if not user_email:
+            logging.warning(f"Not indexing messages of unknown user - {conversation_id}")
+            return
+        with Session(get_engine()) as session:
+            session.add_all(
+                MessageSearchSQL(
+                    conversation_id=conversation_id,
+                    user_email=user_email,
+                    role=message.get("role"),
+                    message=message["message"],
+                )
+                for message in messages
+            )
+            session.commit()
+        record_write(user_email)
+    except Exception as e:
+        logging.error(f"Error indexing messages of {conversation_id} - {e}")
+
+
+def _tsquery(query):
+    return func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'"), query)
+
+
+def _match(column, query, dialect_name):
+    if dialect_name == "postgresql":
+        return search_document(column).op("@@")(_tsquery(query))
+    # without tsvector, every word has to appear in the text
+    return and_(
+        *(
+            func.lower(column).contains(term.lower(), autoescape=True)
+            for term in query.split()
+        )
+    )
+
+
+def _rank(column, query, dialect_name):
+    if dialect_name == "postgresql":
+        return func.ts_rank(search_document(column), _tsquery(query))
+    return literal(1.0)
+
+
+def _snippet(column, query, dialect_name):
+    if dialect_name == "postgresql":
+        return func.ts_headline(
+            literal_column(f"'{SEARCH_CONFIG}'"), column, _tsquery(query), SNIPPET_OPTIONS
+        )
+    return func.substr(column, 1, SNIPPET_LENGTH)
+
+
+def search_statement(user_email, query, limit, offset, dialect_name):
+    """Returns the statement of a page of search hits.
+
+    Messages and titles matching the query are ranked together. Both matches
+    use the GIN indexes on Postgres, snippets are only computed for the rows
+    of the page.
+    """
+    messages = MessageSearchSQL.__table__
+    conversations = ConversationSQL.__table__
+    hits = union_all(
+        select(
+            messages.c.conversation_id,
+            messages.c.id.label("message_id"),
+            messages.c.role,
+            messages.c.message.label("text"),
+            _rank(messages.c.message, query, dialect_name).label("rank"),
+            messages.c.created_at,
+        ).where(
+            messages.c.user_email == user_email,
+            _match(messages.c.message, query, dialect_name),
+            # until the purger removes them
+            ~messages.c.conversation_id.in_(
+                select(conversations.c.id).where(
+                    conversations.c.user_email == user_email,
+                    conversations.c.deleted_at.isnot(None),
+                )
+            ),
+        ),
+        select(
+            conversations.c.id,
+            null(),
+            literal("title"),
+            conversations.c.title,
+            _rank(conversations.c.title, query, dialect_name),
+            conversations.c.created_at,
+        ).where(
+            conversations.c.user_email == user_email,
+            conversations.c.deleted_at.is_(None),
+            _match(conversations.c.title, query, dialect_name),
+        ),
+    ).subquery("hits")
+    page = (
+        select(hits)
+        .order_by(desc(hits.c.rank), desc(hits.c.created_at), desc(hits.c.message_id))
+        .limit(limit)
+        .offset(offset)
+        .subquery("page")
+    )
+    return (
+        select(
+            page.c.conversation_id,
+            conversations.c.title,
+            page.c.message_id,
+            page.c.role,
+            page.c.rank,
+            page.c.created_at,
+            _snippet(page.c.text, query, dialect_name).label("snippet"),
+        )
+        .join(conversations, conversations.c.id == page.c.conversation_id)
+        .order_by(desc(page.c.rank), desc(page.c.created_at), desc(page.c.message_id))
+    )
+
+
+@traced("sql.search_conversations")
+def search_conversations(user_email, query, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Searches the titles and messages of a user's conversations.
+    Args:
+        user_email: User email
+        query: Search terms, web search syntax on Postgres, e.g. "python -java"
+        limit: Maximum number of hits of the page
+        offset: next_offset of the previous page, 0 for the first page
+    Returns:
+        Dictionary of the hits, best first, and the next_offset, None on the
+        last page. A hit of a title has role "title" and no message_id.
+    """
+    try:
+        engine = get_read_engine(user_email)
+        statement = search_statement(
+            user_email, query, limit + 1, offset, engine.dialect.name
+        )
+        with engine.connect() as connection:
+            rows = connection.execute(statement).mappings().all()
+        next_offset = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_offset = offset + limit
+        return {
+            "hits": [
+                dict(row, rank=float(row["rank"]), created_at=str(row["created_at"]))
+                for row in rows
+            ],
+            "next_offset": next_offset,
+        }
+
+    except sqlalchemy.exc.OperationalError as e:
+        logging.error(f"Error searching conversations: {e}")
+        response = ApiResponse(
+            data={"error": {"type": type(e).__name__, "message": str(e)}},
+            message="Database error occurred",
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+        )
+        return response.to_response()
@@ -18,15 +18,22 @@ import logging
 import sqlalchemy
 import random
 import string
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from app.main.model.user import UserSQL
-from db.config import connect_with_connector
+from db.config import get_engine, get_read_engine, record_write
 from app.main.model.apiresponse import ApiResponse
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+from app.main.util import token_verifier
+from app.main.util.cache import TTLCache
+from app.main.util.tracing import traced
 
+# Users resolved by email, admin changes apply after at most the TTL.
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", 60))
+# Usernames tried for a new user before giving up.
+USERNAME_ATTEMPTS = 8
 
-engine = connect_with_connector()
+_users_by_email = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL_SECONDS)
 
 
 def generate_random_username_suffix(length=4):
@@ -49,7 +56,8 @@ def get_users():
       A list of user objects.
     """
     try:
-        session = Session(engine)
+        # users registered on any instance are listed, without waiting for replicas
+        session = Session(get_engine())
         users = session.query(UserSQL).all()
         users_list = [user.to_dict() for user in users]
         session.close()
@@ -65,42 +73,67 @@ def get_users():
         return response.to_response()
 
 
-def create_user(user_email):
-    """Create new user.
-    Returns:
-      User info
-    """
-    try:
-        
-        base_username = user_email.split("@")[0]
-        username = base_username
-
-        session = Session(engine, expire_on_commit=False)
-        while session.query(UserSQL).filter_by(username=username).first() is not None:
-            random_suffix = generate_random_username_suffix()
-            username = f"{base_username}_{random_suffix}"
-
-        user = UserSQL(
-            email=user_email,
-            tenant_id=os.environ.get("TENANT_ID"),
-            username=username
+def _upsert_statement(table, values, dialect_name):
+    """Returns the statement inserting a user unless its email or username is
+    taken, and returning the user of the email."""
+    columns = [table.c.email, table.c.username, table.c.is_admin, table.c.tenant_id]
+    if dialect_name == "postgresql":
+        inserted = (
+            postgresql.insert(table)
+            .values(**values)
+            .on_conflict_do_nothing()
+            .returning(*columns)
+            .cte("inserted")
         )
+        existing = sqlalchemy.select(*columns).where(table.c.email == values["email"])
+        return sqlalchemy.union_all(sqlalchemy.select(inserted), existing).limit(1)
+    return sqlite.insert(table).values(**values).on_conflict_do_nothing().returning(*columns)
 
-        session.add(user)
-        session.commit()
-        session.close()
 
-        logging.info(f"User added: {user_email}")
-        return user.to_dict()
+@traced("sql.upsert_user")
+def upsert_user(user_email):
+    """Returns the user of an email, registering it if it is new.
 
-    except Exception as e:
-        logging.error(f"Error adding user: {e}")
-        response = ApiResponse(
-            data={"error": {"type": type(e).__name__, "message": str(e)}},
-            message="Database error occurred. User could not be registered",
-            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
-        )
-        return response.to_response()
+    On Postgres the lookup and the insert are one statement. The username is
+    the local part of the email, suffixed randomly while it is taken by
+    another user.
+    Args:
+        user_email: email id of user
+    Returns:
+        User info
+    """
+    table = UserSQL.__table__
+    base_username = user_email.split("@")[0]
+    username = base_username
+    engine = get_engine()
+    for _ in range(USERNAME_ATTEMPTS):
+        values = {
+            "email": user_email,
+            "username": username,
+            "is_admin": False,
+            "tenant_id": os.environ.get("TENANT_ID"),
+            "created_at": sqlalchemy.func.now(),
+        }
+        with engine.begin() as connection:
+            row = connection.execute(
+                _upsert_statement(table, values, engine.dialect.name)
+            ).first()
+            if row is None and engine.dialect.name != "postgresql":
+                row = connection.execute(
+                    sqlalchemy.select(table).where(table.c.email == user_email)
+                ).first()
+        if row is not None:
+            record_write(user_email, row.username)
+            return {
+                "email": row.email,
+                "username": row.username,
+                "is_admin": row.is_admin,
+                "tenant_id": row.tenant_id,
+            }
+        # the username belongs to another user, or the email was registered
+        # by a concurrent request after the statement started
+        username = f"{base_username}_{generate_random_username_suffix()}"
+    raise RuntimeError(f"No free username found for {user_email}")
 
 
 def get_user_data(username):
@@ -111,7 +144,7 @@ def get_user_data(username):
         boolean, if the user is admin or not
     """
     try:
-        session = Session(engine)
+        session = Session(get_read_engine(username))
         user = session.query(UserSQL).filter_by(username=username).first()
         session.close()
         if user:
@@ -135,20 +168,19 @@ def get_user_data(username):
 
 
 def get_user_data_email(user_email):
-    """Get details of user using the email.
+    """Get details of user using the email, registering new users.
     Args:
         user_email: email id of user
     Returns:
         user info, if user is found, otherwise error
     """
+    user = _users_by_email.get(user_email)
+    if user is not None:
+        return user
     try:
-        session = Session(engine)
-        user = session.query(UserSQL).filter_by(email=user_email).first()
-        session.close()
-        if user:
-            return user.to_dict()
-        return create_user(user_email)
-
+        user = upsert_user(user_email)
+        _users_by_email.set(user_email, user)
+        return user
 
     except Exception as e:
         logging.error(f"Error fetching details of user: {e}")
@@ -160,6 +192,17 @@ def get_user_data_email(user_email):
         return response.to_response()
 
 
+def verify_id_token(token):
+    """ verify a Google ID token against the cached Google signing keys.
+    Args:
+        token: Google ID token
+    Returns:
+        claims of the token, raises ValueError if it is invalid
+    """
+    CLIENT_ID = os.environ.get("CLIENT_ID")
+    return token_verifier.verify(token, CLIENT_ID)
+
+
 def validate_user_token(token):
     """ validate user token.
     Args:
@@ -168,8 +211,7 @@ def validate_user_token(token):
         user info corresponding to the token, if user is found, otherwise error
     """
     try:
-        CLIENT_ID = os.environ.get("CLIENT_ID")
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), CLIENT_ID)
+        idinfo = verify_id_token(token)
 
         user_email = idinfo['email']
         user_id = idinfo['sub']
@@ -187,4 +229,29 @@ def validate_user_token(token):
             message="Token validation error",
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
         )
-        return response.to_response()
\ No newline at end of file
+        return response.to_response()
+
+
+def get_user_from_token(token):
+    """Returns the registered user a Google ID token belongs to.
+    Args:
+        token: Google ID token
+    Returns:
+        user info, or None if the token is invalid or the user is not registered
+    """
+    try:
+        idinfo = verify_id_token(token)
+    except ValueError as e:
+        logging.warning(f"Invalid token: {e}")
+        return None
+
+    user = _users_by_email.get(idinfo["email"])
+    if user is not None:
+        return user
+    session = Session(get_read_engine(idinfo["email"]))
+    user = session.query(UserSQL).filter_by(email=idinfo["email"]).first()
+    session.close()
+    if user is None:
+        return None
+    _users_by_email.set(idinfo["email"], user.to_dict())
+    return user.to_dict()
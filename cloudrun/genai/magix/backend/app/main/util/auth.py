@@ -0,0 +1,48 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+from http import HTTPStatus
+from flask import g, request
+from app.main.model.apiresponse import ApiResponse
+
+
+def admin_required(view):
+    """Decorates a route so it is only served to admin users.
+
+    The caller sends its Google ID token as "Authorization: Bearer <token>".
+    The user is available to the route as flask.g.user.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        from app.main.service.user_service import get_user_from_token
+
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not token:
+            response = ApiResponse(
+                HTTPStatus.UNAUTHORIZED, message="Bearer token is required"
+            )
+            return response.to_response()
+        user = get_user_from_token(token)
+        if user is None:
+            response = ApiResponse(HTTPStatus.UNAUTHORIZED, message="Invalid token")
+            return response.to_response()
+        if not user["is_admin"]:
+            response = ApiResponse(HTTPStatus.FORBIDDEN, message="Admin access required")
+            return response.to_response()
+        g.user = user
+        return view(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,172 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""JSON encoding and decoding used on the serving and storage paths.
+
+The fastest installed backend is used: orjson, then msgspec, then the
+standard library. Set JSON_CODEC to "orjson", "msgspec" or "json" to force
+one. Every backend produces compact JSON.
+"""
+
+import os
+import json
+import uuid
+import datetime
+from typing import List, Optional
+from flask.json.provider import JSONProvider
+
+
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if hasattr(obj, "to_dict"):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _load_backend(name):
+    if name == "orjson":
+        import orjson
+
+        options = orjson.OPT_NON_STR_KEYS
+
+        def _orjson_dumps(obj):
+            return orjson.dumps(obj, default=_default, option=options)
+
+        return _orjson_dumps, orjson.loads
+
+    if name == "msgspec":
+        import msgspec
+
+        encoder = msgspec.json.Encoder(enc_hook=_default)
+        return encoder.encode, msgspec.json.decode
+
+    def _json_dumps(obj):
+        return json.dumps(
+            obj, default=_default, separators=(",", ":"), ensure_ascii=False
+        ).encode("utf-8")
+
+    return _json_dumps, json.loads
+
+
+def _select_backend():
+    requested = os.environ.get("JSON_CODEC")
+    candidates = [requested] if requested else ["orjson", "msgspec"]
+    for name in candidates:
+        try:
+            return (name,) + _load_backend(name)
+        except ImportError:
+            continue
+    return ("json",) + _load_backend("json")
+
+
+BACKEND, _dumps, _loads = _select_backend()
+DecodeError = ValueError  # raised by every backend on malformed input
+
+
+def dumps(obj) -> bytes:
+    """Encodes an object as UTF-8 JSON bytes."""
+    return _dumps(obj)
+
+
+def loads(data):
+    """Decodes JSON from bytes or str."""
+    return _loads(data)
+
+
+# Typed decoding of Codestral (Mistral chat completion) responses. Role-only
+# and usage chunks carry no content, so missing fields are expected and are
+# handled with defaults rather than KeyError.
+if BACKEND == "msgspec":
+    import msgspec
+
+    class _Delta(msgspec.Struct):
+        content: Optional[str] = None
+
+    class _Choice(msgspec.Struct):
+        delta: Optional[_Delta] = None
+        message: Optional[_Delta] = None
+
+    class _Completion(msgspec.Struct):
+        choices: List[_Choice] = []
+
+    _completion_decoder = msgspec.json.Decoder(_Completion)
+
+    def _choice_content(payload, field):
+        choices = _completion_decoder.decode(payload).choices
+        part = getattr(choices[0], field) if choices else None
+        return part.content if part else None
+
+else:
+
+    def _choice_content(payload, field):
+        data = _loads(payload)
+        choices = data.get("choices") if isinstance(data, dict) else None
+        part = choices[0].get(field) if choices else None
+        return part.get("content") if isinstance(part, dict) else None
+
+
+def decode_codestral_chunk(line) -> Optional[str]:
+    """Extracts the streamed content from one Codestral SSE line.
+
+    Args:
+        line: Line of the streamRawPredict response, e.g. 'data: {...}'.
+
+    Returns:
+        The content delta, or None for control lines and chunks without content.
+
+    Raises:
+        DecodeError when the line holds malformed JSON.
+    """
+    if not line.startswith("data:"):
+        return None
+    payload = line[5:].strip()
+    if not payload or payload == "[DONE]":
+        return None
+    return _choice_content(payload, "delta")
+
+
+def decode_codestral_message(body) -> Optional[str]:
+    """Extracts the content of a non-streamed Codestral response.
+
+    Args:
+        body: JSON body of the rawPredict response.
+
+    Returns:
+        The message content, or None if the response has no content.
+
+    Raises:
+        DecodeError when the body is malformed JSON.
+    """
+    return _choice_content(body, "message")
+
+
+class CodecJSONProvider(JSONProvider):
+    """
+    Flask JSON provider backed by the selected codec
+    """
+
+    mimetype = "application/json"
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
@@ -0,0 +1,267 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process counters and histograms exported in Prometheus text format.
+
+Every thread records into its own shard, so recording takes no lock. A
+scrape copies each shard (dict.copy is atomic under the GIL) and sums them.
+Shards of finished threads are folded into a retired shard.
+"""
+
+import time
+import bisect
+import functools
+import threading
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800)
+
+_metadata = {}
+_local = threading.local()
+_shards = []
+_retired = {}
+_shards_lock = threading.RLock()
+
+
+def register_counter(name, description):
+    _metadata[name] = ("counter", description, None)
+
+
+def register_histogram(name, description, buckets=LATENCY_BUCKETS):
+    _metadata[name] = ("histogram", description, tuple(buckets))
+
+
+class _Shard:
+    def __init__(self):
+        self.values = {}
+        with _shards_lock:
+            _shards.append(self.values)
+
+    def __del__(self):
+        # the owning thread finished, keep its totals
+        with _shards_lock:
+            _shards.remove(self.values)
+            _merge(_retired, self.values)
+
+
+def _values():
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+    return shard.values
+
+
+def _merge(target, values):
+    for key, value in values.items():
+        if isinstance(value, list):
+            current = target.setdefault(key, [0] * len(value))
+            for i, item in enumerate(value):
+                current[i] += item
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def increment_counter(name, value=1, **labels):
+    """Increments a counter.
+
+    Args:
+        name: Metric name, e.g. llm_generations_cancelled_total.
+        value: Amount added to the counter.
+        labels: Label values of the counter.
+    """
+    values = _values()
+    key = _key(name, labels)
+    values[key] = values.get(key, 0) + value
+
+
+def observe_histogram(name, value, **labels):
+    """Records an observation of a histogram.
+
+    Args:
+        name: Metric name, registered with register_histogram.
+        value: Observed value.
+        labels: Label values of the histogram.
+    """
+    buckets = _metadata[name][2]
+    values = _values()
+    key = _key(name, labels)
+    # bucket counts, then sum and count
+    observations = values.get(key)
+    if observations is None:
+        observations = values[key] = [0] * (len(buckets) + 2)
+    observations[bisect.bisect_left(buckets, value)] += 1
+    observations[-2] += value
+    observations[-1] += 1
+
+
+def snapshot():
+    """Returns the totals of every metric across threads."""
+    with _shards_lock:
+        shards = [values.copy() for values in _shards]
+        totals = {}
+        _merge(totals, _retired)
+    for values in shards:
+        _merge(totals, values)
+    return totals
+
+
+def get_counter(name, **labels):
+    """Returns the current value of a counter."""
+    return snapshot().get(_key(name, labels), 0)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in pairs
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def render_prometheus():
+    """Renders every metric in the Prometheus text exposition format."""
+    totals = snapshot()
+    lines = []
+    for name in sorted({key[0] for key in totals} | set(_metadata)):
+        metric_type, description, buckets = _metadata.get(name, ("counter", "", None))
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for (key_name, labels), value in sorted(totals.items(), key=str):
+            if key_name != name:
+                continue
+            if metric_type != "histogram":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), value):
+                cumulative += count
+                bucket_labels = _format_labels(labels, [("le", bound)])
+                lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-2]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {value[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+def estimate_tokens(text):
+    # providers do not report usage per chunk, ~4 characters per token
+    return max(1, len(text) // 4) if text else 0
+
+
+def instrument_stream(chunks, prefix, started=None, **labels):
+    """Records latency and throughput of a stream of message chunks.
+
+    Args:
+        chunks: Iterable of message dictionaries with a "message" text.
+        prefix: Metric name prefix, e.g. "llm" or "chat".
+        started: time.monotonic() the latency is measured from, defaults to now.
+        labels: Label values of the metrics.
+
+    Yields:
+        The chunks, unchanged.
+    """
+    started = started if started is not None else time.monotonic()
+    first_chunk_at = None
+    chunk_count = 0
+    tokens = 0
+    increment_counter(f"{prefix}_requests_total", **labels)
+    try:
+        for chunk in chunks:
+            if first_chunk_at is None:
+                first_chunk_at = time.monotonic()
+                observe_histogram(
+                    f"{prefix}_time_to_first_token_seconds",
+                    first_chunk_at - started,
+                    **labels,
+                )
+            chunk_count += 1
+            tokens += estimate_tokens(chunk.get("message", ""))
+            yield chunk
+    except Exception:
+        increment_counter(f"{prefix}_errors_total", **labels)
+        raise
+    finally:
+        finished = time.monotonic()
+        observe_histogram(f"{prefix}_duration_seconds", finished - started, **labels)
+        increment_counter(f"{prefix}_chunks_total", chunk_count, **labels)
+        increment_counter(f"{prefix}_output_tokens_total", tokens, **labels)
+        if first_chunk_at is not None and finished > first_chunk_at and tokens:
+            observe_histogram(
+                f"{prefix}_tokens_per_second",
+                tokens / (finished - first_chunk_at),
+                **labels,
+            )
+
+
+def instrumented_generation(generate_response):
+    """Decorates an LLM generate_response method with instrument_stream,
+    labelled with the llm_name attribute of the LLM class."""
+
+    @functools.wraps(generate_response)
+    def wrapper(self, *args, **kwargs):
+        chunks = (
+            response["data"][0]
+            for response in generate_response(self, *args, **kwargs)
+        )
+        for chunk in instrument_stream(chunks, "llm", llm_name=self.llm_name):
+            yield {"result": "success", "data": [chunk]}
+
+    return wrapper
+
+
+for _prefix, _subject in (("llm", "LLM provider calls"), ("chat", "chat messages")):
+    register_counter(f"{_prefix}_requests_total", f"Number of {_subject}.")
+    register_counter(f"{_prefix}_errors_total", f"Number of failed {_subject}.")
+    register_counter(f"{_prefix}_chunks_total", f"Chunks streamed by {_subject}.")
+    register_counter(
+        f"{_prefix}_output_tokens_total",
+        f"Estimated output tokens of {_subject}, 4 characters per token.",
+    )
+    register_histogram(
+        f"{_prefix}_time_to_first_token_seconds",
+        f"Time to the first chunk of {_subject}.",
+    )
+    register_histogram(
+        f"{_prefix}_duration_seconds", f"Total duration of {_subject}."
+    )
+    register_histogram(
+        f"{_prefix}_tokens_per_second",
+        f"Estimated output tokens per second of {_subject} after the first chunk.",
+        RATE_BUCKETS,
+    )
+register_counter(
+    "llm_generations_cancelled_total",
+    "Generations cancelled because the client disconnected.",
+)
+register_histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time waited for a database connection from the pool.",
+    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30),
+)
+register_counter(
+    "db_pool_checkout_timeouts_total",
+    "Checkouts that gave up waiting for a database connection.",
+)
+register_counter(
+    "db_pool_connections_opened_total", "Database connections opened by the pool."
+)
+register_counter(
+    "db_reads_total", "Read-only queries, by the primary or replica serving them."
+)
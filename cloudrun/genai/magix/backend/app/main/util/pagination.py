@@ -0,0 +1,49 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opaque cursors of keyset pagination.
+
+A cursor holds the sort key of the last row of a page, the next page starts
+after it. Clients must pass cursors back unchanged.
+"""
+
+import base64
+import binascii
+import datetime
+from app.main.util import codec
+
+
+def encode_cursor(sorted_at, row_id):
+    """Returns the cursor of the page following the row (sorted_at, row_id).
+
+    Args:
+        sorted_at: datetime the rows are sorted by.
+        row_id: Unique id breaking ties between rows sorted at the same time.
+    """
+    payload = codec.dumps([sorted_at.isoformat(), str(row_id)])
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns the (sorted_at, row_id) key of a cursor.
+
+    Raises:
+        ValueError: if the cursor was not returned by encode_cursor.
+    """
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sorted_at, row_id = codec.loads(payload)
+        return datetime.datetime.fromisoformat(sorted_at), str(row_id)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
@@ -0,0 +1,280 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Statistical profiler usable on a live instance.
+
+A sampler thread reads the stacks of the other threads with
+sys._current_frames() at a fixed interval and counts them in the collapsed
+format read by flamegraph.pl and speedscope. Allocations made during the
+profile are reported from tracemalloc, which is only tracing while a profile
+runs. A single profile runs at a time.
+"""
+
+import os
+import sys
+import time
+import uuid
+import logging
+import threading
+import tracemalloc
+import contextlib
+import contextvars
+from collections import Counter
+
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 60))
+PROFILE_INTERVAL_SECONDS = float(os.environ.get("PROFILE_INTERVAL_MS", 10)) / 1000
+PROFILE_TOP_ALLOCATIONS = int(os.environ.get("PROFILE_TOP_ALLOCATIONS", 20))
+# An armed request capture is released if no request arrives in time.
+PROFILE_CAPTURE_TTL_SECONDS = float(os.environ.get("PROFILE_CAPTURE_TTL_SECONDS", 300))
+PROFILE_CAPTURE_HEADER = "X-Profile-Capture"
+
+_active_capture = contextvars.ContextVar("active_capture", default=None)
+_lock = threading.Lock()
+_busy = None
+_captures = {}
+
+
+class ProfilerBusy(Exception):
+    """
+    Raised when a profile is requested while another one runs
+    """
+
+
+def sample_stacks(duration, interval, thread_ids=None, stop_event=None):
+    """Samples the stacks of running threads.
+
+    Args:
+        duration: Seconds to sample for.
+        interval: Seconds between samples.
+        thread_ids: Optional set of thread idents to sample, read on every
+            sample so threads can be added while sampling.
+        stop_event: Optional threading.Event ending the sampling early.
+
+    Returns:
+        Counter of collapsed stacks, "thread;outer;...;inner" -> samples.
+    """
+    stop_event = stop_event or threading.Event()
+    own_thread = threading.get_ident()
+    samples = Counter()
+    thread_names = {}
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline and not stop_event.is_set():
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread or (
+                thread_ids is not None and thread_id not in thread_ids
+            ):
+                continue
+            if thread_id not in thread_names:
+                thread_names = {
+                    thread.ident: thread.name for thread in threading.enumerate()
+                }
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                )
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, "thread").replace(";", ":"))
+            samples[";".join(reversed(stack))] += 1
+        stop_event.wait(interval)
+    return samples
+
+
+def format_collapsed(samples):
+    """Formats sampled stacks as a collapsed stack file, one "stack count" per line."""
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def _start_allocation_tracking():
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    return started, tracemalloc.take_snapshot()
+
+
+def _allocation_top(started, before, limit):
+    after = tracemalloc.take_snapshot()
+    if started:
+        tracemalloc.stop()
+    ignored = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ]
+    stats = after.filter_traces(ignored).compare_to(before.filter_traces(ignored), "lineno")
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_diff_kb": round(stat.size_diff / 1024, 1),
+            "count_diff": stat.count_diff,
+            "size_kb": round(stat.size / 1024, 1),
+        }
+        for stat in stats[:limit]
+    ]
+
+
+def _acquire(owner):
+    global _busy
+    with _lock:
+        if _busy is not None and not _busy.expired():
+            raise ProfilerBusy(f"Profile {_busy.id} is running")
+        _busy = owner
+
+
+def _release(owner):
+    global _busy
+    with _lock:
+        if _busy is owner:
+            _busy = None
+
+
+class Profile:
+    """
+    Profile of the process, or of the threads serving one request
+    """
+
+    def __init__(self, interval, top_n, thread_ids=None):
+        self.id = str(uuid.uuid4())
+        self.interval = interval
+        self.top_n = top_n
+        self.thread_ids = thread_ids
+        self.status = "armed"
+        self.armed_at = time.monotonic()
+        self.stop_event = threading.Event()
+        self.result = None
+
+    def expired(self):
+        return (
+            self.status == "armed"
+            and time.monotonic() - self.armed_at > PROFILE_CAPTURE_TTL_SECONDS
+        )
+
+    def run(self, duration):
+        self.status = "running"
+        started_at = time.monotonic()
+        try:
+            tracking_started, before = _start_allocation_tracking()
+            try:
+                samples = sample_stacks(
+                    duration, self.interval, self.thread_ids, self.stop_event
+                )
+            finally:
+                allocations = _allocation_top(tracking_started, before, self.top_n)
+            self.result = {
+                "id": self.id,
+                "duration_seconds": round(time.monotonic() - started_at, 3),
+                "samples": sum(samples.values()),
+                "collapsed": format_collapsed(samples),
+                "allocations": allocations,
+            }
+            self.status = "done"
+        except Exception as e:
+            logging.error(f"Error in profile {self.id} - {e}")
+            self.status = "failed"
+        finally:
+            _release(self)
+        return self.result
+
+    def to_dict(self):
+        return self.result or {"id": self.id, "status": self.status}
+
+
+def profile_process(duration, interval=PROFILE_INTERVAL_SECONDS, top_n=PROFILE_TOP_ALLOCATIONS):
+    """Profiles every thread of the process.
+
+    Args:
+        duration: Seconds to profile for, at most PROFILE_MAX_SECONDS.
+        interval: Seconds between stack samples.
+        top_n: Number of allocation sites reported.
+
+    Returns:
+        Dictionary with the collapsed stacks and the allocation top-N.
+
+    Raises:
+        ProfilerBusy when another profile runs.
+    """
+    profile = Profile(interval, top_n)
+    _acquire(profile)
+    return profile.run(min(duration, PROFILE_MAX_SECONDS))
+
+
+def arm_request_capture(interval=PROFILE_INTERVAL_SECONDS, top_n=PROFILE_TOP_ALLOCATIONS):
+    """Arms a profile of the next request sent with the capture id in the
+    X-Profile-Capture header.
+
+    Returns:
+        The armed profile.
+
+    Raises:
+        ProfilerBusy when another profile runs.
+    """
+    profile = Profile(interval, top_n, thread_ids=set())
+    _acquire(profile)
+    with _lock:
+        # keep the results of the last few captures
+        for capture_id in [
+            capture_id
+            for capture_id, capture in _captures.items()
+            if capture.status != "running"
+        ][:-9]:
+            del _captures[capture_id]
+        _captures[profile.id] = profile
+    return profile
+
+
+def get_capture(capture_id):
+    with _lock:
+        return _captures.get(capture_id)
+
+
+@contextlib.contextmanager
+def request_capture(capture_id):
+    """Runs the armed capture capture_id for the block serving a request.
+
+    The calling thread, and threads started with
+    tracing.run_in_current_context within the block, are sampled until the
+    profile's stop_event is set or PROFILE_MAX_SECONDS elapse.
+
+    Args:
+        capture_id: Capture id sent by the client, may be None.
+
+    Yields:
+        The profile, or None when capture_id is not armed.
+    """
+    with _lock:
+        profile = _captures.get(capture_id) if capture_id else None
+        if profile is None or profile.status != "armed" or profile.expired():
+            profile = None
+        else:
+            profile.status = "running"
+    if profile is None:
+        yield None
+        return
+    profile.thread_ids.add(threading.get_ident())
+    threading.Thread(
+        target=profile.run, args=(PROFILE_MAX_SECONDS,), daemon=True
+    ).start()
+    token = _active_capture.set(profile)
+    try:
+        yield profile
+    finally:
+        _active_capture.reset(token)
+
+
+def attach_current_thread():
+    """Adds the current thread to the capture of the context, if any."""
+    profile = _active_capture.get()
+    if profile is not None:
+        profile.thread_ids.add(threading.get_ident())
@@ -0,0 +1,134 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Opt-in recorder of anonymised request shapes, replayed by benchmarks/replay.py.
+
+Set TRAFFIC_RECORD_FILE to append one JSON line per request. Only shapes are
+kept: the route rule, sizes, the LLM selected and timings. Conversation ids
+are replaced by a keyed hash so the turns of a conversation can be grouped
+without revealing it; user emails and message texts are never written.
+"""
+
+import os
+import hmac
+import time
+import queue
+import random
+import hashlib
+import logging
+import threading
+from app.main.util import codec
+from app.main.util.streaming import SSE_MIMETYPE
+
+TRAFFIC_RECORD_FILE = os.environ.get("TRAFFIC_RECORD_FILE")
+TRAFFIC_RECORD_SAMPLE_RATIO = float(os.environ.get("TRAFFIC_RECORD_SAMPLE_RATIO", 1))
+
+_key = os.urandom(16)
+_records = queue.Queue(maxsize=10000)
+_turns = {}
+_turns_lock = threading.Lock()
+
+
+def anonymise(value):
+    """Returns a keyed hash of value, stable for the life of the process."""
+    return hmac.new(_key, value.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def request_shape(request):
+    """Describes a request without its content.
+
+    Args:
+        request: Flask request.
+
+    Returns:
+        Dictionary of the route, conversation hash and turn, and body sizes.
+    """
+    shape = {
+        "method": request.method,
+        "route": request.url_rule.rule if request.url_rule else None,
+    }
+    conversation_id = (request.view_args or {}).get("conversation_id")
+    if conversation_id:
+        shape["conversation"] = anonymise(conversation_id)
+    for arg in ("offset", "limit"):
+        if arg in request.args:
+            shape[arg] = request.args.get(arg, type=int)
+    if SSE_MIMETYPE in request.headers.get("Accept", ""):
+        shape["accept"] = SSE_MIMETYPE
+
+    body = request.get_json(silent=True) if request.is_json else None
+    if isinstance(body, dict):
+        if isinstance(body.get("message"), str):
+            shape["prompt_chars"] = len(body["message"])
+        if isinstance(body.get("llm_names"), list):
+            shape["llm_names"] = [str(name) for name in body["llm_names"]]
+        if isinstance(body.get("llm_name"), str):
+            shape["llm_name"] = body["llm_name"]
+    if shape.get("conversation") and "prompt_chars" in shape:
+        # number of messages sent to the conversation while recording
+        with _turns_lock:
+            _turns[shape["conversation"]] = _turns.get(shape["conversation"], 0) + 1
+            shape["turn"] = _turns[shape["conversation"]]
+    return shape
+
+
+def _write_loop():
+    while True:
+        records = [_records.get()]
+        while not _records.empty() and len(records) < 512:
+            records.append(_records.get_nowait())
+        try:
+            with open(TRAFFIC_RECORD_FILE, "ab") as record_file:
+                record_file.writelines(codec.dumps(record) + b"\n" for record in records)
+        except OSError as e:
+            logging.error(f"Error writing {len(records)} traffic records - {e}")
+
+
+def init_recorder(app):
+    """Records the requests of a Flask app when TRAFFIC_RECORD_FILE is set.
+
+    A request is recorded once its response is closed, so the duration of
+    streamed responses is complete.
+    """
+    if not TRAFFIC_RECORD_FILE:
+        return
+    from flask import g, request
+
+    started_at = time.time()
+    threading.Thread(target=_write_loop, daemon=True).start()
+
+    @app.before_request
+    def start_recording():
+        if random.random() < TRAFFIC_RECORD_SAMPLE_RATIO:
+            g.traffic_record = request_shape(request)
+            g.traffic_record["t"] = round(time.time() - started_at, 3)
+            g.traffic_started = time.monotonic()
+
+    @app.after_request
+    def finish_recording(response):
+        record = g.pop("traffic_record", None)
+        if record is None:
+            return response
+        request_started = g.pop("traffic_started")
+        record["status"] = response.status_code
+
+        def write():
+            record["duration_ms"] = round((time.monotonic() - request_started) * 1000, 1)
+            try:
+                _records.put_nowait(record)
+            except queue.Full:
+                pass
+
+        response.call_on_close(write)
+        return response
@@ -0,0 +1,196 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import queue
+import logging
+import threading
+import time
+from app.main.util import codec
+
+SSE_MIMETYPE = "text/event-stream"
+NDJSON_MIMETYPE = "application/json"
+
+# Flush thresholds for coalesced streams. The first chunk is always flushed
+# immediately so time-to-first-token is not affected by coalescing.
+SSE_COALESCE_BYTES = int(os.environ.get("SSE_COALESCE_BYTES", 1024))
+SSE_COALESCE_SECONDS = float(os.environ.get("SSE_COALESCE_MS", 30)) / 1000
+SSE_HEARTBEAT_SECONDS = float(os.environ.get("SSE_HEARTBEAT_SECONDS", 15))
+
+END_OF_STREAM = object()
+
+
+def format_sse_event(data, event="message", event_id=None):
+    """Formats a single Server-Sent Event.
+
+    Args:
+        data: JSON serialisable payload of the event.
+        event: Event type.
+        event_id: Optional id, echoed back by clients as Last-Event-ID.
+
+    Returns:
+        Encoded event frame.
+    """
+    frame = f"event: {event}\n"
+    if event_id is not None:
+        frame += f"id: {event_id}\n"
+    return frame.encode("utf-8") + b"data: " + codec.dumps(data) + b"\n\n"
+
+
+def format_sse_comment(comment="heartbeat"):
+    """Formats an SSE comment line, ignored by clients but keeps proxies from
+    closing an idle connection."""
+    return f": {comment}\n\n".encode("utf-8")
+
+
+def format_ndjson_line(data):
+    """Formats a payload as a newline delimited JSON line."""
+    return codec.dumps(data) + b"\n"
+
+
+def pump_to_queue(items, source):
+    """Drains an iterable into a queue, ending with END_OF_STREAM.
+
+    Args:
+        items: Iterable to consume.
+        source: Queue receiving the items.
+    """
+    try:
+        for item in items:
+            source.put(item)
+    except Exception as e:
+        logging.error(f"Error while reading message stream - {e}")
+    finally:
+        source.put(END_OF_STREAM)
+
+
+def _same_source(pending, message):
+    # chunks are merged only if they come from the same role and, for
+    # fanned-out prompts, the same LLM
+    return pending.get("role") == message.get("role") and pending.get(
+        "llm_name"
+    ) == message.get("llm_name")
+
+
+def coalesce_events(
+    poll,
+    max_bytes=SSE_COALESCE_BYTES,
+    max_delay=SSE_COALESCE_SECONDS,
+    heartbeat_interval=SSE_HEARTBEAT_SECONDS,
+):
+    """Coalesces streamed messages into SSE frames.
+
+    Consecutive messages of the same role and LLM are merged and flushed once the
+    buffered text reaches max_bytes or has waited max_delay seconds. A
+    heartbeat comment is written whenever the stream is idle for
+    heartbeat_interval seconds.
+
+    Args:
+        poll: Callable accepting a timeout and returning the next
+            (sequence, message) item or END_OF_STREAM. It raises queue.Empty
+            when nothing arrived within the timeout.
+        max_bytes: Size threshold of the buffered message text.
+        max_delay: Maximum time a chunk waits in the buffer.
+        heartbeat_interval: Idle time before a heartbeat comment is sent.
+
+    Yields:
+        Encoded SSE frames.
+    """
+    pending = None
+    pending_id = None
+    pending_size = 0
+    deadline = None
+    first_chunk = True
+    last_write = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        if pending is not None:
+            timeout = max(0, deadline - now)
+        else:
+            timeout = max(0, last_write + heartbeat_interval - now)
+
+        try:
+            item = poll(timeout=timeout)
+        except queue.Empty:
+            if pending is not None:
+                yield format_sse_event(pending, event_id=pending_id)
+                pending = None
+            else:
+                yield format_sse_comment()
+            last_write = time.monotonic()
+            continue
+
+        if item is END_OF_STREAM:
+            if pending is not None:
+                yield format_sse_event(pending, event_id=pending_id)
+            yield format_sse_event({}, event="done", event_id=pending_id)
+            return
+
+        sequence, message = item
+        if pending is not None and not _same_source(pending, message):
+            yield format_sse_event(pending, event_id=pending_id)
+            pending = None
+
+        if pending is None:
+            pending = dict(message)
+            pending_size = len(pending.get("message", ""))
+            deadline = time.monotonic() + max_delay
+        else:
+            pending["message"] += message.get("message", "")
+            pending_size += len(message.get("message", ""))
+        pending_id = sequence
+
+        if first_chunk or pending_size >= max_bytes:
+            first_chunk = False
+            yield format_sse_event(pending, event_id=pending_id)
+            pending = None
+            last_write = time.monotonic()
+
+
+def sse_stream(messages, **coalesce_options):
+    """Streams messages as coalesced Server-Sent Events.
+
+    The messages are read on a background thread so that heartbeats and
+    time based flushes are written while the LLM is still generating.
+
+    Args:
+        messages: Iterable of message dictionaries.
+        coalesce_options: Overrides for coalesce_events thresholds.
+
+    Yields:
+        Encoded SSE frames.
+    """
+    source = queue.Queue()
+    threading.Thread(
+        target=pump_to_queue, args=(enumerate(messages), source), daemon=True
+    ).start()
+    yield from coalesce_events(source.get, **coalesce_options)
+
+
+def ndjson_stream(poll):
+    """Streams (sequence, message) items as newline delimited JSON.
+
+    Args:
+        poll: Callable accepting a timeout and returning the next item or
+            END_OF_STREAM, see coalesce_events.
+
+    Yields:
+        Encoded JSON lines.
+    """
+    while True:
+        item = poll(timeout=None)
+        if item is END_OF_STREAM:
+            return
+        yield format_ndjson_line(item[1])
@@ -0,0 +1,159 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Verification of Google ID tokens against locally cached signing keys.
+
+The signing certificates are fetched once and kept for the max-age of their
+Cache-Control header; they are fetched again early only when a token is
+signed by an unknown key, as Google rotates them. Verified tokens are
+remembered until shortly before they expire, so a client sending the same
+token on every request is verified once.
+"""
+
+import os
+import time
+import base64
+import hashlib
+import logging
+import threading
+from app.main.util import codec
+from app.main.util.cache import TTLCache
+
+GOOGLE_CERTS_URL = os.environ.get(
+    "GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs"
+)
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+# Verified tokens kept, and seconds before their exp they are verified again.
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_MARGIN_SECONDS = int(os.environ.get("TOKEN_CACHE_MARGIN_SECONDS", 30))
+# Certificates lifetime when the response has no max-age.
+CERTS_DEFAULT_MAX_AGE_SECONDS = 3600
+# Tokens of unknown keys refresh the certificates at most this often.
+CERTS_MIN_REFRESH_SECONDS = 30
+CLOCK_SKEW_SECONDS = 10
+
+_certs = None
+_certs_expire_at = 0
+_certs_fetched_at = 0
+_certs_lock = threading.Lock()
+_transport = None
+_tokens = TTLCache(TOKEN_CACHE_SIZE, ttl=0)
+
+
+def max_age(headers):
+    """Returns the seconds a response may be cached from its Cache-Control and
+    Age headers, None without max-age."""
+    headers = {name.lower(): value for name, value in headers.items()}
+    for directive in headers.get("cache-control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.isdigit():
+            age = headers.get("age", "0")
+            return max(0, int(value) - (int(age) if age.isdigit() else 0))
+    return None
+
+
+def fetch_certs():
+    """Fetches the signing certificates.
+
+    Returns:
+        Tuple of the dictionary of key id to PEM certificate, and the seconds
+        they may be cached.
+    """
+    global _transport
+    if _transport is None:
+        from google.auth.transport import requests as google_requests
+
+        # one session, so the connection to the certificates server is reused
+        _transport = google_requests.Request()
+    response = _transport(GOOGLE_CERTS_URL, method="GET")
+    if response.status != 200:
+        raise ValueError(
+            f"Could not fetch certificates at {GOOGLE_CERTS_URL}: {response.status}"
+        )
+    age = max_age(response.headers)
+    return codec.loads(response.data), CERTS_DEFAULT_MAX_AGE_SECONDS if age is None else age
+
+
+def get_certs(kid=None):
+    """Returns the cached certificates, fetching them when they expired or,
+    at most every CERTS_MIN_REFRESH_SECONDS, when kid is unknown."""
+    global _certs, _certs_expire_at, _certs_fetched_at
+    now = time.monotonic()
+    certs = _certs
+    if certs is not None and now < _certs_expire_at and (kid is None or kid in certs):
+        return certs
+    with _certs_lock:
+        now = time.monotonic()
+        expired = _certs is None or now >= _certs_expire_at
+        rotated = (
+            not expired
+            and kid is not None
+            and kid not in _certs
+            and now - _certs_fetched_at >= CERTS_MIN_REFRESH_SECONDS
+        )
+        if expired or rotated:
+            certs, lifetime = fetch_certs()
+            _certs, _certs_expire_at, _certs_fetched_at = certs, now + lifetime, now
+            logging.info(f"Fetched {len(certs)} token signing certificates for {lifetime}s")
+        return _certs
+
+
+def _unverified_kid(token):
+    try:
+        header = token.split(".", 1)[0]
+        padded = header + "=" * (-len(header) % 4)
+        return codec.loads(base64.urlsafe_b64decode(padded)).get("kid")
+    except (AttributeError, ValueError):
+        raise ValueError("Malformed token")
+
+
+def verify(token, audience):
+    """Verifies a Google ID token offline.
+
+    Args:
+        token: Encoded ID token.
+        audience: OAuth client id the token must be issued for.
+
+    Returns:
+        The claims of the token.
+
+    Raises:
+        ValueError: if the token is malformed, expired, not signed by Google or
+            not issued for audience.
+    """
+    if isinstance(token, bytes):
+        token = token.decode("utf-8")
+    key = hashlib.sha256(f"{audience}\n{token}".encode("utf-8")).hexdigest()
+    claims = _tokens.get(key)
+    if claims is not None:
+        return claims
+
+    from google.auth import jwt
+
+    certs = get_certs(_unverified_kid(token))
+    claims = jwt.decode(
+        token, certs=certs, audience=audience, clock_skew_in_seconds=CLOCK_SKEW_SECONDS
+    )
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {claims.get('iss')}")
+    _tokens.set(key, claims, ttl=claims["exp"] - time.time() - TOKEN_CACHE_MARGIN_SECONDS)
+    return claims
+
+
+def clear():
+    """Forgets the cached certificates and verified tokens."""
+    global _certs
+    with _certs_lock:
+        _certs = None
+    _tokens.clear()
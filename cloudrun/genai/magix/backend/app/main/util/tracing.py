@@ -0,0 +1,315 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request tracing with W3C trace context propagation.
+
+Spans of sampled traces are exported in batches on a background thread, as
+OTLP/HTTP JSON to OTEL_EXPORTER_OTLP_ENDPOINT (e.g. a local collector on
+http://localhost:4318) and/or as JSON lines to TRACE_EXPORT_FILE.
+TRACE_SAMPLE_RATIO sets the share of new traces that are sampled; incoming
+traceparent headers keep the caller's sampling decision.
+"""
+
+import os
+import re
+import time
+import queue
+import random
+import logging
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+from app.main.util import codec, profiler
+
+TRACE_SAMPLE_RATIO = float(os.environ.get("TRACE_SAMPLE_RATIO", 0))
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE")
+OTEL_EXPORTER_OTLP_ENDPOINT = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
+TRACE_SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME", "magix-backend")
+TRACE_EXPORT_INTERVAL_SECONDS = 2
+TRACE_EXPORT_QUEUE_SIZE = 10000
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_export_queue = queue.Queue(maxsize=TRACE_EXPORT_QUEUE_SIZE)
+_exporter_lock = threading.Lock()
+_exporter_started = False
+
+
+class Span:
+    """
+    Timed operation of a trace
+    """
+
+    def __init__(self, name, trace_id, parent_id=None, sampled=False, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.attributes = attributes or {}
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if self.sampled:
+            _export(self)
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+def _new_span(name, attributes=None, parent=None):
+    parent = parent or _current_span.get()
+    if parent is not None:
+        return Span(name, parent.trace_id, parent.span_id, parent.sampled, attributes)
+    sampled = TRACE_SAMPLE_RATIO > 0 and random.random() < TRACE_SAMPLE_RATIO
+    return Span(name, "%032x" % random.getrandbits(128), None, sampled, attributes)
+
+
+def current_span():
+    return _current_span.get()
+
+
+@contextlib.contextmanager
+def start_span(name, **attributes):
+    """Runs a block of code in a child span of the current span.
+
+    Args:
+        name: Span name, e.g. "sql.get_conversation".
+        attributes: Span attributes.
+
+    Yields:
+        The span.
+    """
+    span = _new_span(name, attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+def traced(name):
+    """Decorates a function, or generator function, to run in a span.
+
+    A generator's span lasts until it is exhausted or closed. It is the
+    current span only while the generator runs, as a generator may be
+    resumed from another context between items.
+    """
+
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                span = _new_span(name)
+                generator = func(*args, **kwargs)
+                try:
+                    while True:
+                        token = _current_span.set(span)
+                        try:
+                            item = next(generator)
+                        except StopIteration as stop:
+                            return stop.value
+                        finally:
+                            _current_span.reset(token)
+                        yield item
+                except Exception as e:
+                    span.error = f"{type(e).__name__}: {e}"
+                    raise
+                finally:
+                    generator.close()
+                    span.end()
+
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with start_span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def run_in_current_context(target):
+    """Wraps a thread target so it runs with the caller's trace context, and
+    is sampled by the caller's profile capture, if any."""
+    context = contextvars.copy_context()
+
+    def attached_target(*args, **kwargs):
+        profiler.attach_current_thread()
+        return target(*args, **kwargs)
+
+    def run(*args, **kwargs):
+        # a context can only be entered by one thread at a time
+        return context.copy().run(attached_target, *args, **kwargs)
+
+    return run
+
+
+def _export(span):
+    global _exporter_started
+    if not (TRACE_EXPORT_FILE or OTEL_EXPORTER_OTLP_ENDPOINT):
+        return
+    if not _exporter_started:
+        with _exporter_lock:
+            if not _exporter_started:
+                threading.Thread(target=_export_loop, daemon=True).start()
+                _exporter_started = True
+    try:
+        _export_queue.put_nowait(span)
+    except queue.Full:
+        # never slow down requests because the collector is behind
+        pass
+
+
+def _export_batch(spans):
+    if TRACE_EXPORT_FILE:
+        with open(TRACE_EXPORT_FILE, "ab") as trace_file:
+            trace_file.writelines(codec.dumps(span.to_dict()) + b"\n" for span in spans)
+    if OTEL_EXPORTER_OTLP_ENDPOINT:
+        import httpx
+
+        payload = {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": TRACE_SERVICE_NAME},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "app.main.util.tracing"},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        httpx.post(
+            OTEL_EXPORTER_OTLP_ENDPOINT.rstrip("/") + "/v1/traces",
+            content=codec.dumps(payload),
+            headers={"Content-Type": "application/json"},
+            timeout=5,
+        )
+
+
+def _export_loop():
+    while True:
+        spans = [_export_queue.get()]
+        deadline = time.monotonic() + TRACE_EXPORT_INTERVAL_SECONDS
+        while len(spans) < 512:
+            try:
+                spans.append(_export_queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            _export_batch(spans)
+        except Exception as e:
+            logging.error(f"Error exporting {len(spans)} spans - {e}")
+
+
+def init_tracing(app):
+    """Starts a server span for every request of a Flask app.
+
+    The span continues the trace of an incoming traceparent header and ends
+    when the response is closed, so streamed responses are fully covered.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request_span():
+        parent = None
+        match = TRACEPARENT.match(request.headers.get("traceparent", ""))
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            parent = Span("remote", trace_id, sampled=int(flags, 16) & 1 == 1)
+            parent.span_id = parent_id
+        rule = request.url_rule.rule if request.url_rule else request.path
+        span = _new_span(
+            f"{request.method} {rule}",
+            {"http.method": request.method, "http.route": rule},
+            parent,
+        )
+        g.trace_span = span
+        g.trace_token = _current_span.set(span)
+
+    @app.after_request
+    def end_request_span(response):
+        span = g.pop("trace_span", None)
+        if span is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            response.headers["traceparent"] = (
+                f"00-{span.trace_id}-{span.span_id}-{'01' if span.sampled else '00'}"
+            )
+            response.call_on_close(span.end)
+        return response
+
+    @app.teardown_request
+    def reset_request_span(exception=None):
+        token = g.pop("trace_token", None)
+        if token is not None:
+            _current_span.reset(token)
+        span = g.pop("trace_span", None)
+        if span is not None:
+            # after_request did not run, the request failed
+            span.error = repr(exception)
+            span.end()
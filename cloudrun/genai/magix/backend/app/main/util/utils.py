@@ -12,9 +12,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
 import logging
-from google.cloud import storage
+from app.main.util import codec
+from app.main.util.tracing import traced
+
+
+# Requests of one batch request, at most 100 for the JSON API.
+GCS_BATCH_SIZE = 100
+
+
+def get_storage_client():
+    """Returns a Cloud Storage client, importing the SDK on first use."""
+    from google.cloud import storage
+
+    return storage.Client()
 
 
 # # Example usage
@@ -24,6 +35,7 @@ from google.cloud import storage
 # file_name = "my-file"
 
 
+@traced("gcs.read")
 def get_file_from_gcs(
     conversation_id,
     file_name="message",
@@ -45,14 +57,14 @@ def get_file_from_gcs(
     blob_name = f"{user_email}/{conversation_id}/{file_name}.json"
 
     try:
-        storage_client = storage.Client()
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
         if not blob.exists():
             logging.error(f"File not found: gs://{bucket_name}/{blob_name}")
             return {}
         file_content_string = blob.download_as_string()
-        file_content_dict = json.loads(file_content_string)
+        file_content_dict = codec.loads(file_content_string)
         return file_content_dict
 
     except Exception as e:
@@ -68,6 +80,7 @@ def get_file_from_gcs(
 # json_data = {"message": "Hello from the JSON file!"}
 
 
+@traced("gcs.write")
 def write_file_to_gcs(
     conversation_id,
     data,
@@ -92,10 +105,10 @@ def write_file_to_gcs(
     blob_name = f"{user_email}/{conversation_id}/{file_name}.json"
 
     try:
-        storage_client = storage.Client()
+        storage_client = get_storage_client()
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(blob_name)
-        blob.upload_from_string(json.dumps(data), content_type="application/json")
+        blob.upload_from_string(codec.dumps(data), content_type="application/json")
         logging.info(f"JSON data uploaded to: gs://{bucket_name}/{blob_name}")
         return {
             "message": f"JSON data uploaded to: gs://{bucket_name}/{blob_name}"
@@ -114,6 +127,7 @@ def write_file_to_gcs(
 # prefix = f"{user_email}/"  # Construct the path
 
 
+@traced("gcs.list_folders")
 def list_folders_in_gcs(
     bucket_name="navi-store", prefix="user@example.com/", delimiter="/"
 ):
@@ -123,7 +137,7 @@ def list_folders_in_gcs(
         bucket_name: Name of the GCS bucket.
         prefix: Path prefix to search for folders.
     """
-    storage_client = storage.Client()  # Uses default credentials
+    storage_client = get_storage_client()  # Uses default credentials
     blobs = storage_client.list_blobs(bucket_name, prefix=prefix, delimiter=delimiter)
     # running to consume blobs object, else prefixes can not be iterated
     for blob in blobs:
@@ -135,3 +149,98 @@ def list_folders_in_gcs(
             folders.append(prefix.split("/")[1])
     # print("List of conversation folders in GCS - ", folders)
     return folders
+
+
+@traced("gcs.write_blob")
+def write_blob_to_gcs(
+    blob_name, payload, content_type="application/json", bucket_name="navi-store"
+):
+    """Writes raw bytes or text to a GCS object.
+
+    Args:
+        blob_name: Full object name, e.g. user_email/batches/job_id/results-00001.ndjson
+        payload: Content of the object.
+        content_type: Content type of the object.
+        bucket_name: Name of the GCS bucket.
+
+    Returns:
+        True if the object was written, False otherwise.
+    """
+    try:
+        storage_client = get_storage_client()
+        bucket = storage_client.bucket(bucket_name)
+        bucket.blob(blob_name).upload_from_string(payload, content_type=content_type)
+        return True
+
+    except Exception as e:
+        logging.error(f"An error occurred while writing {blob_name} file to GCS: {e}")
+        return False
+
+
+@traced("gcs.read_blob")
+def get_blob_from_gcs(blob_name, bucket_name="navi-store"):
+    """Reads a GCS object as bytes.
+
+    Args:
+        blob_name: Full object name.
+        bucket_name: Name of the GCS bucket.
+
+    Returns:
+        The content of the object, or None if it does not exist or can not be read.
+    """
+    try:
+        storage_client = get_storage_client()
+        bucket = storage_client.bucket(bucket_name)
+        blob = bucket.blob(blob_name)
+        if not blob.exists():
+            return None
+        return blob.download_as_bytes()
+
+    except Exception as e:
+        logging.error(f"An error occurred while reading {blob_name} file from GCS: {e}")
+        return None
+
+
+@traced("gcs.list_blobs")
+def list_blobs_in_gcs(prefix, bucket_name="navi-store"):
+    """Lists the objects under a prefix.
+
+    Args:
+        prefix: Path prefix, e.g. user_email/conversation_id/
+        bucket_name: Name of the GCS bucket.
+
+    Returns:
+        The names of the objects.
+    """
+    storage_client = get_storage_client()
+    return [blob.name for blob in storage_client.list_blobs(bucket_name, prefix=prefix)]
+
+
+@traced("gcs.delete_blobs")
+def delete_blobs_in_gcs(blob_names, bucket_name="navi-store"):
+    """Deletes objects with a single batch request.
+
+    Args:
+        blob_names: Full object names, at most GCS_BATCH_SIZE.
+        bucket_name: Name of the GCS bucket.
+
+    Returns:
+        The names of the objects that could not be deleted. Objects that do
+        not exist count as deleted.
+    """
+    if not blob_names:
+        return []
+    storage_client = get_storage_client()
+    bucket = storage_client.bucket(bucket_name)
+    try:
+        with storage_client.batch(raise_exception=False) as batch:
+            for blob_name in blob_names:
+                bucket.blob(blob_name).delete()
+    except Exception as e:
+        logging.error(f"An error occurred while deleting {len(blob_names)} files from GCS: {e}")
+        return list(blob_names)
+    return [
+        blob_name
+        for blob_name, response in zip(blob_names, batch._responses)
+        if not 200 <= response.status_code < 300 and response.status_code != 404
+    ]
@@ -0,0 +1,111 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmarks of the JSON call sites for every installed codec backend.
+
+Usage:
+    python -m benchmarks.bench_codec --number 20000
+"""
+
+import argparse
+import json
+import timeit
+import uuid
+from app.main.util import codec
+
+STREAM_CHUNK = {"role": "system", "message": "def fibonacci(n):"}
+HISTORY = [
+    {"role": "user" if i % 2 == 0 else "system", "message": "lorem ipsum " * 40}
+    for i in range(200)
+]
+API_RESPONSE = {
+    "data": [
+        {
+            "id": str(uuid.uuid4()),
+            "user_email": "user@example.com",
+            "title": "Untitled Chat",
+            "llm_name": "Gemini",
+            "llm_params": {"temp": 0.1, "max_tokens": 1000},
+        }
+        for _ in range(50)
+    ],
+    "message": None,
+}
+CODESTRAL_LINES = [
+    'data: {"id":"1","choices":[{"index":0,"delta":{"role":"assistant"}}]}',
+    'data: {"id":"1","choices":[{"index":0,"delta":{"content":"print"}}]}',
+    'data: {"id":"1","choices":[],"usage":{"total_tokens":12}}',
+    "data: [DONE]",
+]
+
+
+def legacy_extract_streamed_content(chunk):
+    # the json.loads/KeyError based extraction used before the codec
+    if chunk.strip() == "data: [DONE]":
+        return None
+    try:
+        return json.loads(chunk[5:])["choices"][0]["delta"]["content"]
+    except (json.JSONDecodeError, KeyError, IndexError):
+        return None
+
+
+def installed_backends():
+    backends = {}
+    for name in ("json", "orjson", "msgspec"):
+        try:
+            backends[name] = codec._load_backend(name)
+        except ImportError:
+            continue
+    return backends
+
+
+def report(site, name, seconds, number):
+    print(f"{site:28} {name:10} {seconds / number * 1e6:9.2f} us/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+    number = args.number
+    history_bytes = json.dumps(HISTORY).encode("utf-8")
+
+    def bench(site, name, func, number):
+        report(site, name, timeit.timeit(func, number=number), number)
+
+    for name, (dumps, loads) in installed_backends().items():
+        bench("stream chunk dumps", name, lambda: dumps(STREAM_CHUNK), number)
+        bench("history loads", name, lambda: loads(history_bytes), number // 100)
+        bench("history dumps", name, lambda: dumps(HISTORY), number // 100)
+        bench("api response dumps", name, lambda: dumps(API_RESPONSE), number // 10)
+
+    def decode_lines(extract):
+        for line in CODESTRAL_LINES:
+            extract(line)
+
+    bench(
+        "codestral chunk decode",
+        "legacy",
+        lambda: decode_lines(legacy_extract_streamed_content),
+        number,
+    )
+    bench(
+        "codestral chunk decode",
+        codec.BACKEND,
+        lambda: decode_lines(codec.decode_codestral_chunk),
+        number,
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares OFFSET and keyset (cursor) pages of a user's conversation list.
+
+Fills the conversation table with --rows conversations, 90% of them of one
+user, then reads pages at increasing depths both ways through the service
+functions. Keyset pages should take the same time at any depth.
+
+Usage:
+    python -m benchmarks.bench_pagination --rows 1000000
+    python -m benchmarks.bench_pagination --database-url postgresql+pg8000://...
+"""
+
+import argparse
+import datetime
+import statistics
+import time
+import uuid
+import sqlalchemy
+
+USER_EMAIL = "bench@example.com"
+PAGE_DEPTHS = (0, 10, 100, 1000, 10000, 40000)
+
+
+def fill(engine, rows, batch_size=10000):
+    from app.main.model.conversation import ConversationSQL
+
+    table = ConversationSQL.__table__
+    started_at = datetime.datetime(2024, 1, 1)
+    with engine.begin() as connection:
+        if connection.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(table)).scalar():
+            return
+        for start in range(0, rows, batch_size):
+            connection.execute(
+                table.insert(),
+                [
+                    {
+                        "id": str(uuid.UUID(int=index)),
+                        "user_email": USER_EMAIL if index % 10 else f"user{index % 1000}@example.com",
+                        "title": f"Chat {index}",
+                        "llm_name": "Gemini",
+                        "llm_params": {},
+                        # every other conversation active in the same second
+                        "created_at": started_at + datetime.timedelta(seconds=index // 2),
+                        "last_message_at": started_at + datetime.timedelta(seconds=index // 2),
+                    }
+                    for index in range(start, min(start + batch_size, rows))
+                ],
+            )
+
+
+def cursor_at(engine, offset):
+    """Cursor of the page starting at offset, as a client scrolling there holds."""
+    from app.main.model.conversation import ConversationSQL
+    from app.main.util.pagination import encode_cursor
+
+    if offset == 0:
+        return None
+    table = ConversationSQL.__table__
+    with engine.connect() as connection:
+        row = connection.execute(
+            sqlalchemy.select(table.c.last_message_at, table.c.id)
+            .where(table.c.user_email == USER_EMAIL)
+            .order_by(table.c.last_message_at.desc(), table.c.id)
+            .offset(offset - 1)
+            .limit(1)
+        ).first()
+    return encode_cursor(row.last_message_at, row.id) if row else None
+
+
+def timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite database")
+    args = parser.parse_args()
+
+    from benchmarks.fakes import create_fake_engine
+    from app.main.service.conversation_service import (
+        get_user_conversations,
+        get_user_conversations_page,
+    )
+
+    engine = create_fake_engine(args.database_url)
+    started = time.perf_counter()
+    fill(engine, args.rows)
+    print(f"filled {args.rows} conversations in {time.perf_counter() - started:.1f}s")
+
+    user_rows = args.rows - (args.rows + 9) // 10
+    print(f"{'page':>7} {'offset_ms':>10} {'keyset_ms':>10}")
+    for page in PAGE_DEPTHS:
+        offset = page * args.page_size
+        if offset >= user_rows:
+            break
+        cursor = cursor_at(engine, offset)
+        offset_ms = timed(
+            lambda: get_user_conversations(USER_EMAIL, offset, args.page_size), args.repeat
+        )
+        keyset_ms = timed(
+            lambda: get_user_conversations_page(USER_EMAIL, args.page_size, cursor),
+            args.repeat,
+        )
+        print(f"{page:7d} {offset_ms:10.2f} {keyset_ms:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
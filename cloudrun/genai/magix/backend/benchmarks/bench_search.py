@@ -0,0 +1,131 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures full-text search of a user's conversations.
+
+Fills the message_search table with --rows messages, 90% of them of one user
+spread over --rows / 100 conversations, then times pages of queries of
+common, rare and absent words through search_conversations. Run it against
+Postgres, where the GIN indexes are used; SQLite scans the table.
+
+Usage:
+    python -m benchmarks.bench_search --rows 1000000 --database-url postgresql+pg8000://...
+"""
+
+import argparse
+import random
+import statistics
+import time
+import uuid
+import sqlalchemy
+
+USER_EMAIL = "bench@example.com"
+WORDS = (
+    "python java rust function class module error exception test deploy "
+    "database index query cache thread queue stream token model prompt"
+).split()
+QUERIES = {
+    "common": "python",
+    "two_words": "database index",
+    "phrase": '"stream token"',
+    "rare": "zeppelin",
+    "absent": "xylophone",
+}
+
+
+def fill(engine, rows, batch_size=10000):
+    from app.main.model.conversation import ConversationSQL
+    from app.main.model.search import MessageSearchSQL
+
+    conversations, messages = ConversationSQL.__table__, MessageSearchSQL.__table__
+    with engine.begin() as connection:
+        if connection.execute(sqlalchemy.select(sqlalchemy.func.count()).select_from(messages)).scalar():
+            return
+        conversation_ids = [str(uuid.UUID(int=index)) for index in range(max(1, rows // 100))]
+        connection.execute(
+            conversations.insert(),
+            [
+                {
+                    "id": conversation_id,
+                    "user_email": USER_EMAIL if index % 10 else f"user{index}@example.com",
+                    "title": " ".join(random.sample(WORDS, 3)),
+                    "llm_name": "Gemini",
+                    "llm_params": {},
+                }
+                for index, conversation_id in enumerate(conversation_ids)
+            ],
+        )
+        for start in range(0, rows, batch_size):
+            batch = []
+            for index in range(start, min(start + batch_size, rows)):
+                conversation_index = index % len(conversation_ids)
+                words = random.choices(WORDS, k=40)
+                if index % 10000 == 1:
+                    words.append("zeppelin")
+                batch.append(
+                    {
+                        "conversation_id": conversation_ids[conversation_index],
+                        "user_email": USER_EMAIL if conversation_index % 10 else f"user{conversation_index}@example.com",
+                        "role": "user" if index % 2 else "system",
+                        "message": " ".join(words),
+                    }
+                )
+            connection.execute(messages.insert(), batch)
+
+
+def timed(function, repeat):
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database-url", help="defaults to a temporary SQLite database")
+    args = parser.parse_args()
+
+    from benchmarks.fakes import create_fake_engine
+    from app.main.service.search_service import search_conversations
+
+    random.seed(0)
+    engine = create_fake_engine(args.database_url)
+    started = time.perf_counter()
+    fill(engine, args.rows)
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.text("ANALYZE message_search"))
+    print(f"filled {args.rows} messages in {time.perf_counter() - started:.1f}s")
+
+    print(f"{'query':>10} {'page':>5} {'hits':>5} {'ms':>9}")
+    for name, query in QUERIES.items():
+        for page in (0, 10):
+            milliseconds, result = timed(
+                lambda: search_conversations(
+                    USER_EMAIL, query, args.page_size, page * args.page_size
+                ),
+                args.repeat,
+            )
+            print(f"{name:>10} {page:5d} {len(result['hits']):5d} {milliseconds:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
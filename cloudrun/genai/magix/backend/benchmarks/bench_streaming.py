@@ -0,0 +1,79 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares per-chunk NDJSON framing with coalesced SSE framing.
+
+Usage:
+    python -m benchmarks.bench_streaming --chunks 2000 --chunk-delay-ms 0.5
+"""
+
+import argparse
+import time
+from app.main.util.streaming import format_ndjson_line, sse_stream
+
+
+def fake_llm_stream(chunks, chunk_size, chunk_delay):
+    token = "x" * chunk_size
+    for _ in range(chunks):
+        if chunk_delay:
+            time.sleep(chunk_delay)
+        yield {"role": "system", "message": token}
+
+
+def run_stream(name, frames, chunks):
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    first_frame_at = None
+    writes = 0
+    total_bytes = 0
+    for frame in frames:
+        if first_frame_at is None:
+            first_frame_at = time.perf_counter()
+        writes += 1
+        total_bytes += len(frame)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    print(
+        f"{name:8} writes={writes:6d} bytes={total_bytes:8d} "
+        f"ttfb={(first_frame_at - started) * 1000:7.2f}ms "
+        f"wall={elapsed * 1000:8.1f}ms cpu={cpu * 1000:8.1f}ms "
+        f"throughput={chunks / elapsed:9.1f} chunks/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--chunk-size", type=int, default=8)
+    parser.add_argument("--chunk-delay-ms", type=float, default=0.5)
+    args = parser.parse_args()
+    delay = args.chunk_delay_ms / 1000
+
+    run_stream(
+        "ndjson",
+        (
+            format_ndjson_line(chunk)
+            for chunk in fake_llm_stream(args.chunks, args.chunk_size, delay)
+        ),
+        args.chunks,
+    )
+    run_stream(
+        "sse",
+        sse_stream(fake_llm_stream(args.chunks, args.chunk_size, delay)),
+        args.chunks,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures ID token verifications per second against a local key server.
+
+sdk verifies every token with id_token.verify_token, fetching the
+certificates each time, as user_service used to; cached_keys verifies distinct
+tokens with the cached certificates of token_verifier; memoised verifies the
+same token again, as a client sends it on every request.
+
+Usage:
+    python -m benchmarks.bench_tokens --tokens 2000
+"""
+
+import argparse
+import time
+
+
+def run(name, verify, tokens, cert_requests):
+    fetched = cert_requests()
+    started = time.perf_counter()
+    for token in tokens:
+        assert verify(token)["email"]
+    elapsed = time.perf_counter() - started
+    print(
+        f"{name:12} {len(tokens) / elapsed:10.0f}/s "
+        f"{elapsed / len(tokens) * 1e6:9.1f}us/token "
+        f"cert_fetches={cert_requests() - fetched}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--tokens", type=int, default=2000)
+    args = parser.parse_args()
+
+    from google.auth.transport import requests as google_requests
+    from google.oauth2 import id_token
+    from benchmarks.fakes import FakeTokenIssuer
+    from app.main.util import token_verifier
+
+    issuer = FakeTokenIssuer()
+    token_verifier.GOOGLE_CERTS_URL = issuer.serve()
+    tokens = [issuer.token(f"user{index}@example.com") for index in range(args.tokens)]
+    sdk_tokens = tokens[: max(1, args.tokens // 10)]
+
+    run(
+        "sdk",
+        lambda token: id_token.verify_token(
+            token,
+            google_requests.Request(),
+            issuer.audience,
+            certs_url=token_verifier.GOOGLE_CERTS_URL,
+        ),
+        sdk_tokens,
+        lambda: issuer.cert_requests,
+    )
+    run(
+        "cached_keys",
+        lambda token: token_verifier.verify(token, issuer.audience),
+        tokens,
+        lambda: issuer.cert_requests,
+    )
+    run(
+        "memoised",
+        lambda token: token_verifier.verify(token, issuer.audience),
+        [tokens[0]] * args.tokens,
+        lambda: issuer.cert_requests,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process stand-ins for Cloud Storage, Cloud SQL, the LLM providers and
+the issuer of Google ID tokens.
+
+install_fakes() must run before the first request, as the database engine is
+created on first use.
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import sqlalchemy
+from sqlalchemy.ext.compiler import compiles
+from google.api_core.exceptions import NotFound
+
+
+@compiles(sqlalchemy.UUID, "sqlite")
+def compile_sqlite_uuid(type_, compiler, **kwargs):
+    # a column declared as UUID has numeric affinity in SQLite
+    return "CHAR(32)"
+
+
+class FakeBlob:
+    """
+    Object of a FakeStorageClient bucket
+    """
+
+    def __init__(self, client, bucket_name, name):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.name = name
+
+    @property
+    def key(self):
+        return (self.bucket_name, self.name)
+
+    def exists(self):
+        self.client.wait()
+        return self.key in self.client.objects
+
+    def upload_from_string(self, data, content_type=None):
+        self.client.wait()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.client.lock:
+            self.client.objects[self.key] = bytes(data)
+
+    def download_as_bytes(self):
+        self.client.wait()
+        try:
+            return self.client.objects[self.key]
+        except KeyError:
+            raise NotFound(f"gs://{self.bucket_name}/{self.name}")
+
+    download_as_string = download_as_bytes
+
+    def download_as_text(self):
+        return self.download_as_bytes().decode("utf-8")
+
+    def delete(self):
+        batch = getattr(self.client.batches, "current", None)
+        if batch is not None:
+            batch.deferred.append(self)
+            return
+        self.client.wait()
+        self._delete()
+
+    def _delete(self):
+        with self.client.lock:
+            if self.client.objects.pop(self.key, None) is None:
+                raise NotFound(f"gs://{self.bucket_name}/{self.name}")
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def blob(self, name):
+        return FakeBlob(self.client, self.name, name)
+
+
+class FakeBlobIterator:
+    """
+    Result of list_blobs, prefixes are known once it has been iterated
+    """
+
+    def __init__(self, blobs, prefixes):
+        self.blobs = blobs
+        self.prefixes = set()
+        self._prefixes = prefixes
+
+    def __iter__(self):
+        yield from self.blobs
+        self.prefixes = self._prefixes
+
+
+class FakeBatch:
+    """
+    Batch request of a FakeStorageClient, deletes are sent together on exit
+    """
+
+    def __init__(self, client, raise_exception=True):
+        self.client = client
+        self.raise_exception = raise_exception
+        self.deferred = []
+        self._responses = []
+
+    def __enter__(self):
+        self.client.batches.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.batches.current = None
+        if exc_type is not None:
+            return
+        self.client.wait()
+        for blob in self.deferred:
+            try:
+                blob._delete()
+                status_code = 204
+            except NotFound:
+                if self.raise_exception:
+                    raise
+                status_code = 404
+            self._responses.append(types.SimpleNamespace(status_code=status_code))
+
+
+class FakeStorageClient:
+    """
+    Thread safe in-memory replacement of google.cloud.storage.Client
+    """
+
+    def __init__(self, latency=0):
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.latency = latency
+        # the client is shared by every thread, batches are not
+        self.batches = threading.local()
+
+    def __call__(self, *args, **kwargs):
+        # used as the storage.Client class, every client shares the objects
+        return self
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def bucket(self, name):
+        return FakeBucket(self, name)
+
+    def batch(self, raise_exception=True):
+        return FakeBatch(self, raise_exception)
+
+    def list_blobs(self, bucket_name, prefix="", delimiter=None):
+        self.wait()
+        with self.lock:
+            names = sorted(
+                name
+                for bucket, name in self.objects
+                if bucket == bucket_name and name.startswith(prefix or "")
+            )
+        blobs, prefixes = [], set()
+        for name in names:
+            rest = name[len(prefix or ""):]
+            if delimiter and delimiter in rest:
+                prefixes.add((prefix or "") + rest.split(delimiter)[0] + delimiter)
+            else:
+                blobs.append(FakeBlob(self, bucket_name, name))
+        return FakeBlobIterator(blobs, prefixes)
+
+
+class FakeLLM:
+    """
+    Streaming LLM with a fixed time to first token and token rate
+    """
+
+    llm_name = "Fake"
+
+    def __init__(self, ttft=0.05, tokens_per_second=200, tokens=20):
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+
+    def generate_response(self, context, prompt, params, stream=True, cancel_event=None):
+        time.sleep(self.ttft)
+        if not stream:
+            time.sleep(self.tokens / self.tokens_per_second)
+            message = "Title: Benchmark chat" if "Title:" in prompt else "tok " * self.tokens
+            yield {"result": "success", "data": [{"role": "system", "message": message}]}
+            return
+        for index in range(self.tokens):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if index:
+                time.sleep(1 / self.tokens_per_second)
+            yield {"result": "success", "data": [{"role": "system", "message": "tok "}]}
+
+
+class FakeTokenIssuer:
+    """
+    Signs Google-like ID tokens with a local RSA key and serves its certificate
+    """
+
+    def __init__(self, audience="bench-client", key_id="bench-key"):
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from google.auth import crypt
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        private_pem = key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        self.public_pem = key.public_key().public_bytes(
+            serialization.Encoding.PEM,
+            serialization.PublicFormat.SubjectPublicKeyInfo,
+        ).decode("ascii")
+        self.signer = crypt.RSASigner.from_string(private_pem, key_id)
+        self.audience = audience
+        self.key_id = key_id
+        self.cert_requests = 0
+
+    def certs(self):
+        return {self.key_id: self.public_pem}
+
+    def token(self, email="user@example.com", lifetime=3600, **claims):
+        from google.auth import jwt
+
+        now = int(time.time())
+        payload = {
+            "iss": "https://accounts.google.com",
+            "aud": self.audience,
+            "sub": email,
+            "email": email,
+            "iat": now,
+            "exp": now + lifetime,
+        }
+        payload.update(claims)
+        return jwt.encode(self.signer, payload).decode("ascii")
+
+    def serve(self, max_age=3600):
+        """Serves the certificate on localhost, returns its URL."""
+        issuer = self
+
+        class CertsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                issuer.cert_requests += 1
+                body = json.dumps(issuer.certs()).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", f"public, max-age={max_age}")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), CertsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{server.server_port}/oauth2/v1/certs"
+
+
+def create_fake_engine(database_url=None):
+    """Points the shared engine at database_url, or at a temporary SQLite
+    file, and migrates it."""
+    import db.config
+    import db.migrate
+
+    if database_url is None:
+        path = os.path.join(tempfile.mkdtemp(prefix="magix-bench-"), "bench.db")
+        database_url = f"sqlite:///{path}"
+    os.environ["DATABASE_URL"] = database_url
+    engine = db.config.get_engine()
+    db.migrate.upgrade(engine)
+    return engine
+
+
+def install_fakes(database_url=None, gcs_latency=0, llm=None):
+    """Routes the app's storage, database and LLM clients to the fakes.
+
+    Args:
+        database_url: SQLAlchemy URL, e.g. of a Postgres container, defaults
+            to a temporary SQLite database.
+        gcs_latency: Seconds added to every storage operation.
+        llm: FakeLLM answering every prompt, including title generation.
+
+    Returns:
+        Namespace with the storage client, engine and LLM.
+    """
+    fakes = types.SimpleNamespace(
+        storage=FakeStorageClient(gcs_latency),
+        engine=create_fake_engine(database_url),
+        llm=llm or FakeLLM(),
+    )
+
+    from app.main.service import message_service
+    from app.main.util import utils
+
+    utils.get_storage_client = fakes.storage
+    message_service.GeminiLLM = lambda: fakes.llm
+    message_service.get_llm_model = lambda llm_name: fakes.llm
+    return fakes
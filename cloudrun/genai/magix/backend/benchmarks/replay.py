@@ -0,0 +1,183 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays traffic recorded with TRAFFIC_RECORD_FILE against a target instance.
+
+Requests are sent at their recorded inter-arrival times divided by --speed,
+with synthetic content of the recorded sizes. Every recorded conversation is
+mapped to a new conversation id on the target. Latency percentiles and error
+rates are reported per route.
+
+Usage:
+    python -m benchmarks.replay traffic.ndjson --target http://localhost:8080 --speed 4
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import defaultdict
+import httpx
+
+DEFAULT_LLM_PARAMS = {"temp": 0.1, "max_tokens": 1000}
+# Admin routes and batch uploads are not replayed.
+SKIPPED_ROUTE_PREFIXES = ("/admin", "/batches")
+
+
+def load_records(path):
+    with open(path) as record_file:
+        records = [json.loads(line) for line in record_file if line.strip()]
+    return sorted(records, key=lambda record: record["t"])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+
+class Replay:
+    """
+    Builds and sends the requests of a recording
+    """
+
+    def __init__(self, target, user_email, speed):
+        self.target = target.rstrip("/")
+        self.user_email = user_email
+        self.speed = speed
+        self.conversations = defaultdict(lambda: str(uuid.uuid4()))
+        self.latencies = defaultdict(list)
+        self.first_bytes = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lag = []
+        self.skipped = 0
+
+    def build_request(self, record):
+        """Returns (method, path, params, json body, headers) for a record, or
+        None when its route can not be replayed."""
+        route = record.get("route")
+        if not route or route.startswith(SKIPPED_ROUTE_PREFIXES):
+            return None
+        path = route
+        if "<string:conversation_id>" in route:
+            conversation_id = self.conversations[record.get("conversation")]
+            path = path.replace("<string:conversation_id>", conversation_id)
+        if "<" in path:
+            return None
+
+        params = {
+            arg: record[arg] for arg in ("offset", "limit") if record.get(arg) is not None
+        }
+        if route == "/conversations":
+            params["userEmail"] = self.user_email
+        headers = {"Accept": record["accept"]} if record.get("accept") else {}
+
+        body = None
+        if "prompt_chars" in record:
+            body = {"role": "user", "message": "x" * record["prompt_chars"]}
+            if record.get("llm_names"):
+                body["llm_names"] = record["llm_names"]
+        elif record["method"] in ("POST", "PATCH") and route.endswith("/settings"):
+            body = {
+                "llm_name": record.get("llm_name", "Gemini"),
+                "llm_params": DEFAULT_LLM_PARAMS,
+                "userEmail": self.user_email,
+            }
+        return record["method"], path, params, body, headers
+
+    async def send(self, client, record, due):
+        request = self.build_request(record)
+        if request is None:
+            self.skipped += 1
+            return
+        method, path, params, body, headers = request
+        route = f"{method} {record['route']}"
+        started = time.monotonic()
+        self.lag.append(started - due)
+        try:
+            async with client.stream(
+                method, self.target + path, params=params, json=body, headers=headers
+            ) as response:
+                first_byte_at = None
+                async for _ in response.aiter_raw():
+                    if first_byte_at is None:
+                        first_byte_at = time.monotonic()
+                if response.status_code >= 400:
+                    self.errors[route] += 1
+        except httpx.HTTPError:
+            self.errors[route] += 1
+            first_byte_at = None
+        finished = time.monotonic()
+        self.latencies[route].append((finished - started) * 1000)
+        if first_byte_at is not None:
+            self.first_bytes[route].append((first_byte_at - started) * 1000)
+
+    async def run(self, records, max_connections):
+        limits = httpx.Limits(max_connections=max_connections)
+        async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+            started = time.monotonic()
+            first_t = records[0]["t"] if records else 0
+            tasks = []
+            for record in records:
+                due = started + (record["t"] - first_t) / self.speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self.send(client, record, due)))
+            await asyncio.gather(*tasks)
+            return time.monotonic() - started
+
+    def report(self, elapsed):
+        print(
+            f"{'route':55} {'count':>6} {'errors':>7} {'p50_ms':>9} {'p90_ms':>9} "
+            f"{'p99_ms':>9} {'ttfb_p50':>9}"
+        )
+        for route in sorted(self.latencies):
+            latencies = self.latencies[route]
+            ttfb = percentile(self.first_bytes[route], 0.5)
+            print(
+                f"{route:55} {len(latencies):6d} "
+                f"{self.errors[route] / len(latencies):7.1%} "
+                f"{percentile(latencies, 0.5):9.1f} {percentile(latencies, 0.9):9.1f} "
+                f"{percentile(latencies, 0.99):9.1f} "
+                f"{ttfb if ttfb is not None else float('nan'):9.1f}"
+            )
+        sent = sum(len(latencies) for latencies in self.latencies.values())
+        print(
+            f"sent={sent} skipped={self.skipped} elapsed={elapsed:.1f}s "
+            f"rate={sent / elapsed if elapsed else 0:.1f}/s "
+            f"schedule_lag_p99={(percentile(self.lag, 0.99) or 0) * 1000:.1f}ms"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("recording", help="NDJSON file written by TRAFFIC_RECORD_FILE")
+    parser.add_argument("--target", default="http://localhost:8080")
+    parser.add_argument("--speed", type=float, default=1, help="e.g. 4 for 4x speed")
+    parser.add_argument("--user-email", default="replay@example.com")
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    args = parser.parse_args()
+
+    records = load_records(args.recording)[: args.limit]
+    replay = Replay(args.target, args.user_email, args.speed)
+    elapsed = asyncio.run(replay.run(records, args.max_connections))
+    replay.report(elapsed)
+
+
+if __name__ == "__main__":
+    main()
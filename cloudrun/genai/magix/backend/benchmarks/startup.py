@@ -0,0 +1,137 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports where the time of a cold start goes, per imported module.
+
+The statement runs in a fresh interpreter with `-X importtime`. The report
+lists the total time, the import time of each top-level package and the
+slowest modules, including the modules they import.
+
+Usage:
+    python -m benchmarks.startup --top 25
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from collections import defaultdict
+
+STARTUP_STATEMENT = "from app import create_app; create_app()"
+# Provider and cloud SDKs that must only be imported when first used.
+LAZY_MODULES = (
+    "google.generativeai",
+    "vertexai",
+    "openai",
+    "mistralai",
+    "httpx",
+    "google.cloud.storage",
+    "google.cloud.sql.connector",
+    "google.oauth2.id_token",
+)
+
+_TIMED_STATEMENT = """
+import sys, json, time
+started = time.perf_counter()
+exec({statement!r})
+seconds = time.perf_counter() - started
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules)}}))
+"""
+
+
+def parse_importtime(output):
+    """Parses the `-X importtime` lines of stderr.
+
+    Returns:
+        List of (module, self microseconds, cumulative microseconds, depth).
+    """
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return modules
+
+
+def measure(statement=STARTUP_STATEMENT):
+    """Runs statement in a new interpreter from the backend directory.
+
+    Returns:
+        Dictionary of the wall time in seconds, the imports as returned by
+        parse_importtime and the names of the loaded modules.
+    """
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", _TIMED_STATEMENT.format(statement=statement)],
+        cwd=backend_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    timing = json.loads(result.stdout.strip().splitlines()[-1])
+    timing["imports"] = parse_importtime(result.stderr)
+    return timing
+
+
+def package_of(module):
+    parts = module.split(".")
+    # google is a namespace shared by several distributions
+    return ".".join(parts[:3] if parts[0] == "google" else parts[:1])
+
+
+def by_package(imports):
+    """Sums the self import time of modules per top-level package."""
+    totals = defaultdict(int)
+    for module, self_us, _, _ in imports:
+        totals[package_of(module)] += self_us
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def loaded_lazy_modules(modules):
+    return sorted(
+        module
+        for module in modules
+        if any(module == lazy or module.startswith(lazy + ".") for lazy in LAZY_MODULES)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--statement", default=STARTUP_STATEMENT)
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    timing = measure(args.statement)
+    imports = timing["imports"]
+    print(f"total={timing['seconds'] * 1000:.1f}ms modules={len(timing['modules'])}")
+    print(f"\n{'package':45} {'self_ms':>9}")
+    for package, self_us in by_package(imports)[: args.top]:
+        print(f"{package:45} {self_us / 1000:9.1f}")
+    print(f"\n{'module':60} {'self_ms':>9} {'cumulative_ms':>14}")
+    for module, self_us, cumulative_us, depth in sorted(
+        imports, key=lambda item: item[2], reverse=True
+    )[: args.top]:
+        print(f"{module:60} {self_us / 1000:9.1f} {cumulative_us / 1000:14.1f}")
+    lazy = loaded_lazy_modules(timing["modules"])
+    if lazy:
+        print(f"\nimported at startup, expected on first use: {', '.join(lazy)}")
+
+
+if __name__ == "__main__":
+    main()
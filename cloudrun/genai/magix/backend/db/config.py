@@ -13,24 +13,111 @@
 # limitations under the License.
 
 import os
-from flask import Flask
-from google.cloud.sql.connector import Connector, IPTypes
-import pg8000
+import time
+import logging
+import itertools
+import threading
 import sqlalchemy
+from sqlalchemy.pool import QueuePool
 
+# Connections kept open per worker, and opened on top of them under load.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 5))
+# Connections are replaced after this many seconds, before Cloud SQL drops them.
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+# Seconds a request waits for a free connection before failing.
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
 
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
+# Read replicas, as comma separated SQLAlchemy URLs or Cloud SQL instance
+# connection names ('project:region:instance').
+DATABASE_REPLICA_URLS = [
+    url for url in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if url
+]
+REPLICA_INSTANCE_CONNECTION_NAMES = [
+    name
+    for name in os.environ.get("REPLICA_INSTANCE_CONNECTION_NAMES", "").split(",")
+    if name
+]
+# Replicas lagging more than this many seconds serve no reads.
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 10))
+REPLICA_LAG_POLL_SECONDS = float(os.environ.get("REPLICA_LAG_POLL_SECONDS", 2))
+# Reads of what was written less than the lag of a replica plus this margin
+# ago are not served by that replica.
+READ_YOUR_WRITES_MARGIN_SECONDS = float(
+    os.environ.get("READ_YOUR_WRITES_MARGIN_SECONDS", 1)
+)
+RECENT_WRITES_SIZE = 100000
+# Cookie, and header for other clients, carrying the wall clock time of a
+# caller's last write, so that whichever instance serves its next requests
+# keeps them off the replicas lagging behind that write.
+LAST_WRITE_COOKIE = "last_write_at"
+LAST_WRITE_HEADER = "X-Last-Write-At"
+# Seconds a streamed response keeps writing after its headers are sent, e.g.
+# the messages persisted at the end of a generation.
+READ_YOUR_WRITES_STREAM_SECONDS = float(
+    os.environ.get("READ_YOUR_WRITES_STREAM_SECONDS", 60)
+)
+# Seconds a Postgres replica is behind its primary, 0 when it replayed all it
+# received, as an idle primary sends nothing to replay.
+REPLICA_LAG_QUERY = sqlalchemy.text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+_engine = None
+_connector = None
+_engine_lock = threading.Lock()
+_replicas = None
+_replica_turn = itertools.count()
+_recent_writes = None
+_monitor = None
+
+
+class TimedQueuePool(QueuePool):
+    """
+    Queue pool recording how long checkouts wait for a connection
+    """
+
+    def _do_get(self):
+        # imported here, importing the app package imports the services
+        from app.main.util.metrics import increment_counter, observe_histogram
+
+        started = time.monotonic()
+        try:
+            return super()._do_get()
+        except sqlalchemy.exc.TimeoutError:
+            increment_counter("db_pool_checkout_timeouts_total")
+            raise
+        finally:
+            observe_histogram(
+                "db_pool_checkout_wait_seconds", time.monotonic() - started
+            )
+
+
+def get_connector():
+    """Returns the Cloud SQL Python Connector shared by the process."""
+    global _connector
+    if _connector is None:
+        from google.cloud.sql.connector import Connector
+
+        _connector = Connector()
+    return _connector
+
+
+def connect_with_connector(instance_connection_name=None) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of Postgres.
 
-    Uses the Cloud SQL Python Connector package.
+    Uses the Cloud SQL Python Connector package. Connects to
+    INSTANCE_CONNECTION_NAME unless instance_connection_name is given.
     """
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
+    from google.cloud.sql.connector import IPTypes
 
-    instance_connection_name = os.environ[
+    instance_connection_name = instance_connection_name or os.environ[
         "INSTANCE_CONNECTION_NAME"
     ]  # e.g. 'project:region:instance'
     db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
@@ -39,11 +126,10 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 
     ip_type = IPTypes.PRIVATE if os.environ.get("PRIVATE_IP") else IPTypes.PUBLIC
 
-    # initialize Cloud SQL Python Connector object
-    connector = Connector()
+    connector = get_connector()
 
-    def getconn() -> pg8000.dbapi.Connection:
-        conn: pg8000.dbapi.Connection = connector.connect(
+    def getconn():
+        conn = connector.connect(
             instance_connection_name,
             "pg8000",
             user=db_user,
@@ -55,9 +141,238 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
 
     # The Cloud SQL Python Connector can be used with SQLAlchemy
     # using the 'creator' argument to 'create_engine'
-    pool = sqlalchemy.create_engine(
-        "postgresql+pg8000://",
-        creator=getconn,
-        # ...
+    return sqlalchemy.create_engine(
+        "postgresql+pg8000://", creator=getconn, **pool_options()
+    )
+
+
+def pool_options():
+    return {
+        "poolclass": TimedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": True,
+    }
+
+
+def create_engine_from_url(database_url) -> sqlalchemy.engine.base.Engine:
+    """Creates an engine for a SQLAlchemy URL, e.g. a local Postgres or SQLite
+    database used instead of Cloud SQL."""
+    if database_url.startswith("sqlite"):
+        return sqlalchemy.create_engine(
+            database_url, connect_args={"check_same_thread": False, "timeout": 30}
+        )
+    return sqlalchemy.create_engine(database_url, **pool_options())
+
+
+def _count_connection(*args):
+    from app.main.util.metrics import increment_counter
+
+    increment_counter("db_pool_connections_opened_total")
+
+
+def database_configured():
+    """Returns whether get_engine has a database to connect to."""
+    return bool(
+        os.environ.get("DATABASE_URL") or os.environ.get("INSTANCE_CONNECTION_NAME")
     )
-    return pool
+
+
+def get_engine() -> sqlalchemy.engine.base.Engine:
+    """Returns the engine shared by every service, created on first use.
+
+    The engine connects to Cloud SQL with the Cloud SQL Python Connector, or to
+    DATABASE_URL when it is set.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                database_url = os.environ.get("DATABASE_URL")
+                if database_url:
+                    _engine = create_engine_from_url(database_url)
+                else:
+                    _engine = connect_with_connector()
+                sqlalchemy.event.listen(_engine, "connect", _count_connection)
+    return _engine
+
+
+class Replica:
+    """
+    Read replica and its last measured lag
+    """
+
+    def __init__(self, name, engine):
+        self.name = name
+        self.engine = engine
+        # seconds, infinite while the replica cannot be reached
+        self.lag = 0.0
+
+
+def get_replicas():
+    """Returns the read replicas, created on first use. Their lag is measured
+    on a background thread."""
+    global _replicas, _recent_writes, _monitor
+    if _replicas is None:
+        with _engine_lock:
+            if _replicas is None:
+                from app.main.util.cache import TTLCache
+
+                replicas = [
+                    Replica(f"replica-{index}", create_engine_from_url(url))
+                    for index, url in enumerate(DATABASE_REPLICA_URLS)
+                ] + [
+                    Replica(name, connect_with_connector(name))
+                    for name in REPLICA_INSTANCE_CONNECTION_NAMES
+                ]
+                for replica in replicas:
+                    sqlalchemy.event.listen(replica.engine, "connect", _count_connection)
+                # older writes are behind every replica that serves reads
+                _recent_writes = TTLCache(
+                    RECENT_WRITES_SIZE,
+                    REPLICA_MAX_LAG_SECONDS + READ_YOUR_WRITES_MARGIN_SECONDS,
+                )
+                if any(r.engine.dialect.name == "postgresql" for r in replicas):
+                    _monitor = threading.Thread(
+                        target=monitor_replicas,
+                        args=(replicas,),
+                        name="replica-lag",
+                        daemon=True,
+                    )
+                    _monitor.start()
+                _replicas = replicas
+    return _replicas
+
+
+def measure_replica_lag(replica):
+    """Returns the seconds replica is behind the primary, 0 on databases
+    without replication."""
+    if replica.engine.dialect.name != "postgresql":
+        return 0.0
+    with replica.engine.connect() as connection:
+        return float(connection.execute(REPLICA_LAG_QUERY).scalar())
+
+
+def monitor_replicas(replicas, stop_event=None):
+    """Measures the lag of every replica every REPLICA_LAG_POLL_SECONDS, until
+    stop_event is set."""
+    stop_event = stop_event or threading.Event()
+    while True:
+        for replica in replicas:
+            try:
+                lag = measure_replica_lag(replica)
+            except Exception as e:
+                if replica.lag != float("inf"):
+                    logging.error(f"Replica {replica.name} is unreachable: {e}")
+                lag = float("inf")
+            if (lag > REPLICA_MAX_LAG_SECONDS) != (replica.lag > REPLICA_MAX_LAG_SECONDS):
+                logging.warning(f"Replica {replica.name} lags {lag:.1f}s")
+            replica.lag = lag
+        if stop_event.wait(REPLICA_LAG_POLL_SECONDS):
+            return
+
+
+def record_write(*keys):
+    """Records that the data identified by keys, e.g. a user email or a
+    conversation id, was just written to the primary, so that get_read_engine
+    serves it from the primary or replicas that caught up. Writes made in a
+    request are also recorded for its caller, see record_caller_write."""
+    if not get_replicas():
+        return
+    now = time.monotonic()
+    for key in keys:
+        if key is not None:
+            _recent_writes.set(key, now)
+    record_caller_write()
+
+
+def record_caller_write(duration=0):
+    """Records that the caller of the current request wrote to the primary,
+    or keeps writing for duration seconds, so that its next requests are read
+    from the primary or replicas that caught up, on any instance."""
+    from flask import g, has_request_context
+
+    if not has_request_context() or not get_replicas():
+        return
+    g.last_write_at = max(g.get("last_write_at", 0), time.time() + duration)
+
+
+def _caller_write_time():
+    """Returns the wall clock time of the current caller's last write, or None."""
+    from flask import g, has_request_context, request
+
+    if not has_request_context():
+        return None
+    times = [g.get("last_write_at")]
+    for value in (request.headers.get(LAST_WRITE_HEADER), request.cookies.get(LAST_WRITE_COOKIE)):
+        try:
+            times.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    return max((t for t in times if t is not None), default=None)
+
+
+def init_read_your_writes(app):
+    """Returns the time of the caller's writes with the responses of a Flask
+    app, as long as replicas may lag behind them."""
+    from flask import g
+
+    @app.after_request
+    def send_last_write(response):
+        last_write_at = g.get("last_write_at")
+        if last_write_at is not None:
+            response.headers[LAST_WRITE_HEADER] = f"{last_write_at:.3f}"
+            response.set_cookie(
+                LAST_WRITE_COOKIE,
+                f"{last_write_at:.3f}",
+                max_age=int(
+                    last_write_at - time.time()
+                    + REPLICA_MAX_LAG_SECONDS + READ_YOUR_WRITES_MARGIN_SECONDS
+                ) + 1,
+                httponly=True,
+                # the frontend is served from another origin
+                secure=True,
+                samesite="None",
+            )
+        return response
+
+
+def get_read_engine(*keys) -> sqlalchemy.engine.base.Engine:
+    """Returns an engine for read-only queries.
+
+    Reads are spread round-robin over the replicas lagging at most
+    REPLICA_MAX_LAG_SECONDS, and go to the primary when there are none.
+    Args:
+        keys: Identifiers of the data read, a replica only serves them once its
+            lag is shorter than the time since they were last written. The
+            caller's own writes, on any instance, are waited for as well.
+    Returns:
+        The engine of a replica or of the primary.
+    """
+    from app.main.util.metrics import increment_counter
+
+    replicas = get_replicas()
+    if replicas:
+        now = time.monotonic()
+        written_at = max(
+            (_recent_writes.get(key) or float("-inf") for key in keys),
+            default=float("-inf"),
+        )
+        since_write = now - written_at
+        caller_written_at = _caller_write_time()
+        if caller_written_at is not None:
+            since_write = min(since_write, time.time() - caller_written_at)
+        current = [
+            replica
+            for replica in replicas
+            if replica.lag <= REPLICA_MAX_LAG_SECONDS
+            and since_write > replica.lag + READ_YOUR_WRITES_MARGIN_SECONDS
+        ]
+        if current:
+            replica = current[next(_replica_turn) % len(current)]
+            increment_counter("db_reads_total", target=replica.name)
+            return replica.engine
+    increment_counter("db_reads_total", target="primary")
+    return get_engine()
@@ -0,0 +1,288 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Versioned schema migrations.
+
+Migrations are the modules db/migrations/NNNN_<name>.py, applied in version
+order. Each defines up(connection) and down(connection); both must be
+idempotent, so a migration interrupted before its version was recorded can
+run again. A migration setting TRANSACTIONAL = False runs in autocommit mode,
+as CREATE INDEX CONCURRENTLY requires on Postgres.
+
+Usage:
+    python -m db.migrate up [version]
+    python -m db.migrate down <version>
+    python -m db.migrate status
+    python -m db.migrate check
+"""
+
+import os
+import re
+import sys
+import logging
+import importlib
+import sqlalchemy
+
+MIGRATIONS_PACKAGE = "db.migrations"
+VERSION_TABLE = "schema_migrations"
+# Key of the Postgres advisory lock serialising concurrent runners.
+ADVISORY_LOCK_ID = 7146231
+
+_version_table = sqlalchemy.Table(
+    VERSION_TABLE,
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("version", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("applied_at", sqlalchemy.DateTime, server_default=sqlalchemy.func.now()),
+)
+
+
+class Migration:
+    """
+    Migration module of db/migrations
+    """
+
+    def __init__(self, version, name, module):
+        self.version = version
+        self.name = name
+        self.module = module
+
+    @property
+    def transactional(self):
+        return getattr(self.module, "TRANSACTIONAL", True)
+
+    def run(self, engine, step):
+        """Runs up or down, in a transaction when the migration is transactional."""
+        if self.transactional:
+            with engine.begin() as connection:
+                getattr(self.module, step)(connection)
+        else:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                getattr(self.module, step)(connection)
+
+
+def discover():
+    """Returns the migrations of db/migrations, by version."""
+    package = importlib.import_module(MIGRATIONS_PACKAGE)
+    migrations = []
+    for file_name in sorted(os.listdir(os.path.dirname(package.__file__))):
+        match = re.fullmatch(r"(\d{4})_(\w+)\.py", file_name)
+        if match:
+            module = importlib.import_module(f"{MIGRATIONS_PACKAGE}.{file_name[:-3]}")
+            migrations.append(Migration(int(match.group(1)), match.group(2), module))
+    return migrations
+
+
+def applied_versions(engine):
+    """Returns the versions recorded in the version table."""
+    _version_table.create(engine, checkfirst=True)
+    with engine.connect() as connection:
+        return {row.version for row in connection.execute(sqlalchemy.select(_version_table.c.version))}
+
+
+def _locked(engine, function):
+    if engine.dialect.name != "postgresql":
+        return function()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(sqlalchemy.text(f"SELECT pg_advisory_lock({ADVISORY_LOCK_ID})"))
+        try:
+            return function()
+        finally:
+            connection.execute(sqlalchemy.text(f"SELECT pg_advisory_unlock({ADVISORY_LOCK_ID})"))
+
+
+def upgrade(engine, target=None):
+    """Applies the migrations not applied yet, up to target.
+    Args:
+        engine: SQLAlchemy engine.
+        target: Last version to apply, all when None.
+    Returns:
+        The versions applied.
+    """
+
+    def run():
+        applied = applied_versions(engine)
+        done = []
+        for migration in discover():
+            if migration.version in applied or (target is not None and migration.version > target):
+                continue
+            logging.info(f"Applying migration {migration.version:04d}_{migration.name}")
+            migration.run(engine, "up")
+            with engine.begin() as connection:
+                connection.execute(
+                    _version_table.insert().values(version=migration.version, name=migration.name)
+                )
+            done.append(migration.version)
+        return done
+
+    return _locked(engine, run)
+
+
+def downgrade(engine, target):
+    """Reverts the applied migrations newer than target.
+    Args:
+        engine: SQLAlchemy engine.
+        target: Version to go back to, 0 reverts every migration.
+    Returns:
+        The versions reverted.
+    """
+
+    def run():
+        applied = applied_versions(engine)
+        done = []
+        for migration in reversed(discover()):
+            if migration.version not in applied or migration.version <= target:
+                continue
+            logging.info(f"Reverting migration {migration.version:04d}_{migration.name}")
+            migration.run(engine, "down")
+            with engine.begin() as connection:
+                connection.execute(
+                    _version_table.delete().where(_version_table.c.version == migration.version)
+                )
+            done.append(migration.version)
+        return done
+
+    return _locked(engine, run)
+
+
+def model_metadata():
+    """Returns the metadata of the ORM models of app/main/model."""
+    from app.main.model.conversation import Base as ConversationBase
+    from app.main.model.llm import Base as LLMBase
+    from app.main.model.search import Base as SearchBase
+    from app.main.model.user import Base as UserBase
+
+    return [
+        ConversationBase.metadata,
+        LLMBase.metadata,
+        SearchBase.metadata,
+        UserBase.metadata,
+    ]
+
+
+def _same_type(engine, reflected, declared):
+    if isinstance(reflected, sqlalchemy.types.NullType):
+        # a type the dialect cannot reflect, e.g. tsvector
+        return True
+    if reflected.compile(engine.dialect) == declared.compile(engine.dialect):
+        return True
+    # e.g. TIMESTAMP and DATETIME, one type on Postgres, two names on SQLite
+    return all(
+        getattr(reflected, attribute, None) == getattr(declared, attribute, None)
+        for attribute in ("_type_affinity", "length", "timezone")
+    )
+
+
+def _index_columns(index):
+    # expressions, other than sorted columns, are compared by position only
+    columns = []
+    for expression in index.expressions:
+        expression = getattr(expression, "element", expression)
+        columns.append(expression.name if isinstance(expression, sqlalchemy.Column) else None)
+    return columns
+
+
+def check_drift(engine, metadatas=None):
+    """Compares the migrated schema with the ORM models.
+    Args:
+        engine: SQLAlchemy engine of a migrated database.
+        metadatas: MetaData to compare, those of the ORM models by default.
+    Returns:
+        List of differences, empty when the models match the schema.
+    """
+    inspector = sqlalchemy.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    differences = []
+    for metadata in metadatas or model_metadata():
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                differences.append(f"table {table.name} is not migrated")
+                continue
+            columns = {column["name"]: column for column in inspector.get_columns(table.name)}
+            for name in sorted(set(table.columns.keys()) - set(columns)):
+                differences.append(f"column {table.name}.{name} is not migrated")
+            for name in sorted(set(columns) - set(table.columns.keys())):
+                differences.append(f"column {table.name}.{name} is not in the model")
+            for name in sorted(set(columns) & set(table.columns.keys())):
+                column, model_column = columns[name], table.columns[name]
+                if not _same_type(engine, column["type"], model_column.type):
+                    differences.append(
+                        f"column {table.name}.{name} is {column['type']}, "
+                        f"{model_column.type} in the model"
+                    )
+                if column["nullable"] != model_column.nullable:
+                    nullable = "nullable" if column["nullable"] else "not nullable"
+                    differences.append(
+                        f"column {table.name}.{name} is {nullable}, not in the model"
+                    )
+            indexes = {
+                index["name"]: index
+                for index in inspector.get_indexes(table.name)
+                # indexes backing unique constraints are not declared as indexes
+                if not index.get("duplicates_constraint")
+            }
+            model_indexes = {
+                index.name: index
+                for index in table.indexes
+                # e.g. GIN indexes, declared for Postgres only
+                if engine.dialect.name in index.info.get("dialects", (engine.dialect.name,))
+            }
+            for name in sorted(set(model_indexes) - set(indexes)):
+                differences.append(f"index {name} on {table.name} is not migrated")
+            for name in sorted(set(indexes) - set(model_indexes)):
+                differences.append(f"index {name} on {table.name} is not in the model")
+            for name in sorted(set(indexes) & set(model_indexes)):
+                index, model_index = indexes[name], model_indexes[name]
+                if list(index["column_names"]) != _index_columns(model_index):
+                    differences.append(
+                        f"index {name} on {table.name} is on {index['column_names']}, "
+                        f"{_index_columns(model_index)} in the model"
+                    )
+                if bool(index["unique"]) != bool(model_index.unique):
+                    unique = "unique" if index["unique"] else "not unique"
+                    differences.append(
+                        f"index {name} on {table.name} is {unique}, not in the model"
+                    )
+    return differences
+
+
+def main(argv=None):
+    from db.config import get_engine
+
+    logging.basicConfig(level=logging.INFO)
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else "up"
+    engine = get_engine()
+    if command == "up":
+        upgrade(engine, int(argv[1]) if len(argv) > 1 else None)
+    elif command == "down" and len(argv) > 1:
+        downgrade(engine, int(argv[1]))
+    elif command == "status":
+        applied = applied_versions(engine)
+        for migration in discover():
+            state = "applied" if migration.version in applied else "pending"
+            print(f"{migration.version:04d}_{migration.name:40} {state}")
+    elif command == "check":
+        differences = check_drift(engine)
+        for difference in differences:
+            print(difference)
+        return 1 if differences else 0
+    else:
+        print(__doc__)
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tables created by infrastructure/sql/db.py before migrations existed.
+
+The tables are declared here as they were, not imported from the models, so
+that later model changes do not change this migration.
+"""
+
+from sqlalchemy import (
+    JSON,
+    UUID,
+    Boolean,
+    Column,
+    DateTime,
+    MetaData,
+    String,
+    Table,
+    func,
+)
+
+metadata = MetaData()
+
+Table(
+    "conversation",
+    metadata,
+    Column("id", UUID(as_uuid=False), unique=True, primary_key=True),
+    Column("user_email", String),
+    Column("title", String),
+    Column("llm_name", String),
+    Column("llm_params", JSON, nullable=True),
+    Column("created_at", DateTime, default=func.now()),
+)
+
+Table(
+    "llm",
+    metadata,
+    Column("name", String, unique=True, nullable=False, primary_key=True),
+    Column("display_name", String),
+    Column("provider", String),
+    Column("model_name", String),
+    Column("version", String),
+    Column("params", JSON, nullable=True),
+    Column("is_active", Boolean, default=True),
+)
+
+Table(
+    "user",
+    metadata,
+    Column("email", String),
+    Column("username", String, unique=True, primary_key=True),
+    Column("is_admin", Boolean, default=False),
+    Column("tenant_id", UUID(as_uuid=False)),
+    Column("created_at", DateTime, default=func.now()),
+)
+
+
+def up(connection):
+    metadata.create_all(connection, checkfirst=True)
+
+
+def down(connection):
+    metadata.drop_all(connection, checkfirst=True)
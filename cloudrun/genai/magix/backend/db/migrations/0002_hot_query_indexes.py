@@ -0,0 +1,39 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Indexes of the per-request queries.
+
+The conversation index serves filtering by user_email and sorting by
+created_at, for offset and cursor pages; user.email is looked up on every
+authenticated request.
+"""
+
+from db.migrations import create_index, drop_index
+
+TRANSACTIONAL = False
+
+
+def up(connection):
+    create_index(
+        connection,
+        "ix_conversation_user_email_created_at_id",
+        "conversation",
+        "user_email, created_at DESC, id",
+    )
+    create_index(connection, "ix_user_email", "user", "email")
+
+
+def down(connection):
+    drop_index(connection, "ix_user_email")
+    drop_index(connection, "ix_conversation_user_email_created_at_id")
@@ -0,0 +1,44 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""One user per email, so that a login resolves its user with one upsert.
+
+Fails without changing the schema if existing users share an email; merge
+them first.
+"""
+
+import sqlalchemy
+from db.migrations import create_index, drop_index
+
+TRANSACTIONAL = False
+
+
+def up(connection):
+    duplicates = connection.execute(
+        sqlalchemy.text(
+            'SELECT email FROM "user" WHERE email IS NOT NULL '
+            "GROUP BY email HAVING COUNT(*) > 1"
+        )
+    ).scalars().all()
+    if duplicates:
+        raise RuntimeError(f"Users share emails, merge them first: {duplicates}")
+    # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind
+    drop_index(connection, "uq_user_email")
+    create_index(connection, "uq_user_email", "user", "email", unique=True)
+    drop_index(connection, "ix_user_email")
+
+
+def down(connection):
+    create_index(connection, "ix_user_email", "user", "email")
+    drop_index(connection, "uq_user_email")
@@ -0,0 +1,78 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Messages and titles searchable by full-text search.
+
+message_search holds the text of every persisted message. On Postgres, the
+messages and conversation titles get GIN indexes on their tsvector, created
+without blocking writes; other databases get the plain table.
+"""
+
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    UUID,
+    func,
+)
+from db.migrations import create_index, drop_index
+
+TRANSACTIONAL = False
+
+metadata = MetaData()
+
+message_search = Table(
+    "message_search",
+    metadata,
+    Column("id", BigInteger().with_variant(Integer, "sqlite"), primary_key=True, autoincrement=True),
+    Column("conversation_id", UUID(as_uuid=False), nullable=False),
+    Column("user_email", String, nullable=False),
+    Column("role", String),
+    Column("message", Text),
+    Column("created_at", DateTime, default=func.now()),
+)
+
+
+def up(connection):
+    metadata.create_all(connection, checkfirst=True)
+    create_index(
+        connection,
+        "ix_message_search_user_email_conversation_id",
+        "message_search",
+        "user_email, conversation_id",
+    )
+    if connection.dialect.name == "postgresql":
+        # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind
+        for name, table, column in (
+            ("ix_message_search_document", "message_search", "message"),
+            ("ix_conversation_title_document", "conversation", "title"),
+        ):
+            drop_index(connection, name)
+            create_index(
+                connection,
+                name,
+                table,
+                f"to_tsvector('english', coalesce({column}, ''))",
+                using="gin",
+            )
+
+
+def down(connection):
+    drop_index(connection, "ix_conversation_title_document")
+    metadata.drop_all(connection, checkfirst=True)
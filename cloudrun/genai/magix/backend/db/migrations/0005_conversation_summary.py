@@ -0,0 +1,82 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Message summary of conversations, and the conversation list by activity.
+
+Adds message_count, last_message_at and last_message_preview to conversation.
+last_message_at of existing conversations starts at their creation, in
+batches so that no long transaction holds their rows; counts and previews
+are set at their next turn. The conversation list index moves from
+created_at to last_message_at.
+"""
+
+import sqlalchemy
+from db.migrations import create_index, drop_index
+
+TRANSACTIONAL = False
+
+BACKFILL_BATCH_SIZE = 10000
+
+COLUMNS = {
+    "message_count": "INTEGER NOT NULL DEFAULT 0",
+    "last_message_at": "TIMESTAMP",
+    "last_message_preview": "VARCHAR",
+}
+
+
+def up(connection):
+    existing = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns("conversation")
+    }
+    for name, definition in COLUMNS.items():
+        if name not in existing:
+            connection.execute(
+                sqlalchemy.text(f"ALTER TABLE conversation ADD COLUMN {name} {definition}")
+            )
+    while True:
+        backfilled = connection.execute(
+            sqlalchemy.text(
+                "UPDATE conversation SET last_message_at = COALESCE(created_at, CURRENT_TIMESTAMP) "
+                "WHERE id IN (SELECT id FROM conversation WHERE last_message_at IS NULL "
+                f"LIMIT {BACKFILL_BATCH_SIZE})"
+            )
+        ).rowcount
+        # each batch commits on its own, the connection autocommits
+        if not backfilled:
+            break
+    # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind
+    drop_index(connection, "ix_conversation_user_email_last_message_at_id")
+    create_index(
+        connection,
+        "ix_conversation_user_email_last_message_at_id",
+        "conversation",
+        "user_email, last_message_at DESC, id",
+    )
+    drop_index(connection, "ix_conversation_user_email_created_at_id")
+
+
+def down(connection):
+    create_index(
+        connection,
+        "ix_conversation_user_email_created_at_id",
+        "conversation",
+        "user_email, created_at DESC, id",
+    )
+    drop_index(connection, "ix_conversation_user_email_last_message_at_id")
+    existing = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns("conversation")
+    }
+    for name in reversed(list(COLUMNS)):
+        if name in existing:
+            connection.execute(sqlalchemy.text(f"ALTER TABLE conversation DROP COLUMN {name}"))
@@ -0,0 +1,50 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Soft deletion of conversations.
+
+Deleted conversations keep their row, with deleted_at set, until the purger
+removed their storage objects; a partial index finds them.
+"""
+
+import sqlalchemy
+from db.migrations import create_index, drop_index
+
+TRANSACTIONAL = False
+
+
+def up(connection):
+    columns = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns("conversation")
+    }
+    if "deleted_at" not in columns:
+        connection.execute(sqlalchemy.text("ALTER TABLE conversation ADD COLUMN deleted_at TIMESTAMP"))
+    # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind
+    drop_index(connection, "ix_conversation_deleted_at")
+    create_index(
+        connection,
+        "ix_conversation_deleted_at",
+        "conversation",
+        "deleted_at",
+        where="deleted_at IS NOT NULL",
+    )
+
+
+def down(connection):
+    drop_index(connection, "ix_conversation_deleted_at")
+    columns = {
+        column["name"] for column in sqlalchemy.inspect(connection).get_columns("conversation")
+    }
+    if "deleted_at" in columns:
+        connection.execute(sqlalchemy.text("ALTER TABLE conversation DROP COLUMN deleted_at"))
@@ -0,0 +1,40 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Index of the conversations by activity, across users.
+
+The analytics export pages the conversations by keyset on
+(last_message_at, id), which without it scans and sorts the whole table for
+every page.
+"""
+
+from db.migrations import create_index, drop_index
+
+TRANSACTIONAL = False
+
+
+def up(connection):
+    # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind
+    drop_index(connection, "ix_conversation_last_message_at_id")
+    create_index(
+        connection,
+        "ix_conversation_last_message_at_id",
+        "conversation",
+        "last_message_at, id",
+        where="deleted_at IS NULL",
+    )
+
+
+def down(connection):
+    drop_index(connection, "ix_conversation_last_message_at_id")
@@ -0,0 +1,46 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Schema migrations applied by db/migrate.py, and helpers shared by them."""
+
+import sqlalchemy
+
+
+def create_index(connection, name, table, columns, unique=False, using=None, where=None):
+    """Creates an index unless it exists, without blocking writes on Postgres.
+
+    Args:
+        connection: Connection in autocommit mode on Postgres.
+        name: Index name.
+        table: Table name.
+        columns: SQL of the indexed columns, e.g. "user_email, created_at DESC".
+        unique: Whether the index is unique.
+        using: Index method, e.g. "gin", the default one when None.
+        where: SQL condition of the rows of a partial index, all rows when None.
+    """
+    concurrently = "CONCURRENTLY " if connection.dialect.name == "postgresql" else ""
+    quoted_table = connection.dialect.identifier_preparer.quote(table)
+    connection.execute(
+        sqlalchemy.text(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}IF NOT EXISTS "
+            f"{name} ON {quoted_table} {f'USING {using} ' if using else ''}({columns})"
+            f"{f' WHERE {where}' if where else ''}"
+        )
+    )
+
+
+def drop_index(connection, name):
+    """Drops an index if it exists, without blocking writes on Postgres."""
+    concurrently = "CONCURRENTLY " if connection.dialect.name == "postgresql" else ""
+    connection.execute(sqlalchemy.text(f"DROP INDEX {concurrently}IF EXISTS {name}"))
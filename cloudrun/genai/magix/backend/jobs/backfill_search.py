@@ -0,0 +1,187 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Backfill of the search index with the messages persisted before it.
+
+Messages are indexed as they are persisted, so the message_search table
+(migration 0004) lacks the messages of the turns before its deployment. This
+job walks the conversations in keyset order of id, a page at a time, reads
+their message files in parallel and indexes the messages the table lacks.
+
+A message is indexed only if the conversation has fewer rows of the same role
+and text than its message file, so the job can be run again, or resumed with
+--after, without indexing a message twice. Conversations active in the last
+BACKFILL_SETTLE_SECONDS are left for a later run, as the messages of their
+current turn may be persisted but not indexed yet. The last id of every page
+is logged, to resume an interrupted run from.
+
+Usage:
+    python -m jobs.backfill_search
+    python -m jobs.backfill_search --after 2f1c6a3e-0000-4000-8000-000000000000
+"""
+
+import os
+import sys
+import logging
+import argparse
+import datetime
+import sqlalchemy
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from app.main.model.conversation import ConversationSQL
+from app.main.model.search import MessageSearchSQL
+from app.main.util.utils import get_file_from_gcs
+from db.config import get_engine
+
+# Conversations backfilled per page.
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", 500))
+# Concurrent message file reads.
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", 16))
+# Conversations active in the last seconds are left for a later run.
+BACKFILL_SETTLE_SECONDS = float(os.environ.get("BACKFILL_SETTLE_SECONDS", 300))
+
+
+def conversations_after(after, until, limit=None):
+    """Returns a page of conversations to backfill.
+    Args:
+        after: Id of the last backfilled conversation, or None.
+        until: Conversations active from this time on are not returned.
+        limit: Number of conversations of the page, BACKFILL_BATCH_SIZE by default.
+    Returns:
+        List of (id, user_email) rows, by id.
+    """
+    table = ConversationSQL.__table__
+    statement = (
+        sqlalchemy.select(table.c.id, table.c.user_email)
+        .where(table.c.deleted_at.is_(None), table.c.last_message_at < until)
+        .order_by(table.c.id)
+        .limit(limit or BACKFILL_BATCH_SIZE)
+    )
+    if after is not None:
+        statement = statement.where(table.c.id > after)
+    with get_engine().connect() as connection:
+        return connection.execute(statement).all()
+
+
+def read_messages(conversation_id):
+    """Returns the messages of a conversation, or None when they cannot be read."""
+    messages = get_file_from_gcs(conversation_id=conversation_id, file_name="message")
+    if isinstance(messages, tuple):
+        return None
+    return messages if isinstance(messages, list) else []
+
+
+def index_missing_messages(conversation, messages, until):
+    """Indexes the messages of a conversation that the search index lacks.
+    Args:
+        conversation: (id, user_email) row of the conversation.
+        messages: Messages of its message file.
+        until: The conversation is skipped if it was active since this time.
+    Returns:
+        The number of indexed messages, or None if the conversation was skipped.
+    """
+    table = MessageSearchSQL.__table__
+    conversations = ConversationSQL.__table__
+    with get_engine().begin() as connection:
+        last_message_at = connection.execute(
+            sqlalchemy.select(conversations.c.last_message_at).where(
+                conversations.c.id == conversation.id, conversations.c.deleted_at.is_(None)
+            )
+        ).scalar()
+        if last_message_at is None or last_message_at >= until:
+            return None
+        indexed = Counter(
+            (row.role, row.message)
+            for row in connection.execute(
+                sqlalchemy.select(table.c.role, table.c.message).where(
+                    table.c.conversation_id == conversation.id
+                )
+            )
+        )
+        missing = []
+        for message in messages:
+            if not message.get("message"):
+                continue
+            key = (message.get("role"), message["message"])
+            if indexed[key]:
+                indexed[key] -= 1
+            else:
+                missing.append({
+                    "conversation_id": conversation.id,
+                    "user_email": conversation.user_email,
+                    "role": key[0],
+                    "message": key[1],
+                })
+        if missing:
+            connection.execute(table.insert(), missing)
+    return len(missing)
+
+
+def backfill(after=None, until=None, workers=BACKFILL_WORKERS):
+    """Indexes the messages of every conversation after an id.
+    Args:
+        after: Id of the last backfilled conversation, to resume a run.
+        until: Conversations active from this time on are left for a later
+            run, defaults to BACKFILL_SETTLE_SECONDS ago.
+        workers: Concurrent message file reads.
+    Returns:
+        The number of indexed messages and the ids of the conversations that
+        were skipped or whose messages could not be read.
+    """
+    if until is None:
+        until = datetime.datetime.now(datetime.timezone.utc).replace(
+            tzinfo=None
+        ) - datetime.timedelta(seconds=BACKFILL_SETTLE_SECONDS)
+    indexed = conversation_count = 0
+    skipped = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+        while True:
+            conversations = conversations_after(after, until)
+            if not conversations:
+                break
+            messages = executor.map(read_messages, [c.id for c in conversations])
+            for conversation, conversation_messages in zip(conversations, messages):
+                count = None
+                if conversation_messages is not None:
+                    count = index_missing_messages(conversation, conversation_messages, until)
+                if count is None:
+                    skipped.append(conversation.id)
+                else:
+                    indexed += count
+            after = conversations[-1].id
+            conversation_count += len(conversations)
+            logging.info(
+                f"Backfilled {conversation_count} conversations, {indexed} messages, "
+                f"through {after}"
+            )
+    if skipped:
+        logging.warning(f"{len(skipped)} conversations were skipped, run the backfill again")
+    return indexed, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--after", help="id of the last backfilled conversation")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    _, skipped = backfill(args.after, workers=args.workers)
+    return 1 if skipped else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Incremental columnar export of conversations and their turns.
+
+Exports the conversations active since the last run, read from a read
+replica, and their message files, read in parallel, to two tables of
+Parquet (or Arrow IPC) files partitioned by day of last activity:
+
+    <output>/conversations/dt=YYYY-MM-DD/part-<run>-<page>.parquet
+    <output>/turns/dt=YYYY-MM-DD/part-<run>-<page>.parquet
+
+Turns hold the model, parameters, lengths and timings of every message, not
+its text; user emails are hashed with ANALYTICS_HASH_KEY. The watermark, the
+(last_message_at, id) of the last exported conversation, is saved to
+<output>/_watermark.json after every page, so an interrupted run resumes
+where it stopped. A conversation continued after its export is exported
+again with all its turns: keep the rows of its latest exported_at.
+
+Usage:
+    python -m jobs.export_analytics --output gs://analytics-bucket/magix
+    python -m jobs.export_analytics --output /tmp/magix --format arrow
+"""
+
+import os
+import sys
+import hmac
+import json
+import uuid
+import hashlib
+import logging
+import argparse
+import datetime
+import sqlalchemy
+from concurrent.futures import ThreadPoolExecutor
+from app.main.model.conversation import ConversationSQL
+from app.main.util.metrics import estimate_tokens
+from app.main.util.utils import get_file_from_gcs
+from db.config import get_read_engine
+
+# Conversations exported per page, and per file of each partition.
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 500))
+# Concurrent message file reads.
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", 16))
+# Conversations active in the last seconds are left for the next run, as
+# turns of them may still be committing with an earlier last_message_at.
+EXPORT_SETTLE_SECONDS = float(os.environ.get("EXPORT_SETTLE_SECONDS", 300))
+# Key of the HMAC of user emails, the same for every run so that users can be
+# counted across exports. Without it no user column is exported.
+ANALYTICS_HASH_KEY = os.environ.get("ANALYTICS_HASH_KEY", "")
+ANALYTICS_EXPORT_URI = os.environ.get("ANALYTICS_EXPORT_URI", "")
+# Bucket of the conversation files, which exports must not be written to.
+SERVING_BUCKET = "navi-store"
+WATERMARK_FILE = "_watermark.json"
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.fs
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise SystemExit(
+            "The analytics export requires pyarrow: pip install -r jobs/requirements.txt"
+        )
+    return pyarrow
+
+
+def schemas():
+    """Returns the Arrow schemas of the conversations and turns tables."""
+    pa = _pyarrow()
+    timestamp = pa.timestamp("us", tz="UTC")
+    conversations = pa.schema([
+        ("conversation_id", pa.string()),
+        ("user_hash", pa.string()),
+        ("llm_name", pa.string()),
+        ("llm_params", pa.string()),
+        ("message_count", pa.int32()),
+        ("created_at", timestamp),
+        ("last_message_at", timestamp),
+        ("exported_at", timestamp),
+    ])
+    turns = pa.schema([
+        ("conversation_id", pa.string()),
+        ("turn", pa.int32()),
+        ("role", pa.string()),
+        ("llm_name", pa.string()),
+        ("llm_params", pa.string()),
+        ("message_chars", pa.int32()),
+        ("estimated_tokens", pa.int32()),
+        ("truncated", pa.bool_()),
+        ("ttft_ms", pa.int32()),
+        ("duration_ms", pa.int32()),
+        ("created_at", timestamp),
+        ("exported_at", timestamp),
+    ])
+    return {"conversations": conversations, "turns": turns}
+
+
+def _utc(value):
+    # the database stores naive UTC times
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=datetime.timezone.utc)
+
+
+def _params(value):
+    return json.dumps(value, sort_keys=True) if value is not None else None
+
+
+def hash_user(user_email, key=None):
+    """Returns the HMAC-SHA256 of a user email, or None without a key."""
+    key = ANALYTICS_HASH_KEY if key is None else key
+    if not key or not user_email:
+        return None
+    return hmac.new(key.encode(), user_email.encode(), hashlib.sha256).hexdigest()
+
+
+def conversations_after(watermark, until, limit=None):
+    """Returns a page of conversations active after a watermark.
+    Args:
+        watermark: (last_message_at, id) of the last exported conversation, or None.
+        until: Conversations active from this time on are not returned.
+        limit: Number of conversations of the page, EXPORT_BATCH_SIZE by default.
+    Returns:
+        List of conversation rows, least recently active first.
+    """
+    table = ConversationSQL.__table__
+    statement = (
+        sqlalchemy.select(
+            table.c.id,
+            table.c.user_email,
+            table.c.llm_name,
+            table.c.llm_params,
+            table.c.message_count,
+            table.c.created_at,
+            table.c.last_message_at,
+        )
+        .where(table.c.deleted_at.is_(None), table.c.last_message_at < until)
+        .order_by(table.c.last_message_at, table.c.id)
+        .limit(limit or EXPORT_BATCH_SIZE)
+    )
+    if watermark is not None:
+        statement = statement.where(
+            sqlalchemy.tuple_(table.c.last_message_at, table.c.id) > tuple(watermark)
+        )
+    with get_read_engine().connect() as connection:
+        return connection.execute(statement).all()
+
+
+def read_messages(conversation_id):
+    """Returns the messages of a conversation, raising when they cannot be read."""
+    messages = get_file_from_gcs(conversation_id=conversation_id, file_name="message")
+    if isinstance(messages, tuple):
+        raise RuntimeError(f"Failed to read the messages of {conversation_id}")
+    return messages if isinstance(messages, list) else []
+
+
+def turn_rows(conversation, messages, exported_at):
+    """Returns the turns rows of a conversation's messages."""
+    rows = []
+    for turn, message in enumerate(messages):
+        metadata = message.get("metadata") or {}
+        text = message.get("message") or ""
+        created_at = metadata.get("created_at")
+        answer = message.get("role") != "user"
+        rows.append({
+            "conversation_id": str(conversation.id),
+            "turn": turn,
+            "role": message.get("role"),
+            # answers stored before their metadata are of the conversation's LLM
+            "llm_name": (
+                metadata.get("llm_name") or message.get("llm_name") or conversation.llm_name
+                if answer else None
+            ),
+            "llm_params": _params(metadata.get("llm_params")),
+            "message_chars": len(text),
+            "estimated_tokens": estimate_tokens(text),
+            "truncated": bool(message.get("truncated")),
+            "ttft_ms": metadata.get("ttft_ms"),
+            "duration_ms": metadata.get("duration_ms"),
+            "created_at": (
+                datetime.datetime.fromisoformat(created_at) if created_at else None
+            ),
+            "exported_at": exported_at,
+        })
+    return rows
+
+
+def conversation_row(conversation, exported_at):
+    """Returns the conversations row of a conversation."""
+    return {
+        "conversation_id": str(conversation.id),
+        "user_hash": hash_user(conversation.user_email),
+        "llm_name": conversation.llm_name,
+        "llm_params": _params(conversation.llm_params),
+        "message_count": conversation.message_count,
+        "created_at": _utc(conversation.created_at),
+        "last_message_at": _utc(conversation.last_message_at),
+        "exported_at": exported_at,
+    }
+
+
+class Exporter:
+    """Writes pages of conversations to partitioned files of an output URI."""
+
+    def __init__(self, output, file_format="parquet", workers=EXPORT_WORKERS):
+        if file_format not in FORMATS:
+            raise ValueError(f"Unknown format {file_format}, expected one of {list(FORMATS)}")
+        if output.rstrip("/") == f"gs://{SERVING_BUCKET}" or output.startswith(
+            f"gs://{SERVING_BUCKET}/"
+        ):
+            raise ValueError(f"Exports must not be written to the serving bucket {SERVING_BUCKET}")
+        pa = _pyarrow()
+        self.pa = pa
+        self.filesystem, self.path = pa.fs.FileSystem.from_uri(output)
+        self.path = self.path.rstrip("/")
+        self.file_format = file_format
+        self.schemas = schemas()
+        self.run_id = uuid.uuid4().hex[:12]
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export")
+
+    def read_watermark(self):
+        """Returns the (last_message_at, id) of the last exported conversation, or None."""
+        try:
+            with self.filesystem.open_input_stream(f"{self.path}/{WATERMARK_FILE}") as stream:
+                watermark = json.loads(stream.read())
+        except FileNotFoundError:
+            return None
+        return (
+            datetime.datetime.fromisoformat(watermark["last_message_at"]),
+            watermark["id"],
+        )
+
+    def write_watermark(self, conversation):
+        self.filesystem.create_dir(self.path, recursive=True)
+        with self.filesystem.open_output_stream(f"{self.path}/{WATERMARK_FILE}") as stream:
+            stream.write(json.dumps({
+                "last_message_at": conversation.last_message_at.isoformat(),
+                "id": str(conversation.id),
+            }).encode())
+
+    def write_table(self, name, rows, partition, page):
+        """Writes the rows of one partition of a table to a new file."""
+        table = self.pa.Table.from_pylist(rows, schema=self.schemas[name])
+        directory = f"{self.path}/{name}/dt={partition}"
+        self.filesystem.create_dir(directory, recursive=True)
+        path = f"{directory}/part-{self.run_id}-{page:05d}{FORMATS[self.file_format]}"
+        if self.file_format == "parquet":
+            self.pa.parquet.write_table(
+                table, path, filesystem=self.filesystem, compression="zstd"
+            )
+        else:
+            with self.filesystem.open_output_stream(path) as stream:
+                with self.pa.ipc.new_file(stream, table.schema) as writer:
+                    writer.write_table(table)
+        return path
+
+    def export_page(self, conversations, page):
+        """Exports a page of conversations and their turns.
+        Returns:
+            The paths of the written files.
+        """
+        exported_at = datetime.datetime.now(datetime.timezone.utc)
+        # reads fail the run, the page is exported again by the next one
+        messages = self.executor.map(read_messages, [c.id for c in conversations])
+        partitions = {}
+        for conversation, conversation_messages in zip(conversations, messages):
+            partition = partitions.setdefault(
+                conversation.last_message_at.date().isoformat(),
+                {"conversations": [], "turns": []},
+            )
+            partition["conversations"].append(conversation_row(conversation, exported_at))
+            partition["turns"].extend(
+                turn_rows(conversation, conversation_messages, exported_at)
+            )
+        paths = []
+        for partition, tables in sorted(partitions.items()):
+            for name, rows in tables.items():
+                if rows:
+                    paths.append(self.write_table(name, rows, partition, page))
+        return paths
+
+    def run(self, until=None):
+        """Exports every conversation active since the watermark.
+        Args:
+            until: Conversations active from this time on are left for the
+                next run, defaults to EXPORT_SETTLE_SECONDS ago.
+        Returns:
+            The number of exported conversations.
+        """
+        if until is None:
+            until = datetime.datetime.now(datetime.timezone.utc).replace(
+                tzinfo=None
+            ) - datetime.timedelta(seconds=EXPORT_SETTLE_SECONDS)
+        if not ANALYTICS_HASH_KEY:
+            logging.warning("ANALYTICS_HASH_KEY is not set, user_hash is not exported")
+        watermark = self.read_watermark()
+        exported = page = 0
+        while True:
+            conversations = conversations_after(watermark, until)
+            if not conversations:
+                break
+            paths = self.export_page(conversations, page)
+            self.write_watermark(conversations[-1])
+            watermark = (conversations[-1].last_message_at, conversations[-1].id)
+            exported += len(conversations)
+            page += 1
+            logging.info(f"Exported {exported} conversations, {len(paths)} files of page {page}")
+        logging.info(f"Export {self.run_id} done, {exported} conversations")
+        return exported
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--output", default=ANALYTICS_EXPORT_URI,
+        help="local directory or gs:// URI, defaults to ANALYTICS_EXPORT_URI",
+    )
+    parser.add_argument("--format", choices=list(FORMATS), default="parquet")
+    parser.add_argument("--workers", type=int, default=EXPORT_WORKERS)
+    args = parser.parse_args(argv)
+    if not args.output:
+        parser.error("--output or ANALYTICS_EXPORT_URI is required")
+
+    logging.basicConfig(level=logging.INFO)
+    Exporter(args.output, args.format, args.workers).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import time
+import pytest
+from flask import Flask
+from app.main.service import batch_service
+from app.main.util import codec
+
+LLM = {
+    "name": "Gemini",
+    "provider": "google",
+    "params": {"temp": 0.1},
+    "is_active": True,
+}
+
+
+class FakeLLM:
+    def generate_response(self, context, prompt, params, stream):
+        if prompt == "fail":
+            raise RuntimeError("quota exceeded")
+        yield {"result": "success", "data": [{"role": "system", "message": prompt.upper()}]}
+
+
+@pytest.fixture
+def store(mocker):
+    store = {}
+    mocker.patch.object(
+        batch_service,
+        "write_blob_to_gcs",
+        side_effect=lambda name, payload, **kwargs: store.__setitem__(name, payload) or True,
+    )
+    mocker.patch.object(batch_service, "get_blob_from_gcs", side_effect=store.get)
+    mocker.patch.object(batch_service, "get_llm", return_value=LLM)
+    mocker.patch.object(batch_service, "get_llm_model", return_value=FakeLLM())
+    mocker.patch.object(batch_service, "BATCH_CHECKPOINT_EVERY", 2)
+    mocker.patch.object(batch_service, "BATCH_DEFAULT_RATE_LIMIT", 1000)
+    return store
+
+
+def wait_for(job_id, user_email="test@example.com"):
+    for _ in range(100):
+        status = batch_service.get_batch_job_status(user_email, job_id)
+        if status["status"] != "running":
+            return status
+        time.sleep(0.05)
+    pytest.fail("batch job did not finish")
+
+
+def read_results(store, status):
+    results = []
+    for part in status["result_parts"]:
+        results.extend(codec.loads(line) for line in store[part].splitlines())
+    return sorted(results, key=lambda result: result["index"])
+
+
+def test_parse_prompts():
+    prompts = batch_service.parse_prompts(b'{"prompt": "a", "id": 1}\n\n{"prompt": "b"}\n')
+    assert prompts == [{"prompt": "a", "id": 1}, {"prompt": "b"}]
+    with pytest.raises(ValueError):
+        batch_service.parse_prompts(b'{"text": "a"}')
+
+
+def test_batch_job_writes_ndjson_results(store):
+    prompts = [{"prompt": "a"}, {"prompt": "b"}, {"prompt": "c"}]
+    job_id = batch_service.create_batch_job("test@example.com", "Gemini", prompts)["id"]
+
+    status = wait_for(job_id)
+
+    assert status["status"] == "done"
+    assert status["completed"] == 3
+    assert [result["response"] for result in read_results(store, status)] == ["A", "B", "C"]
+    checkpoint = codec.loads(store[f"test@example.com/batches/{job_id}/checkpoint.json"])
+    assert checkpoint["completed"] == [0, 1, 2]
+
+
+def test_batch_job_resume_retries_failed_prompts(store):
+    prompts = [{"prompt": "a"}, {"prompt": "fail"}]
+    job_id = batch_service.create_batch_job("test@example.com", "Gemini", prompts)["id"]
+    assert wait_for(job_id)["status"] == "failed"
+
+    prompts_blob = f"test@example.com/batches/{job_id}/prompts.json"
+    store[prompts_blob] = codec.dumps([{"prompt": "a"}, {"prompt": "b"}])
+    batch_service.resume_batch_job("test@example.com", job_id)
+    status = wait_for(job_id)
+
+    assert status["status"] == "done"
+    assert status["completed"] == 2
+    assert [result.get("response") for result in read_results(store, status)] == [
+        "A",
+        None,
+        "B",
+    ]
+
+
+def test_resume_batch_job_of_another_user_is_not_found(store, mocker):
+    job = mocker.Mock(user_email="owner@example.com", status="running")
+    mocker.patch.dict(batch_service._jobs, {"job-1": job})
+
+    with Flask(__name__).app_context():
+        _, status_code = batch_service.resume_batch_job("test@example.com", "job-1")
+
+    assert status_code == 404
+    job.to_dict.assert_not_called()
+
+
+def test_checkpoint_keeps_results_whose_part_was_not_written(store, mocker):
+    job = batch_service.BatchJob("job-1", "test@example.com", LLM, {}, [{"prompt": "a"}])
+    job.record({"index": 0, "response": "A"})
+    write_blob = mocker.patch.object(batch_service, "write_blob_to_gcs", return_value=False)
+
+    assert not job.checkpoint()
+
+    write_blob.assert_called_once()
+    assert (job.parts, job.completed, len(job.pending_results)) == (0, set(), 1)
+    write_blob.return_value = True
+    assert job.checkpoint()
+    assert (job.parts, job.completed, job.pending_results) == (1, {0}, [])
+
+
+def test_create_batch_job_fails_when_prompts_are_not_stored(store, mocker):
+    mocker.patch.object(batch_service, "write_blob_to_gcs", return_value=False)
+    start = mocker.patch.object(batch_service, "_start")
+
+    with Flask(__name__).app_context():
+        _, status_code = batch_service.create_batch_job(
+            "test@example.com", "Gemini", [{"prompt": "a"}]
+        )
+
+    assert status_code == 503
+    start.assert_not_called()
@@ -1,5 +1,7 @@
 import pytest
 import uuid
+import datetime
+import sqlalchemy
 from unittest.mock import MagicMock, create_autospec
 from http import HTTPStatus
 from app.main.service.conversation_service import (
@@ -7,7 +9,13 @@ from app.main.service.conversation_service import (
     get_user_conversations,
     create_conversation,
     get_conversation,
+    get_user_conversations_page,
+    get_conversation_settings,
+    update_conversation_settings,
+    flush_settings_reconciler,
 )
+from app.main.service import conversation_service
+from app.main.util.cache import TTLCache
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import OperationalError
 from app import create_app  # Adjust import according to your app's structure
@@ -37,6 +45,9 @@ def mock_session(mocker):
     mocker.patch(
         "app.main.service.conversation_service.Session", return_value=mock_session
     )
+    # Sessions are opened on the shared engine, which is never connected
+    mocker.patch("app.main.service.conversation_service.get_engine")
+    mocker.patch("app.main.service.conversation_service.get_read_engine")
     return mock_session
 
 
@@ -67,7 +78,7 @@ def test_create_conversation_success(mock_session, mocker):
         return_value=mock_conversation,
     )
     # Patch the engine so that no actual database connection is used
-    mocker.patch("app.main.service.conversation_service.engine")
+    mocker.patch("app.main.service.conversation_service.get_engine")
 
     # Ensure that add, commit, and close do not raise exceptions
     mock_session.add.return_value = None
@@ -122,7 +133,7 @@ def test_create_conversation_failure(client, mock_session, mocker):
     mocker.patch(
         "app.main.model.conversation.ConversationSQL", return_value=mock_conversation
     )
-    mocker.patch("app.main.service.conversation_service.engine")
+    mocker.patch("app.main.service.conversation_service.get_engine")
 
     # Patch the Session methods to raise OperationalError
     mock_session.add.side_effect = OperationalError("INSERT ...", {}, "database error")
@@ -252,3 +263,172 @@ def test_get_user_conversations_operational_error(client, mock_session):
 
     # Assert status code (optional, depending on what you're testing)
     assert status_code == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@pytest.fixture
+def sqlite_engine(mocker):
+    from benchmarks import fakes  # noqa: F401, renders UUID columns on SQLite
+    from app.main.model.conversation import Base, ConversationSQL
+
+    engine = sqlalchemy.create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    mocker.patch(
+        "app.main.service.conversation_service.get_engine", return_value=engine
+    )
+    mocker.patch(
+        "app.main.service.conversation_service.get_read_engine", return_value=engine
+    )
+    created_at = datetime.datetime(2024, 7, 13)
+    with Session(engine) as session:
+        for index in range(5):
+            conversation = ConversationSQL(
+                f"00000000-0000-4000-8000-00000000000{index}",
+                "test@example.com",
+                f"Chat {index}",
+                "Gemini",
+                {},
+            )
+            # two conversations active at the same time
+            conversation.created_at = created_at + datetime.timedelta(minutes=min(index, 3))
+            conversation.last_message_at = conversation.created_at
+            session.add(conversation)
+        session.commit()
+    return engine
+
+
+def test_get_user_conversations_page_follows_cursor(sqlite_engine):
+    """Test that pages read by cursor cover every conversation once, newest first."""
+    titles, cursor = [], None
+    while True:
+        page = get_user_conversations_page("test@example.com", 2, cursor)
+        titles += [conversation["title"] for conversation in page["conversations"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+
+    assert titles == ["Chat 3", "Chat 4", "Chat 2", "Chat 1", "Chat 0"]
+
+
+def test_update_conversation_summary_moves_conversation_first(sqlite_engine, settings_cache):
+    """Test that persisting a turn updates the summary and the activity order."""
+    conversation_id = "00000000-0000-4000-8000-000000000001"
+    conversation_service.get_conversation_settings(conversation_id)
+    messages = [{"role": "user", "message": "hi"}, {"role": "system", "message": "y" * 300}]
+
+    conversation_service.update_conversation_summary(conversation_id, messages)
+
+    first = get_user_conversations_page("test@example.com", 1)["conversations"][0]
+    assert first["title"] == "Chat 1"
+    assert first["message_count"] == 2
+    assert first["last_message_preview"] == "y" * conversation_service.PREVIEW_LENGTH
+    cached = conversation_service.get_conversation_settings(conversation_id)
+    assert cached["message_count"] == 2
+    assert cached["last_message_at"] == first["last_message_at"]
+
+
+def test_get_user_conversations_page_invalid_cursor(client):
+    """Test that a malformed cursor is a bad request."""
+    with client.application.app_context():
+        _, status_code = get_user_conversations_page("test@example.com", 2, "not-a-cursor")
+
+    assert status_code == HTTPStatus.BAD_REQUEST
+
+
+@pytest.fixture
+def settings_cache(mocker):
+    mocker.patch.object(conversation_service, "_settings_cache", TTLCache(10, 60))
+
+
+def test_get_conversation_settings_reads_row_once(sqlite_engine, settings_cache, mocker):
+    """Test that settings are read from the conversation row, then from the cache."""
+    read = mocker.spy(conversation_service, "_read_conversation_settings")
+    get_file = mocker.patch.object(conversation_service, "get_file_from_gcs")
+    conversation_id = "00000000-0000-4000-8000-000000000001"
+
+    for _ in range(3):
+        settings = get_conversation_settings(conversation_id)
+        assert (settings["title"], settings["llm_name"]) == ("Chat 1", "Gemini")
+
+    read.assert_called_once()
+    get_file.assert_not_called()
+
+
+def test_get_conversation_settings_falls_back_to_gcs(sqlite_engine, settings_cache, mocker):
+    """Test that conversations without a row are read from llm-settings.json."""
+    get_file = mocker.patch.object(
+        conversation_service, "get_file_from_gcs", return_value={"llm_name": "Codestral"}
+    )
+
+    assert get_conversation_settings("legacy") == {"llm_name": "Codestral"}
+    get_file.assert_called_once_with(conversation_id="legacy", file_name="llm-settings")
+
+
+def test_update_conversation_settings_writes_sql_then_gcs(sqlite_engine, settings_cache, mocker):
+    """Test that a PATCH updates the row and cache, and llm-settings.json in the background."""
+    write_file = mocker.patch.object(
+        conversation_service, "write_file_to_gcs", return_value=({}, 200)
+    )
+    conversation_id = "00000000-0000-4000-8000-000000000002"
+
+    updated = update_conversation_settings(conversation_id, {"llm_name": "Codestral"})
+
+    assert updated["llm_name"] == "Codestral"
+    assert get_conversation_settings(conversation_id) is updated
+    assert conversation_service._read_conversation_settings(conversation_id) == updated
+    assert flush_settings_reconciler(timeout=5)
+    write_file.assert_called_once_with(
+        conversation_id=conversation_id, data=updated, file_name="llm-settings"
+    )
+
+
+def test_get_conversations_batch(sqlite_engine, settings_cache, mocker):
+    """Test that rows, storage settings and previews of a batch are returned in order."""
+    rowless = {"id": "c9", "user_email": "test@example.com", "title": "Old chat"}
+    files = {
+        ("c9", "llm-settings"): rowless,
+        ("c8", "llm-settings"): dict(rowless, id="c8", user_email="other@example.com"),
+        ("c9", "message"): [{"role": "user", "message": "hi"}, {"role": "system", "message": "x" * 500}],
+    }
+    get_file = mocker.patch.object(
+        conversation_service,
+        "get_file_from_gcs",
+        side_effect=lambda conversation_id, file_name: files.get((conversation_id, file_name), {}),
+    )
+    read = mocker.spy(conversation_service, "_read_conversations")
+    ids = ["c9", "00000000-0000-4000-8000-000000000002", "c8", "c9"]
+    conversation_service.update_conversation_summary(
+        ids[1], [{"role": "user", "message": "hi"}, {"role": "system", "message": "hello"}]
+    )
+
+    batch = conversation_service.get_conversations_batch(ids, "test@example.com", True)
+
+    assert [c["title"] for c in batch["conversations"]] == ["Old chat", "Chat 2"]
+    assert batch["missing"] == ["c8"]
+    assert batch["conversations"][0]["preview"] == {"role": "system", "message": "x" * 200}
+    assert batch["conversations"][1]["preview"] == {"role": "system", "message": "hello"}
+    read.assert_called_once()
+    # settings of c9 and c8 and the preview of c9, the row has its own
+    assert get_file.call_count == 3
+
+
+def test_batch_and_delete_report_invalid_ids_missing(client, mocker):
+    """Test that ids which are not UUIDs are missing rather than failing the request."""
+    valid_id = "00000000-0000-4000-8000-000000000002"
+    get_batch = mocker.patch(
+        "app.main.controller.conversation_controller.get_conversations_batch",
+        return_value={"conversations": [], "missing": [valid_id]},
+    )
+    delete = mocker.patch(
+        "app.main.controller.conversation_controller.delete_conversations",
+        return_value={"deleted": [], "missing": []},
+    )
+    body = {"userEmail": "test@example.com", "ids": ["c9", valid_id]}
+
+    response = client.post("/conversations/batch", json=body)
+
+    assert response.json["missing"] == ["c9", valid_id]
+    get_batch.assert_called_once_with([valid_id], "test@example.com", False)
+    assert client.delete("/conversations", json=body).json["missing"] == ["c9"]
+    response = client.delete("/conversations/c9?userEmail=test@example.com")
+    assert response.status_code == 404
+    delete.assert_called_once_with("test@example.com", [valid_id])
@@ -0,0 +1,156 @@
+import threading
+import pytest
+from app.main.service.generation_service import (
+    Generation,
+    GenerationExpired,
+    _generations,
+    _remove_expired_generations,
+    get_generation,
+    start_generation,
+)
+
+
+def messages(count):
+    for i in range(count):
+        yield {"role": "system", "message": str(i)}
+
+
+def test_generation_replays_from_offset():
+    generation = start_generation("conversation-1", messages(5))
+
+    live = [message["message"] for _, message in generation.reader()]
+    resumed = [message["message"] for _, message in generation.reader(offset=3)]
+
+    assert live == ["0", "1", "2", "3", "4"]
+    assert resumed == ["3", "4"]
+    assert get_generation("conversation-1", generation.id) is generation
+    assert get_generation("conversation-2", generation.id) is None
+
+
+def test_generation_consumes_messages_once():
+    produced = []
+
+    def tracked_messages():
+        for message in messages(3):
+            produced.append(message)
+            yield message
+
+    generation = start_generation("conversation-1", tracked_messages())
+    list(generation.reader())
+    list(generation.reader())
+
+    assert len(produced) == 3
+
+
+def test_generation_offset_evicted_from_buffer():
+    generation = Generation("conversation-1", buffer_size=2, spill=False)
+    for message in messages(4):
+        generation.append(message)
+    generation.finish()
+
+    with pytest.raises(GenerationExpired):
+        generation.reader(offset=1)
+    assert [sequence for sequence, _ in generation.reader(offset=2)] == [2, 3]
+
+
+def test_generation_spills_evicted_chunks_to_gcs(mocker):
+    store = {}
+
+    def write_file(conversation_id, data, file_name):
+        store[file_name] = data
+        return {}, 200
+
+    mocker.patch(
+        "app.main.service.generation_service.write_file_to_gcs", side_effect=write_file
+    )
+    mocker.patch(
+        "app.main.service.generation_service.get_file_from_gcs",
+        side_effect=lambda conversation_id, file_name: store.get(file_name, {}),
+    )
+    generation = Generation("conversation-1", buffer_size=2, spill=True)
+    for message in messages(7):
+        generation.append(message)
+    generation.finish()
+
+    assert len(store) == 2
+    assert generation.spilled == [0, 1]
+    replayed = [message["message"] for _, message in generation.reader(offset=1)]
+    assert replayed == ["1", "2", "3", "4", "5", "6"]
+
+
+def test_generation_keeps_blocks_that_failed_to_spill(mocker):
+    mocker.patch(
+        "app.main.service.generation_service.write_file_to_gcs",
+        return_value=({"error": "unavailable"}, 400),
+    )
+    get_file = mocker.patch("app.main.service.generation_service.get_file_from_gcs")
+    generation = Generation("conversation-1", buffer_size=2, spill=True)
+    for message in messages(5):
+        generation.append(message)
+    generation.finish()
+
+    replayed = [message["message"] for _, message in generation.reader()]
+
+    assert replayed == ["0", "1", "2", "3", "4"]
+    get_file.assert_not_called()
+    assert generation.spilled_blob_names() == []
+
+
+def test_expired_generations_delete_their_spilled_blocks(mocker):
+    mocker.patch("app.main.service.generation_service.GENERATION_RETENTION_SECONDS", 0)
+    deleted = threading.Event()
+    delete_blobs = mocker.patch(
+        "app.main.service.generation_service.delete_blobs_in_gcs",
+        side_effect=lambda names: deleted.set() or [],
+    )
+    generation = Generation("conversation-1", spill=True)
+    generation.spilled.extend([0, 1])
+    generation.finish()
+    mocker.patch.dict(_generations, {generation.id: generation})
+
+    _remove_expired_generations()
+
+    assert deleted.wait(timeout=5)
+    assert generation.id not in _generations
+    delete_blobs.assert_called_once_with([
+        f"user@example.com/conversation-1/generation-{generation.id}-0.json",
+        f"user@example.com/conversation-1/generation-{generation.id}-1.json",
+    ])
+
+
+def test_generation_cancelled_when_last_reader_disconnects(mocker):
+    mocker.patch(
+        "app.main.service.generation_service.GENERATION_RESUME_GRACE_SECONDS", 0
+    )
+    generation = Generation("conversation-1")
+    reader = generation.reader()
+    generation.append({"role": "system", "message": "partial"})
+    reader.close()
+
+    assert generation.cancel_event.wait(timeout=5)
+
+
+def test_generation_not_cancelled_when_client_reconnects(mocker):
+    mocker.patch(
+        "app.main.service.generation_service.GENERATION_RESUME_GRACE_SECONDS", 0.2
+    )
+    generation = Generation("conversation-1")
+    generation.reader().close()
+    generation.reader(offset=0)
+
+    assert not generation.cancel_event.wait(timeout=0.5)
+
+
+def test_generation_cancelled_when_client_leaves_before_first_frame(mocker):
+    from flask import Flask
+    from app.main.controller.conversation_controller import stream_generation
+
+    mocker.patch(
+        "app.main.service.generation_service.GENERATION_RESUME_GRACE_SECONDS", 0
+    )
+    generation = Generation("conversation-1")
+    with Flask(__name__).test_request_context():
+        response = stream_generation(generation)
+    response.close()
+
+    assert generation.cancel_event.wait(timeout=5)
@@ -0,0 +1,75 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from collections import deque
+from unittest.mock import MagicMock
+from flask import Flask
+from app.main.service import llm_service
+
+GEMINI = {"name": "Gemini", "is_active": True}
+
+
+@pytest.fixture
+def load_catalog(mocker):
+    mocker.patch.object(llm_service, "_catalog", None)
+    return mocker.patch.object(
+        llm_service, "load_llm_catalog", return_value={"Gemini": GEMINI}
+    )
+
+
+def test_catalog_is_loaded_once(load_catalog):
+    assert llm_service.is_llm_active("Gemini") is True
+    assert llm_service.get_llm("Gemini") == GEMINI
+    assert llm_service.get_llms() == [GEMINI]
+    assert llm_service.is_llm_active("Codestral") == {"error": "LLM Not Found."}
+
+    load_catalog.assert_called_once()
+
+
+def test_catalog_is_reloaded_after_ttl(load_catalog, mocker):
+    mocker.patch.object(llm_service, "LLM_CATALOG_TTL_SECONDS", 0)
+
+    llm_service.is_llm_active("Gemini")
+    llm_service.is_llm_active("Gemini")
+
+    assert load_catalog.call_count == 2
+
+
+def test_update_llm_invalidates_catalog(load_catalog, mocker):
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
+    mocker.patch.object(llm_service, "Session", return_value=session)
+    mocker.patch.object(llm_service, "get_engine")
+    llm_service.is_llm_active("Gemini")
+
+    with Flask(__name__).app_context():
+        llm_service.update_llm("Gemini", False)
+    llm_service.is_llm_active("Gemini")
+
+    assert load_catalog.call_count == 2
+    notify = session.execute.call_args.args[0]
+    assert str(notify) == f"NOTIFY {llm_service.LLM_CATALOG_CHANNEL}"
+    session.commit.assert_called_once()
+
+
+def test_wait_for_notification_reads_pg8000_notifications():
+    connection = MagicMock(spec=["notifications"])
+    connection.notifications = deque()
+    cursor = MagicMock()
+
+    assert llm_service._wait_for_notification(connection, cursor) is False
+    connection.notifications.append((1, llm_service.LLM_CATALOG_CHANNEL, ""))
+    assert llm_service._wait_for_notification(connection, cursor) is True
+    assert not connection.notifications
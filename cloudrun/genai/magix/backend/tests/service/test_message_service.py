@@ -0,0 +1,110 @@
+from app.main.service import message_service
+from app.main.service.message_service import (
+    context_for_llm,
+    generate_fanout_messages,
+    generate_messages,
+)
+
+
+class FakeLLM:
+    def __init__(self, name, chunks):
+        self.name = name
+        self.chunks = chunks
+        self.contexts = []
+
+    def generate_response(self, context, prompt, params, stream=True, cancel_event=None):
+        self.contexts.append(context)
+        for chunk in self.chunks:
+            yield {"result": "success", "data": [{"role": "system", "message": chunk}]}
+
+
+def test_context_for_llm_keeps_one_answer_per_turn():
+    context = [
+        {"role": "user", "message": "q1"},
+        {"role": "system", "message": "gemini", "llm_name": "Gemini"},
+        {"role": "system", "message": "codestral", "llm_name": "Codestral"},
+        {"role": "user", "message": "q2"},
+        {"role": "system", "message": "a2"},
+    ]
+
+    assert [m["message"] for m in context_for_llm(context, "Codestral")] == [
+        "q1", "codestral", "q2", "a2",
+    ]
+    assert [m["message"] for m in context_for_llm(context, "Other")] == [
+        "q1", "gemini", "q2", "a2",
+    ]
+
+
+def test_fanout_streams_tagged_chunks_and_writes_once(mocker):
+    llms = {
+        "Gemini": FakeLLM("Gemini", ["Hello", " world"]),
+        "Codestral": FakeLLM("Codestral", ["print('hi')"]),
+    }
+    mocker.patch.object(message_service, "list_folders_in_gcs", return_value=["c1"])
+    mocker.patch.object(
+        message_service, "get_conversation", return_value={"title": "Chat"}
+    )
+    mocker.patch.object(message_service, "get_context_from_bucket", return_value=[])
+    mocker.patch.object(
+        message_service,
+        "get_conversation_settings",
+        return_value={"llm_name": "Gemini", "llm_params": {}},
+    )
+    mocker.patch.object(message_service, "is_llm_active", return_value=True)
+    mocker.patch.object(message_service, "get_llm_model", side_effect=llms.get)
+    write_file = mocker.patch.object(message_service, "write_file_to_gcs")
+    index = mocker.patch.object(message_service, "index_messages")
+    summarise = mocker.patch.object(message_service, "update_conversation_summary")
+
+    chunks = list(
+        generate_messages(
+            "c1",
+            {"role": "user", "message": "hi", "llm_names": ["Gemini", "Codestral"]},
+        )
+    )
+
+    assert sorted((c["llm_name"], c["message"]) for c in chunks) == [
+        ("Codestral", "print('hi')"),
+        ("Gemini", " world"),
+        ("Gemini", "Hello"),
+    ]
+    write_file.assert_called_once()
+    data = write_file.call_args.kwargs["data"]
+    metadata = [message.pop("metadata") for message in data[1:]]
+    assert data == [
+        {"role": "user", "message": "hi"},
+        {"role": "system", "message": "Hello world", "llm_name": "Gemini"},
+        {"role": "system", "message": "print('hi')", "llm_name": "Codestral"},
+    ]
+    assert [m["llm_name"] for m in metadata] == ["Gemini", "Codestral"]
+    assert all(0 <= m["ttft_ms"] <= m["duration_ms"] for m in metadata)
+    index.assert_called_once_with("c1", write_file.call_args.kwargs["data"])
+    summarise.assert_called_once_with("c1", write_file.call_args.kwargs["data"])
+
+
+def test_fanout_reports_and_skips_failed_llms(mocker):
+    class FailingLLM:
+        def generate_response(self, context, prompt, params, stream, cancel_event=None):
+            yield {"data": [{"role": "system", "message": "partial"}]}
+            raise RuntimeError("quota exceeded")
+
+    llms = {"Gemini": FakeLLM("Gemini", ["Hello"]), "Codestral": FailingLLM()}
+    mocker.patch.object(message_service, "get_llm_model", side_effect=llms.get)
+    mocker.patch.object(message_service, "is_llm_active", return_value=True)
+    write_file = mocker.patch.object(message_service, "write_file_to_gcs")
+    index = mocker.patch.object(message_service, "index_messages")
+    mocker.patch.object(message_service, "update_conversation_summary")
+
+    chunks = list(
+        generate_fanout_messages(
+            "c1", [], {"role": "user", "message": "hi"}, ["Gemini", "Codestral"], {}
+        )
+    )
+
+    assert {"role": "error", "message": "quota exceeded", "llm_name": "Codestral"} in chunks
+    data = write_file.call_args.kwargs["data"]
+    assert [(m["role"], m.get("llm_name")) for m in data] == [
+        ("user", None),
+        ("system", "Gemini"),
+    ]
+    index.assert_called_once_with("c1", data)
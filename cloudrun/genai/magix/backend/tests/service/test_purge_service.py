@@ -0,0 +1,126 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import sqlalchemy
+from sqlalchemy.orm import Session
+from benchmarks.fakes import FakeStorageClient
+from app.main.model.conversation import ConversationSQL
+from app.main.model.search import MessageSearchSQL
+from app.main.service import conversation_service, purge_service
+from app import create_app
+from app.main.util import utils
+from app.main.util.cache import TTLCache
+from db import migrate
+
+USER = "user@example.com"
+IDS = [f"00000000-0000-4000-8000-00000000000{index}" for index in range(3)]
+
+
+@pytest.fixture
+def storage(mocker):
+    storage = FakeStorageClient()
+    mocker.patch.object(utils, "get_storage_client", storage)
+    return storage
+
+
+@pytest.fixture
+def engine(tmp_path, mocker, storage):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate.upgrade(engine)
+    for module in (conversation_service, purge_service):
+        mocker.patch.object(module, "get_engine", return_value=engine)
+    mocker.patch.object(conversation_service, "get_read_engine", return_value=engine)
+    wake = mocker.patch.object(conversation_service, "wake_purger")
+    with Session(engine) as session:
+        for conversation_id in IDS:
+            session.add(ConversationSQL(conversation_id, USER, "Chat", "Gemini", {}))
+            session.add(
+                MessageSearchSQL(conversation_id=conversation_id, user_email=USER, message="hi")
+            )
+            for file_name in ("message", "llm-settings"):
+                utils.write_file_to_gcs(conversation_id, {}, file_name)
+        session.commit()
+    engine.wake = wake
+    return engine
+
+
+def remaining(engine, column):
+    with Session(engine) as session:
+        return sorted({row[0] for row in session.query(column)})
+
+
+def test_deleted_conversations_are_hidden_then_purged(engine, storage, mocker):
+    result = conversation_service.delete_conversations(USER, IDS[:2] + ["unknown"])
+
+    assert result == {"deleted": IDS[:2], "missing": ["unknown"]}
+    engine.wake.assert_called_once()
+    conversations = conversation_service.get_user_conversations(USER, 0, 10)
+    assert [c["id"] for c in conversations] == IDS[2:]
+    assert conversation_service.delete_conversations(USER, IDS[:1])["missing"] == IDS[:1]
+
+    # running generations may still write files of the conversations
+    assert purge_service.purge_once() == 0
+    mocker.patch.object(purge_service, "PURGE_DELAY_SECONDS", 0)
+    assert purge_service.purge_once() == 2
+    assert remaining(engine, ConversationSQL.id) == IDS[2:]
+    assert remaining(engine, MessageSearchSQL.conversation_id) == IDS[2:]
+    assert sorted(name.split("/")[1] for _, name in storage.objects) == IDS[2:] * 2
+    assert purge_service.purge_once() == 0
+
+
+def test_conversations_with_undeleted_files_are_purged_later(engine, mocker):
+    conversation_service.delete_conversations(USER, IDS)
+    mocker.patch.object(purge_service, "PURGE_DELAY_SECONDS", 0)
+    failing = f"{USER}/{IDS[1]}/message.json"
+    delete_blobs = mocker.patch.object(
+        purge_service,
+        "delete_blobs_in_gcs",
+        side_effect=lambda names: [name for name in names if name == failing],
+    )
+    mocker.patch.object(purge_service, "GCS_BATCH_SIZE", 4)
+
+    assert purge_service.purge_once() == 2
+    # 6 files in batches of 4
+    assert delete_blobs.call_count == 2
+    assert remaining(engine, ConversationSQL.id) == [IDS[1]]
+
+
+def test_deleted_conversations_are_not_read_or_written(engine, mocker):
+    mocker.patch.object(conversation_service, "_settings_cache", TTLCache(10, 60))
+    conversation_service.delete_conversations(USER, IDS[:1])
+    app = create_app()
+
+    with app.app_context():
+        _, status_code = conversation_service.get_conversation_settings(IDS[0])
+        assert status_code == 404
+        _, status_code = conversation_service.update_conversation_settings(
+            IDS[0], {"title": "Renamed"}
+        )
+        assert status_code == 404
+    conversation_service.update_conversation_summary(
+        IDS[0], [{"role": "system", "message": "late answer"}]
+    )
+    with Session(engine) as session:
+        conversation = session.get(ConversationSQL, IDS[0])
+        assert (conversation.title, conversation.message_count) == ("Chat", 0)
+
+    generate = mocker.patch(
+        "app.main.controller.conversation_controller.generate_messages"
+    )
+    response = app.test_client().post(
+        f"/conversations/{IDS[0]}/messages", json={"role": "user", "message": "hi"}
+    )
+    assert response.status_code == 404
+    generate.assert_not_called()
@@ -0,0 +1,98 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import uuid
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from benchmarks import fakes  # noqa: F401, renders UUID columns on SQLite
+from app.main.model.conversation import ConversationSQL
+from app.main.service import search_service
+from db import migrate
+
+USER = "user@example.com"
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path, mocker):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate.upgrade(engine)
+    mocker.patch.object(search_service, "get_engine", return_value=engine)
+    mocker.patch.object(search_service, "get_read_engine", return_value=engine)
+    return engine
+
+
+def add_conversation(engine, title, user_email=USER):
+    conversation_id = str(uuid.uuid4())
+    with Session(engine) as session:
+        session.add(ConversationSQL(conversation_id, user_email, title, "Gemini", {}))
+        session.commit()
+    return conversation_id
+
+
+def test_indexed_messages_and_titles_are_searchable(sqlite_engine, mocker):
+    python = add_conversation(sqlite_engine, "Python decorators")
+    other = add_conversation(sqlite_engine, "Cooking")
+    add_conversation(sqlite_engine, "Python for others", user_email="other@example.com")
+    mocker.patch.object(
+        search_service, "get_conversation_settings", return_value={"user_email": USER}
+    )
+    search_service.index_messages(
+        other,
+        [
+            {"role": "user", "message": "How do I use a Python decorator?"},
+            {"role": "system", "message": "Wrap the function."},
+            {"role": "system", "message": ""},
+        ],
+    )
+
+    first = search_service.search_conversations(USER, "python", limit=1)
+    second = search_service.search_conversations(USER, "python", limit=1, offset=1)
+
+    assert first["next_offset"] == 1 and second["next_offset"] is None
+    hits = first["hits"] + second["hits"]
+    assert sorted((hit["conversation_id"], hit["role"]) for hit in hits) == sorted(
+        [(python, "title"), (other, "user")]
+    )
+    assert search_service.search_conversations(USER, "wrap function")["hits"][0][
+        "title"
+    ] == "Cooking"
+    assert search_service.search_conversations(USER, "rust")["hits"] == []
+
+
+def test_messages_of_unknown_conversations_are_not_indexed(sqlite_engine, mocker):
+    mocker.patch.object(
+        search_service, "get_conversation_settings", return_value={}
+    )
+
+    search_service.index_messages("c1", [{"role": "user", "message": "hi"}])
+
+    with sqlite_engine.connect() as connection:
+        assert connection.execute(
+            sqlalchemy.text("SELECT COUNT(*) FROM message_search")
+        ).scalar() == 0
+
+
+def test_postgres_search_uses_the_indexed_expressions():
+    sql = str(
+        search_service.search_statement(USER, "cats -dogs", 21, 0, "postgresql").compile(
+            dialect=postgresql.dialect()
+        )
+    )
+
+    assert "to_tsvector('english', coalesce(message_search.message, ''))" in sql
+    assert "to_tsvector('english', coalesce(conversation.title, ''))" in sql
+    # snippets are only computed for the page
+    assert sql.index("ts_headline") < sql.index("LIMIT")
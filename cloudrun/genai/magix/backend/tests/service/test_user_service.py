@@ -0,0 +1,72 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from benchmarks import fakes  # noqa: F401, renders UUID columns on SQLite
+from db import migrate
+from app.main.model.user import UserSQL
+from app.main.service import user_service
+from app.main.util.cache import TTLCache
+
+
+@pytest.fixture
+def engine(mocker, tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate.upgrade(engine)
+    mocker.patch.object(user_service, "get_engine", return_value=engine)
+    mocker.patch.object(user_service, "get_read_engine", return_value=engine)
+    mocker.patch.object(user_service, "_users_by_email", TTLCache(10, 60))
+    return engine
+
+
+def test_upsert_user_creates_once(engine):
+    first = user_service.upsert_user("ada@example.com")
+    second = user_service.upsert_user("ada@example.com")
+
+    assert first == second
+    assert first["username"] == "ada"
+    count = sqlalchemy.select(sqlalchemy.func.count()).select_from(UserSQL.__table__)
+    with engine.connect() as connection:
+        assert connection.execute(count).scalar() == 1
+
+
+def test_upsert_user_suffixes_taken_username(engine):
+    user_service.upsert_user("ada@example.com")
+
+    user = user_service.upsert_user("ada@example.org")
+
+    assert user["email"] == "ada@example.org"
+    assert user["username"].startswith("ada_")
+
+
+def test_get_user_data_email_is_cached(engine, mocker):
+    upsert = mocker.spy(user_service, "upsert_user")
+
+    for _ in range(3):
+        assert user_service.get_user_data_email("ada@example.com")["username"] == "ada"
+
+    upsert.assert_called_once()
+
+
+def test_postgres_upsert_is_one_statement():
+    values = {"email": "ada@example.com", "username": "ada"}
+    statement = user_service._upsert_statement(UserSQL.__table__, values, "postgresql")
+
+    sql = str(statement.compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith("WITH inserted AS")
+    assert "ON CONFLICT DO NOTHING RETURNING" in sql
+    assert "UNION ALL" in sql
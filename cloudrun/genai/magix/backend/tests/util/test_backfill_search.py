@@ -0,0 +1,101 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import pytest
+import sqlalchemy
+from benchmarks.fakes import FakeStorageClient
+from app.main.model.conversation import ConversationSQL
+from app.main.model.search import MessageSearchSQL
+from app.main.util import utils
+from db import migrate
+from jobs import backfill_search
+
+USER = "user@example.com"
+UNTIL = datetime.datetime(2024, 1, 10)
+
+
+@pytest.fixture
+def engine(tmp_path, mocker):
+    mocker.patch.object(utils, "get_storage_client", FakeStorageClient())
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate.upgrade(engine)
+    mocker.patch.object(backfill_search, "get_engine", return_value=engine)
+    return engine
+
+
+def add_conversation(engine, index, messages, day=1):
+    conversation_id = f"00000000-0000-4000-8000-{index:012d}"
+    with engine.begin() as connection:
+        connection.execute(
+            ConversationSQL.__table__.insert().values(
+                id=conversation_id, user_email=USER, title="Chat", llm_name="Gemini",
+                llm_params={}, message_count=len(messages),
+                last_message_at=datetime.datetime(2024, 1, day, 12),
+            )
+        )
+    utils.write_file_to_gcs(conversation_id, messages, "message")
+    return conversation_id
+
+
+def indexed(engine):
+    table = MessageSearchSQL.__table__
+    with engine.connect() as connection:
+        return sorted(
+            (row.conversation_id, row.message)
+            for row in connection.execute(sqlalchemy.select(table))
+        )
+
+
+def test_backfill_indexes_missing_messages_once(engine, mocker):
+    mocker.patch.object(backfill_search, "BACKFILL_BATCH_SIZE", 2)
+    turn = [{"role": "user", "message": "hi"}, {"role": "system", "message": "Hello"}]
+    first = add_conversation(engine, 1, turn + turn)
+    second = add_conversation(engine, 2, turn + [{"role": "system", "message": ""}])
+    add_conversation(engine, 3, turn, day=11)
+    # the last turn of the first conversation was indexed as it was persisted
+    with engine.begin() as connection:
+        connection.execute(
+            MessageSearchSQL.__table__.insert(),
+            [dict(conversation_id=first, user_email=USER, **message) for message in turn],
+        )
+
+    count, skipped = backfill_search.backfill(until=UNTIL)
+    rerun_count, _ = backfill_search.backfill(until=UNTIL)
+
+    assert count == 4
+    assert rerun_count == 0
+    assert skipped == []
+    assert indexed(engine) == sorted(
+        [(first, "hi"), (first, "Hello")] * 2 + [(second, "hi"), (second, "Hello")]
+    )
+
+
+def test_backfill_resumes_after_an_id_and_reports_unread_conversations(engine, mocker):
+    first = add_conversation(engine, 1, [{"role": "user", "message": "one"}])
+    second = add_conversation(engine, 2, [{"role": "user", "message": "two"}])
+    third = add_conversation(engine, 3, [{"role": "user", "message": "three"}])
+    mocker.patch.object(
+        backfill_search,
+        "read_messages",
+        side_effect=lambda conversation_id: (
+            None if conversation_id == third else [{"role": "user", "message": "two"}]
+        ),
+    )
+
+    count, skipped = backfill_search.backfill(after=first, until=UNTIL)
+
+    assert count == 1
+    assert skipped == [third]
+    assert indexed(engine) == [(second, "two")]
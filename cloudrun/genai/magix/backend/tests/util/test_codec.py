@@ -0,0 +1,37 @@
+import uuid
+import pytest
+from app.main.util import codec
+
+
+def test_dumps_is_compact_and_handles_uuid():
+    conversation_id = uuid.UUID("b8e234ee-3849-4d51-b8e8-ea768eee08e3")
+    encoded = codec.dumps({"id": conversation_id, "title": "Untitled Chat"})
+    assert encoded == b'{"id":"b8e234ee-3849-4d51-b8e8-ea768eee08e3","title":"Untitled Chat"}'
+    assert codec.loads(encoded) == {
+        "id": "b8e234ee-3849-4d51-b8e8-ea768eee08e3",
+        "title": "Untitled Chat",
+    }
+
+
+@pytest.mark.parametrize(
+    "line, content",
+    [
+        ('data: {"choices":[{"delta":{"content":"def"}}]}', "def"),
+        ('data: {"choices":[{"delta":{"role":"assistant"}}]}', None),
+        ('data: {"choices":[],"usage":{"total_tokens":3}}', None),
+        ("data: [DONE]", None),
+        (": keep-alive", None),
+    ],
+)
+def test_decode_codestral_chunk(line, content):
+    assert codec.decode_codestral_chunk(line) == content
+
+
+def test_decode_codestral_chunk_malformed():
+    with pytest.raises(codec.DecodeError):
+        codec.decode_codestral_chunk("data: {not json")
+
+
+def test_decode_codestral_message():
+    body = '{"choices":[{"message":{"role":"assistant","content":"print(1)"}}]}'
+    assert codec.decode_codestral_message(body) == "print(1)"
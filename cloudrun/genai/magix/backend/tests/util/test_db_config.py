@@ -0,0 +1,158 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import itertools
+import threading
+import pytest
+import sqlalchemy
+from flask import Flask
+from db import config
+from app.main.util import metrics
+
+
+@pytest.fixture
+def shared_engine(mocker, tmp_path):
+    mocker.patch.object(config, "_engine", None)
+    mocker.patch.dict("os.environ", {"DATABASE_URL": f"sqlite:///{tmp_path}/test.db"})
+    connect = mocker.patch.object(config, "connect_with_connector")
+    yield
+    connect.assert_not_called()
+
+
+def test_engine_is_created_once_on_first_use(shared_engine):
+    engines = []
+    threads = [
+        threading.Thread(target=lambda: engines.append(config.get_engine()))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(engines) == 8
+    assert all(engine is engines[0] for engine in engines)
+    with engines[0].connect() as connection:
+        assert connection.execute(sqlalchemy.text("select 1")).scalar() == 1
+
+
+def test_pool_records_checkout_waits_and_timeouts():
+    engine = sqlalchemy.create_engine(
+        "sqlite://",
+        poolclass=config.TimedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=0.05,
+    )
+    timeouts = metrics.get_counter("db_pool_checkout_timeouts_total")
+
+    with engine.connect():
+        with pytest.raises(sqlalchemy.exc.TimeoutError):
+            engine.connect()
+
+    assert metrics.get_counter("db_pool_checkout_timeouts_total") == timeouts + 1
+    assert "db_pool_checkout_wait_seconds_count" in metrics.render_prometheus()
+
+
+@pytest.fixture
+def replicas(shared_engine, mocker, tmp_path):
+    mocker.patch.object(config, "_replicas", None)
+    mocker.patch.object(config, "_recent_writes", None)
+    mocker.patch.object(config, "_replica_turn", itertools.count())
+    mocker.patch.object(
+        config,
+        "DATABASE_REPLICA_URLS",
+        [f"sqlite:///{tmp_path}/replica{index}.db" for index in range(2)],
+    )
+    return config.get_replicas()
+
+
+def test_reads_are_spread_over_current_replicas(replicas, mocker):
+    engines = [config.get_read_engine("a@example.com") for _ in range(4)]
+
+    assert engines == [replica.engine for replica in replicas] * 2
+    mocker.patch.object(replicas[0], "lag", config.REPLICA_MAX_LAG_SECONDS + 1)
+    assert {config.get_read_engine() for _ in range(4)} == {replicas[1].engine}
+    mocker.patch.object(replicas[1], "lag", float("inf"))
+    assert config.get_read_engine() is config.get_engine()
+
+
+def test_recent_writes_are_read_from_caught_up_replicas(replicas, mocker):
+    now = mocker.patch.object(config.time, "monotonic", return_value=100.0)
+    replicas[0].lag, replicas[1].lag = 0.5, 5
+
+    config.record_write("a@example.com")
+
+    assert config.get_read_engine("a@example.com") is config.get_engine()
+    assert config.get_read_engine("b@example.com") is not config.get_engine()
+    now.return_value = 102
+    assert {config.get_read_engine("b@example.com", "a@example.com") for _ in range(2)} == {
+        replicas[0].engine
+    }
+    now.return_value = 107
+    assert len({config.get_read_engine("a@example.com") for _ in range(2)}) == 2
+
+
+def test_unreachable_replicas_are_excluded(replicas, mocker):
+    mocker.patch.object(
+        config, "measure_replica_lag", side_effect=[0.2, ConnectionError("down")]
+    )
+    stop_event = threading.Event()
+    stop_event.set()
+
+    config.monitor_replicas(replicas, stop_event)
+
+    assert replicas[0].lag == 0.2 and replicas[1].lag == float("inf")
+
+
+def test_caller_writes_are_read_from_caught_up_replicas_on_any_instance(replicas):
+    app = Flask(__name__)
+    config.init_read_your_writes(app)
+
+    @app.route("/write")
+    def write():
+        config.record_write("a@example.com")
+        return "written"
+
+    response = app.test_client().get("/write")
+    written_at = response.headers[config.LAST_WRITE_HEADER]
+    assert config.LAST_WRITE_COOKIE in response.headers["Set-Cookie"]
+
+    # another instance, which did not record the write
+    config._recent_writes.clear()
+    with app.test_request_context(headers={config.LAST_WRITE_HEADER: written_at}):
+        assert config.get_read_engine() is config.get_engine()
+    with app.test_request_context(headers={config.LAST_WRITE_HEADER: str(time.time() - 60)}):
+        assert config.get_read_engine() is not config.get_engine()
+
+
+def test_cross_origin_responses_expose_the_last_write(replicas):
+    from app import create_app
+
+    app = create_app()
+
+    @app.route("/test-write", methods=["POST"])
+    def write():
+        config.record_caller_write()
+        return "written"
+
+    response = app.test_client().post(
+        "/test-write", headers={"Origin": "https://navi.example.com"}
+    )
+
+    assert config.LAST_WRITE_HEADER in response.headers
+    assert config.LAST_WRITE_HEADER in response.headers["Access-Control-Expose-Headers"]
+    assert response.headers["Access-Control-Allow-Origin"] == "https://navi.example.com"
+    assert response.headers["Access-Control-Allow-Credentials"] == "true"
@@ -0,0 +1,123 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import pytest
+import sqlalchemy
+from benchmarks.fakes import FakeStorageClient
+from app.main.model.conversation import ConversationSQL
+from app.main.util import utils
+from db import migrate
+from jobs import export_analytics
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+USER = "user@example.com"
+UNTIL = datetime.datetime(2024, 1, 10)
+
+
+@pytest.fixture
+def engine(tmp_path, mocker):
+    mocker.patch.object(utils, "get_storage_client", FakeStorageClient())
+    mocker.patch.object(export_analytics, "ANALYTICS_HASH_KEY", "secret")
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+    migrate.upgrade(engine)
+    mocker.patch.object(export_analytics, "get_read_engine", return_value=engine)
+    return engine
+
+
+def add_conversation(engine, index, day):
+    conversation_id = f"00000000-0000-4000-8000-{index:012d}"
+    last_message_at = datetime.datetime(2024, 1, day, 12)
+    with engine.begin() as connection:
+        connection.execute(
+            ConversationSQL.__table__.insert().values(
+                id=conversation_id, user_email=USER, title="Chat", llm_name="Gemini",
+                llm_params={}, message_count=1, created_at=last_message_at,
+                last_message_at=last_message_at,
+            )
+        )
+    messages = [
+        {"role": "user", "message": "hi"},
+        {
+            "role": "system",
+            "message": "Hello world",
+            "metadata": {
+                "llm_name": "Gemini",
+                "llm_params": {"temperature": 0.2},
+                "created_at": "2024-01-01T12:00:00+00:00",
+                "ttft_ms": 120,
+                "duration_ms": 900,
+            },
+        },
+    ]
+    utils.write_file_to_gcs(conversation_id, messages, "message")
+    return conversation_id
+
+
+def read(tmp_path, name):
+    return pq.read_table(tmp_path / "export" / name).to_pylist()
+
+
+def test_export_is_partitioned_and_incremental(engine, tmp_path, mocker):
+    mocker.patch.object(export_analytics, "EXPORT_BATCH_SIZE", 2)
+    first = [add_conversation(engine, index, 1 + index % 2) for index in range(3)]
+    output = str(tmp_path / "export")
+
+    assert export_analytics.Exporter(output).run(until=UNTIL) == 3
+    add_conversation(engine, 3, 2)
+    assert export_analytics.Exporter(output).run(until=UNTIL) == 1
+    assert export_analytics.Exporter(output).run(until=UNTIL) == 0
+
+    conversations = read(tmp_path, "conversations")
+    assert sorted(row["conversation_id"] for row in conversations) == sorted(
+        first + ["00000000-0000-4000-8000-000000000003"]
+    )
+    assert {row["dt"] for row in conversations} == {"2024-01-01", "2024-01-02"}
+    assert conversations[0]["user_hash"] == export_analytics.hash_user(USER, "secret")
+    turns = read(tmp_path, "turns")
+    assert len(turns) == 8
+    answer = next(row for row in turns if row["role"] == "system")
+    assert answer["llm_name"] == "Gemini"
+    assert answer["llm_params"] == '{"temperature": 0.2}'
+    assert (answer["message_chars"], answer["ttft_ms"], answer["duration_ms"]) == (11, 120, 900)
+
+
+def test_export_refuses_serving_bucket():
+    with pytest.raises(ValueError):
+        export_analytics.Exporter(f"gs://{export_analytics.SERVING_BUCKET}/analytics")
+
+
+def test_interrupted_export_resumes_after_the_last_page(engine, tmp_path, mocker):
+    mocker.patch.object(export_analytics, "EXPORT_BATCH_SIZE", 2)
+    ids = [add_conversation(engine, index, 1) for index in range(5)]
+    output = str(tmp_path / "export")
+    exporter = export_analytics.Exporter(output)
+    export_page = exporter.export_page
+
+    def fail_second_page(conversations, page):
+        if page == 1:
+            raise RuntimeError("storage unavailable")
+        return export_page(conversations, page)
+
+    mocker.patch.object(exporter, "export_page", side_effect=fail_second_page)
+    with pytest.raises(RuntimeError):
+        exporter.run(until=UNTIL)
+
+    assert exporter.read_watermark() == (datetime.datetime(2024, 1, 1, 12), ids[1])
+    # conversations of the same time are paged by id
+    assert export_analytics.Exporter(output).run(until=UNTIL) == 3
+    conversations = read(tmp_path, "conversations")
+    assert sorted(row["conversation_id"] for row in conversations) == ids
+    assert len(list((tmp_path / "export" / "conversations" / "dt=2024-01-01").iterdir())) == 3
@@ -0,0 +1,44 @@
+import threading
+import pytest
+from app import create_app
+from app.main.util import metrics
+
+
+@pytest.fixture
+def client():
+    return create_app().test_client()
+
+
+def test_counters_are_summed_across_threads():
+    def work():
+        for _ in range(1000):
+            metrics.increment_counter("test_events_total", kind="a")
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert metrics.get_counter("test_events_total", kind="a") == 4000
+
+
+def test_instrument_stream_renders_prometheus_histograms():
+    chunks = [{"role": "system", "message": "12345678"}, {"role": "system", "message": "1234"}]
+
+    assert list(metrics.instrument_stream(iter(chunks), "llm", llm_name="Test")) == chunks
+
+    text = metrics.render_prometheus()
+    assert 'llm_requests_total{llm_name="Test"} 1' in text
+    assert 'llm_chunks_total{llm_name="Test"} 2' in text
+    assert 'llm_output_tokens_total{llm_name="Test"} 3' in text
+    assert 'llm_time_to_first_token_seconds_bucket{llm_name="Test",le="+Inf"} 1' in text
+    assert 'llm_duration_seconds_count{llm_name="Test"} 1' in text
+    assert "# TYPE llm_tokens_per_second histogram" in text
+
+
+def test_metrics_endpoint(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert b"# TYPE chat_duration_seconds histogram" in response.data
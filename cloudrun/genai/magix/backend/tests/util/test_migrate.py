@@ -0,0 +1,81 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import sqlalchemy
+from benchmarks import fakes  # noqa: F401, renders UUID columns on SQLite
+from db import migrate
+
+
+@pytest.fixture
+def engine(tmp_path):
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path}/test.db")
+
+
+def test_models_match_migrated_schema(engine):
+    versions = [migration.version for migration in migrate.discover()]
+
+    assert migrate.upgrade(engine) == versions
+    assert migrate.upgrade(engine) == []
+    assert migrate.check_drift(engine) == []
+
+
+def test_migrations_are_reversible_and_idempotent(engine):
+    migrate.upgrade(engine)
+    latest = migrate.discover()[-1]
+
+    migrate.downgrade(engine, latest.version - 1)
+    assert migrate.applied_versions(engine) == set(range(1, latest.version))
+    # up runs again when its version was not recorded
+    latest.run(engine, "up")
+    latest.run(engine, "up")
+    migrate.upgrade(engine)
+    assert migrate.check_drift(engine) == []
+
+    migrate.downgrade(engine, 0)
+    assert set(sqlalchemy.inspect(engine).get_table_names()) == {migrate.VERSION_TABLE}
+
+
+def test_check_drift_reports_missing_index(engine):
+    migrate.upgrade(engine, target=1)
+
+    assert "index uq_user_email on user is not migrated" in migrate.check_drift(engine)
+
+
+def test_check_drift_reports_column_and_index_changes(engine):
+    migrated = sqlalchemy.MetaData()
+    table = sqlalchemy.Table(
+        "item", migrated,
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("name", sqlalchemy.String(20)),
+        sqlalchemy.Column("created_at", sqlalchemy.TIMESTAMP),
+    )
+    sqlalchemy.Index("ix_item_name", table.c.name)
+    migrated.create_all(engine)
+
+    model = sqlalchemy.MetaData()
+    table = sqlalchemy.Table(
+        "item", model,
+        sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+        sqlalchemy.Column("name", sqlalchemy.String(40), nullable=False),
+        sqlalchemy.Column("created_at", sqlalchemy.DateTime),
+    )
+    sqlalchemy.Index("ix_item_name", table.c.name, table.c.created_at, unique=True)
+
+    assert migrate.check_drift(engine, [model]) == [
+        "column item.name is VARCHAR(20), VARCHAR(40) in the model",
+        "column item.name is nullable, not in the model",
+        "index ix_item_name on item is on ['name'], ['name', 'created_at'] in the model",
+        "index ix_item_name on item is not unique, not in the model",
+    ]
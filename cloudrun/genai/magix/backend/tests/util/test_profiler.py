@@ -0,0 +1,95 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+import pytest
+from app import create_app
+from app.main.util import profiler
+from app.main.util.tracing import run_in_current_context
+
+
+def busy_loop(stop_event):
+    while not stop_event.is_set():
+        sum(range(1000))
+
+
+@pytest.fixture
+def busy_thread():
+    stop_event = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stop_event,), name="busy")
+    thread.start()
+    yield thread
+    stop_event.set()
+    thread.join()
+
+
+def test_profile_process_returns_collapsed_stacks(busy_thread):
+    result = profiler.profile_process(0.2, interval=0.005, top_n=5)
+
+    assert result["samples"] > 0
+    busy_stacks = [
+        line for line in result["collapsed"].splitlines() if line.startswith("busy;")
+    ]
+    assert busy_stacks
+    assert all("busy_loop (test_profiler.py:" in line for line in busy_stacks)
+    assert len(result["allocations"]) <= 5
+
+
+def test_only_one_profile_runs_at_a_time(busy_thread):
+    running = threading.Thread(target=profiler.profile_process, args=(0.5,))
+    running.start()
+    time.sleep(0.1)
+    with pytest.raises(profiler.ProfilerBusy):
+        profiler.profile_process(0.1)
+    running.join()
+
+
+def test_request_capture_samples_only_the_request_threads(busy_thread):
+    profile = profiler.arm_request_capture(interval=0.005)
+    worker_stop = threading.Event()
+
+    with profiler.request_capture(profile.id) as capture:
+        assert capture is profile
+        worker = threading.Thread(
+            target=run_in_current_context(busy_loop), args=(worker_stop,), name="worker"
+        )
+        worker.start()
+    time.sleep(0.2)
+    worker_stop.set()
+    worker.join()
+    capture.stop_event.set()
+    while capture.result is None:
+        time.sleep(0.01)
+
+    threads = {line.split(";")[0] for line in capture.result["collapsed"].splitlines()}
+    assert "worker" in threads
+    assert "busy" not in threads
+    with profiler.request_capture(profile.id) as capture:
+        assert capture is None
+
+
+def test_profile_routes_require_an_admin(mocker):
+    client = create_app().test_client()
+    get_user = mocker.patch(
+        "app.main.service.user_service.get_user_from_token",
+        return_value={"email": "user@example.com", "is_admin": False},
+    )
+
+    assert client.post("/admin/profile").status_code == 401
+    response = client.post(
+        "/admin/profile", headers={"Authorization": "Bearer token"}
+    )
+    assert response.status_code == 403
+    get_user.assert_called_once_with("token")
@@ -0,0 +1,60 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+from flask import Flask
+from app.main.util import recorder
+
+CONVERSATION_ID = "b8e234ee-3849-4d51-b8e8-ea768eee08e3"
+
+
+def test_records_anonymised_request_shapes(mocker, tmp_path):
+    mocker.patch.object(recorder, "TRAFFIC_RECORD_FILE", str(tmp_path / "traffic.ndjson"))
+    mocker.patch.object(recorder, "_records", queue.Queue())
+    mocker.patch("threading.Thread")
+    app = Flask(__name__)
+    recorder.init_recorder(app)
+
+    @app.route("/conversations/<string:conversation_id>/messages", methods=["POST"])
+    def messages(conversation_id):
+        return "ok"
+
+    client = app.test_client()
+    for prompt in ("secret prompt", "another one"):
+        client.post(
+            f"/conversations/{CONVERSATION_ID}/messages?userEmail=user@example.com",
+            json={"role": "user", "message": prompt, "llm_names": ["Gemini"]},
+        ).close()
+
+    first, second = recorder._records.get_nowait(), recorder._records.get_nowait()
+    assert first["route"] == "/conversations/<string:conversation_id>/messages"
+    assert first["prompt_chars"] == len("secret prompt")
+    assert first["llm_names"] == ["Gemini"]
+    assert first["status"] == 200
+    assert "duration_ms" in first
+    assert (first["turn"], second["turn"]) == (1, 2)
+    assert first["conversation"] == second["conversation"]
+    recorded = repr(first)
+    assert CONVERSATION_ID not in recorded
+    assert "secret" not in recorded
+    assert "user@example.com" not in recorded
+
+
+def test_recorder_is_opt_in(mocker):
+    mocker.patch.object(recorder, "TRAFFIC_RECORD_FILE", None)
+    app = Flask(__name__)
+
+    recorder.init_recorder(app)
+
+    assert not app.before_request_funcs
@@ -0,0 +1,47 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pytest
+from benchmarks import startup
+
+# Seconds importing the app and creating it may take, generous for slow CI runners.
+IMPORT_TIME_BUDGET_SECONDS = float(os.environ.get("IMPORT_TIME_BUDGET_SECONDS", 3))
+
+
+@pytest.fixture(scope="module")
+def timing():
+    return startup.measure()
+
+
+def test_provider_sdks_are_not_imported_at_startup(timing):
+    assert startup.loaded_lazy_modules(timing["modules"]) == []
+
+
+def test_startup_within_import_time_budget(timing):
+    slowest = startup.by_package(timing["imports"])[:5]
+    assert timing["seconds"] < IMPORT_TIME_BUDGET_SECONDS, f"slowest packages: {slowest}"
+
+
+def test_parse_importtime():
+    output = (
+        "import time: self [us] | cumulative | imported package\n"
+        "import time:       120 |        120 |     google.auth\n"
+        "import time:        30 |        150 |   google\n"
+    )
+
+    assert startup.parse_importtime(output) == [
+        ("google.auth", 120, 120, 2),
+        ("google", 30, 150, 1),
+    ]
@@ -0,0 +1,55 @@
+import json
+import queue
+from app.main.util.streaming import (
+    END_OF_STREAM,
+    coalesce_events,
+    format_sse_event,
+    sse_stream,
+)
+
+
+def parse_frames(frames):
+    events = []
+    for frame in frames:
+        text = frame.decode("utf-8")
+        if text.startswith(":"):
+            events.append(("comment", None, None))
+            continue
+        fields = dict(line.split(": ", 1) for line in text.strip().split("\n"))
+        events.append((fields["event"], fields.get("id"), json.loads(fields["data"])))
+    return events
+
+
+def test_format_sse_event():
+    frame = format_sse_event({"role": "system", "message": "hi"}, event_id=3)
+    assert frame == b'event: message\nid: 3\ndata: {"role":"system","message":"hi"}\n\n'
+
+
+def test_sse_stream_flushes_first_chunk_and_coalesces_the_rest():
+    chunks = [{"role": "system", "message": "a"} for _ in range(5)]
+    events = parse_frames(sse_stream(iter(chunks), max_bytes=1024, max_delay=10))
+
+    assert events[0] == ("message", "0", {"role": "system", "message": "a"})
+    assert events[1] == ("message", "4", {"role": "system", "message": "aaaa"})
+    assert events[2] == ("done", "4", {})
+
+
+def test_sse_stream_flushes_on_size():
+    chunks = [{"role": "system", "message": "abc"} for _ in range(5)]
+    events = parse_frames(sse_stream(iter(chunks), max_bytes=6, max_delay=10))
+
+    assert [event[2]["message"] for event in events[:-1]] == ["abc", "abcabc", "abcabc"]
+
+
+def test_coalesce_events_sends_heartbeat_when_idle():
+    items = [queue.Empty, (0, {"role": "system", "message": "a"}), END_OF_STREAM]
+
+    def poll(timeout):
+        item = items.pop(0)
+        if item is queue.Empty:
+            raise queue.Empty
+        return item
+
+    events = parse_frames(coalesce_events(poll, heartbeat_interval=0))
+
+    assert [event[0] for event in events] == ["comment", "message", "done"]
@@ -0,0 +1,73 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from google.auth import jwt
+from benchmarks.fakes import FakeTokenIssuer
+from app.main.util import token_verifier
+
+
+@pytest.fixture(scope="module")
+def issuer():
+    return FakeTokenIssuer(audience="client-id")
+
+
+@pytest.fixture
+def fetch_certs(mocker, issuer):
+    token_verifier.clear()
+    yield mocker.patch.object(
+        token_verifier, "fetch_certs", return_value=(issuer.certs(), 3600)
+    )
+    token_verifier.clear()
+
+
+def test_verified_tokens_and_certs_are_cached(fetch_certs, issuer, mocker):
+    decode = mocker.spy(jwt, "decode")
+    first, second = issuer.token("a@example.com"), issuer.token("b@example.com")
+
+    for _ in range(3):
+        assert token_verifier.verify(first, "client-id")["email"] == "a@example.com"
+    assert token_verifier.verify(second, "client-id")["email"] == "b@example.com"
+
+    fetch_certs.assert_called_once()
+    assert decode.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "claims, audience",
+    [({"lifetime": -60}, "client-id"), ({}, "other-client"), ({"iss": "evil"}, "client-id")],
+)
+def test_invalid_tokens_are_rejected(fetch_certs, issuer, claims, audience):
+    token = issuer.token(**claims)
+
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            token_verifier.verify(token, audience)
+
+
+def test_unknown_key_refreshes_certs(fetch_certs, issuer, mocker):
+    token_verifier.verify(issuer.token(), "client-id")
+    rotated = FakeTokenIssuer(audience="client-id", key_id="rotated-key")
+    fetch_certs.return_value = ({**issuer.certs(), **rotated.certs()}, 3600)
+    mocker.patch.object(token_verifier, "CERTS_MIN_REFRESH_SECONDS", 0)
+
+    assert token_verifier.verify(rotated.token(), "client-id")
+    assert fetch_certs.call_count == 2
+
+
+def test_max_age():
+    headers = {"Cache-Control": "public, max-age=19800, must-revalidate", "Age": "800"}
+
+    assert token_verifier.max_age(headers) == 19000
+    assert token_verifier.max_age({"Cache-Control": "no-cache"}) is None
@@ -0,0 +1,132 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import pytest
+from flask import Flask
+from app.main.util import codec, tracing
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+@pytest.fixture
+def exported(mocker):
+    spans = []
+    mocker.patch.object(tracing, "_export", spans.append)
+    return spans
+
+
+def test_nested_spans_share_the_trace(exported, mocker):
+    mocker.patch.object(tracing, "TRACE_SAMPLE_RATIO", 1)
+
+    @tracing.traced("child")
+    def child():
+        return "done"
+
+    with tracing.start_span("parent", conversation_id="c1") as parent:
+        assert child() == "done"
+
+    child_span, parent_span = exported
+    assert parent_span is parent
+    assert child_span.trace_id == parent.trace_id
+    assert child_span.parent_id == parent.span_id
+    assert parent.attributes == {"conversation_id": "c1"}
+    assert tracing.current_span() is None
+
+
+def test_unsampled_spans_are_not_exported(exported):
+    with tracing.start_span("parent"):
+        pass
+    assert exported == []
+
+
+def test_traced_generator_is_current_while_running(exported, mocker):
+    mocker.patch.object(tracing, "TRACE_SAMPLE_RATIO", 1)
+
+    @tracing.traced("chunks")
+    def chunks():
+        yield tracing.current_span().name
+        with tracing.start_span("upload"):
+            pass
+        yield "last"
+
+    generator = chunks()
+    assert next(generator) == "chunks"
+    assert tracing.current_span() is None
+    assert list(generator) == ["last"]
+
+    upload, chunks_span = exported
+    assert upload.parent_id == chunks_span.span_id
+
+
+def test_errors_are_recorded(exported, mocker):
+    mocker.patch.object(tracing, "TRACE_SAMPLE_RATIO", 1)
+
+    with pytest.raises(ValueError):
+        with tracing.start_span("failing"):
+            raise ValueError("boom")
+
+    assert exported[0].error == "ValueError: boom"
+
+
+def test_threads_continue_the_callers_trace(exported):
+    app = Flask(__name__)
+    tracing.init_tracing(app)
+    spans = []
+
+    def work():
+        with tracing.start_span("work") as span:
+            spans.append(span)
+
+    @app.route("/work")
+    def work_route():
+        threads = [
+            threading.Thread(target=tracing.run_in_current_context(work))
+            for _ in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return "ok"
+
+    response = app.test_client().get(
+        "/work", headers={"traceparent": f"00-{TRACE_ID}-{PARENT_ID}-01"}
+    )
+    # the request span ends when the server closes the response
+    response.close()
+
+    request_span = exported[-1]
+    assert request_span.name == "GET /work"
+    assert request_span.parent_id == PARENT_ID
+    assert request_span.attributes["http.status_code"] == 200
+    assert response.headers["traceparent"] == f"00-{TRACE_ID}-{request_span.span_id}-01"
+    assert [span.parent_id for span in spans] == [request_span.span_id] * 2
+    assert all(span.trace_id == TRACE_ID for span in spans)
+
+
+def test_export_batch_writes_json_lines(mocker, tmp_path):
+    trace_file = tmp_path / "traces.jsonl"
+    mocker.patch.object(tracing, "TRACE_EXPORT_FILE", str(trace_file))
+    mocker.patch.object(tracing, "OTEL_EXPORTER_OTLP_ENDPOINT", None)
+    span = tracing.Span("gcs.read", TRACE_ID, PARENT_ID, sampled=True)
+    span.end_ns = span.start_ns + 2_000_000
+
+    tracing._export_batch([span])
+
+    line = codec.loads(trace_file.read_bytes().splitlines()[0])
+    assert line["name"] == "gcs.read"
+    assert line["parent_id"] == PARENT_ID
+    assert line["duration_ms"] == 2
@@ -1,56 +1,14 @@
 import os
-from typing import List
+import sys
 from dotenv import load_dotenv
-from google.cloud.sql.connector import Connector, IPTypes
+from google.cloud.sql.connector import Connector
 import sqlalchemy
-import sys
-from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, String, JSON, UUID, DateTime, Boolean, func
-
-
-Base = declarative_base()
-
-class ConversationSQL(Base):
-    """
-    Conversation class
-
-    """
-
-    __tablename__ = "conversation"
-    id = Column(UUID, unique=True, primary_key=True)
-    user_email = Column(String)
-    title = Column(String)
-    llm_name = Column(String)
-    llm_params = Column(JSON, nullable=True)
-    created_at = Column(DateTime, default=func.now())
-
-class LLMTableSQL(Base):
-    """
-    LLM sql table
-    """
-
-    __tablename__ = "llm"
-
-    name = Column(String, unique=True, nullable=False, primary_key=True)
-    display_name = Column(String)
-    provider = Column(String)
-    model_name = Column(String)
-    version = Column(String)
-    params = Column(JSON, nullable=True)
-    is_active = Column(Boolean, default=True)
 
-class UserSQL(Base):
-    """
-    Conversation class
+# The schema is owned by the migrations of the backend, see backend/db/migrate.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "backend"))
 
-    """
+from db.migrate import upgrade  # noqa: E402
 
-    __tablename__ = "user"
-    email = Column(String)
-    username = Column(String, unique=True, primary_key=True)
-    is_admin = Column(Boolean, default=False)
-    tenant_id = Column(UUID)
-    created_at = Column(DateTime, default=func.now())
 
 def connect():
     # initialize Connector object
@@ -72,11 +30,11 @@ def run_ddl_script(connector: Connector):
         ),
     )
 
-    Base.metadata.create_all(bind=engine)
+    upgrade(engine)
 
 
 
 if __name__ == "__main__":
     load_dotenv()
     connector = connect()
-    run_ddl_script(connector)
\ No newline at end of file
+    run_ddl_script(connector)